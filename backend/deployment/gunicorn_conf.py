@@ -6,6 +6,8 @@
 #
 
 import multiprocessing
+import os
+import shutil
 
 # Socket binding
 bind = "127.0.0.1:8000"
@@ -28,4 +30,18 @@ errorlog = "-"
 loglevel = "info"
 
 # Process naming
-proc_name = "personal_analytics"
\ No newline at end of file
+proc_name = "personal_analytics"
+# Prometheus metrics: the workers write their values to files in this directory, so that /metrics
+# reports the sum over all workers. It has to be set before the app is imported, and is emptied on
+# every start of the server.
+prometheus_multiproc_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/pa_prometheus_metrics")
+
+
+def on_starting(server):
+    shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+    os.makedirs(prometheus_multiproc_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -9,6 +9,15 @@
 #
 # Usage: python import.py <filename> [--api-base <url>] [--username <user>] [--password <pass>]
 #
+# For large (e.g., multi-user) exports, use the bulk mode:
+#
+#        python import.py <filename> --bulk [--concurrency <n>] [--batch-size <n>] [--checkpoint <file>]
+#
+# The bulk mode reads the file incrementally, sends chunks of entries to the batch endpoint of the API
+# (or single entries with several requests in flight, if the server has no batch endpoint), and keeps a
+# checkpoint file, so that re-running the same command after an interruption resumes where it stopped.
+# Besides JSON arrays as exported by the system, it also accepts files with one JSON object per line (NDJSON).
+#
 # You will need to have the 'requests' library installed. You can install it via pip: `pip install requests`,
 # preferably in a virtual environment.
 #
@@ -16,6 +25,10 @@
 import requests
 import json
 import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 # Configuration
@@ -26,6 +39,11 @@ API_BASE = "http://localhost:8000"  # Change to your production URL/system URL a
 HTTP_AUTH_USERNAME = "john"   # The default username for HTTP authentication, typically set in htpasswd file of web server.
 HTTP_AUTH_PASSWORD = "doe"    # The default password for HTTP authentication, typically set in htpasswd file of web server.
 
+# Bulk mode defaults
+BULK_CONCURRENCY = 4      # Number of requests in flight at the same time.
+BULK_BATCH_SIZE = 200     # Entries per request to the batch endpoint. Use 1 to always post single entries.
+READ_SIZE = 64 * 1024     # Characters read from the input file at a time.
+
 
 def import_data(filename : str, api_base: str = API_BASE, username: str = HTTP_AUTH_USERNAME, password: str = HTTP_AUTH_PASSWORD):
     """
@@ -81,6 +99,239 @@ def import_data(filename : str, api_base: str = API_BASE, username: str = HTTP_A
     print(f"   📋 Total: {len(entries)}")
 
 
+def iter_entries(filename: str, read_size: int = READ_SIZE):
+    """
+    Yield the entries of a JSON array file or an NDJSON file one by one, without loading the whole file.
+    @param filename: Path to the file
+    @param read_size: Number of characters to read at a time
+    """
+    decoder = json.JSONDecoder()
+    with open(filename, 'r', encoding='utf-8') as f:
+        buffer = f.read(read_size)
+        pos = 0
+        is_array = None
+        while True:
+            # Skip whitespace, and in an array also the separating commas
+            while pos < len(buffer) and (buffer[pos].isspace() or (is_array and buffer[pos] == ',')):
+                pos += 1
+            if pos >= len(buffer):
+                more = f.read(read_size)
+                if not more:
+                    if is_array:
+                        raise ValueError("Unexpected end of file, JSON array is not closed")
+                    return
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+
+            if is_array is None:
+                is_array = buffer[pos] == '['
+                if is_array:
+                    pos += 1
+                continue
+            if is_array and buffer[pos] == ']':
+                return
+
+            try:
+                entry, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Most likely the entry continues beyond what we have read so far
+                more = f.read(read_size)
+                if not more:
+                    raise
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            yield entry
+            pos = end
+
+
+def _read_checkpoint(checkpoint_file: str) -> dict:
+    try:
+        with open(checkpoint_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"next_index": 0, "failed": []}
+
+
+def _write_checkpoint(checkpoint_file: str, checkpoint: dict):
+    # Write to a temporary file first, so an interruption never leaves a broken checkpoint behind.
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_file, checkpoint_file)
+
+
+class BulkSender:
+    """
+    Sends chunks of entries to the API over a shared, pooled HTTP session. Used from several threads.
+    """
+
+    def __init__(self, api_base: str, username: str, password: str, concurrency: int, use_batch: bool):
+        self.api_base = api_base
+        self.use_batch = use_batch   # Switched off if the server turns out to have no batch endpoint
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(username, password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def send(self, chunk: list) -> list:
+        """
+        Send a chunk of (index, entry) pairs. Returns a list of (index, date, outcome, message) tuples,
+        where outcome is 'created', 'updated' or 'failed'.
+        """
+        if self.use_batch and len(chunk) > 1:
+            results = self._send_batch(chunk)
+            if results is not None:
+                return results
+        return [self._send_single(index, entry) for index, entry in chunk]
+
+    def _send_batch(self, chunk: list):
+        """Returns None if the chunk should be sent entry by entry instead."""
+        try:
+            response = self.session.post(
+                f"{self.api_base}/entries/batch",
+                json=[entry for _, entry in chunk],
+                timeout=120 # seconds
+            )
+        except requests.exceptions.RequestException:
+            return None  # Retried entry by entry, which reports the error per entry if it persists
+
+        if response.status_code in [404, 405]:
+            print("ℹ️  Server has no batch endpoint, sending single entries instead")
+            self.use_batch = False
+            return None
+        if response.status_code != 200:
+            # E.g., a single invalid entry rejects the whole batch. Find out which one(s).
+            return None
+
+        try:
+            operations = {result["index"]: result["operation"] for result in response.json()["results"]}
+        except (ValueError, KeyError):
+            return None
+        return [(index, entry.get('date'), operations[i], None) for i, (index, entry) in enumerate(chunk)]
+
+    def _send_single(self, index: int, entry: dict) -> tuple:
+        date = entry.get('date') if isinstance(entry, dict) else None
+        try:
+            response = self.session.post(f"{self.api_base}/entries/", json=entry, timeout=20)
+        except requests.exceptions.RequestException as e:
+            return (index, date, 'failed', f"Network error: {e}")
+
+        if response.status_code in [200, 201]:
+            return (index, date, response.headers.get('X-Operation', 'unknown'), None)
+        return (index, date, 'failed', f"HTTP {response.status_code}: {response.text}")
+
+
+def import_data_bulk(filename: str, api_base: str = API_BASE, username: str = HTTP_AUTH_USERNAME, password: str = HTTP_AUTH_PASSWORD,
+                     concurrency: int = BULK_CONCURRENCY, batch_size: int = BULK_BATCH_SIZE, checkpoint_file: str = None):
+    """
+    Import health data from a JSON or NDJSON export file with high throughput, resuming from a checkpoint if one exists.
+    @param filename: Path to the file to import
+    @param api_base: Base URL of the API
+    @param username: HTTP Basic Auth username, will be ignored if authentication is not enforced
+    @param password: HTTP Basic Auth password, will be ignored if authentication is not enforced
+    @param concurrency: Maximal number of requests in flight at the same time
+    @param batch_size: Number of entries per request to the batch endpoint, 1 disables the batch endpoint
+    @param checkpoint_file: Path of the checkpoint file, defaults to the input filename with '.checkpoint' appended
+    """
+    if not os.path.isfile(filename):
+        print(f"Error: File '{filename}' not found")
+        return
+
+    checkpoint_file = checkpoint_file or f"{filename}.checkpoint"
+    checkpoint = _read_checkpoint(checkpoint_file)
+    start_index = checkpoint["next_index"]
+    if start_index > 0:
+        print(f"Resuming from checkpoint '{checkpoint_file}': skipping the first {start_index} entries")
+
+    print(f"Using API: {api_base} with {concurrency} concurrent requests and batch size {batch_size}")
+
+    sender = BulkSender(api_base, username, password, concurrency, use_batch=batch_size > 1)
+    counts = {'created': 0, 'updated': 0, 'unknown': 0, 'failed': 0}
+    errors = {}            # error message (without details) -> count
+    finished_chunks = {}   # start index -> end index of chunks that are done, but not yet covered by the checkpoint
+    pending = set()
+    started_at = time.monotonic()
+
+    def handle_done(done_futures):
+        for future in done_futures:
+            chunk_start, chunk_end = future.chunk_range
+            for index, date, outcome, message in future.result():
+                counts[outcome] = counts.get(outcome, 0) + 1
+                if outcome == 'failed':
+                    print(f"❌ [{index + 1}] {date} - {message}")
+                    error_kind = message.split(':')[0]
+                    errors[error_kind] = errors.get(error_kind, 0) + 1
+                    checkpoint["failed"].append({"index": index, "date": date, "error": message})
+            finished_chunks[chunk_start] = chunk_end
+
+        # Only advance the checkpoint over contiguous finished chunks, as they complete out of order.
+        advanced = False
+        while checkpoint["next_index"] in finished_chunks:
+            checkpoint["next_index"] = finished_chunks.pop(checkpoint["next_index"])
+            advanced = True
+        if advanced:
+            _write_checkpoint(checkpoint_file, checkpoint)
+            processed = checkpoint["next_index"] - start_index
+            rate = processed / max(time.monotonic() - started_at, 1e-9)
+            print(f"✅ {checkpoint['next_index']} entries done ({rate:.0f} entries/s)")
+
+    def submit(executor, chunk):
+        future = executor.submit(sender.send, chunk)
+        future.chunk_range = (chunk[0][0], chunk[-1][0] + 1)
+        pending.add(future)
+        # Bound the number of chunks held in memory and in flight
+        if len(pending) >= concurrency * 2:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            pending.difference_update(done)
+            handle_done(done)
+
+    total = 0
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            chunk = []
+            for index, entry in enumerate(iter_entries(filename)):
+                total = index + 1
+                if index < start_index:
+                    continue
+                chunk.append((index, entry))
+                if len(chunk) >= batch_size:
+                    submit(executor, chunk)
+                    chunk = []
+            if chunk:
+                submit(executor, chunk)
+
+            done, _ = wait(pending)
+            pending.clear()
+            handle_done(done)
+    except (ValueError, json.JSONDecodeError) as e:
+        # Everything before the broken part was imported and is covered by the checkpoint.
+        print(f"Error: Invalid JSON in '{filename}' after entry {total}: {e}")
+    except KeyboardInterrupt:
+        print(f"\nInterrupted. Run the same command again to resume from checkpoint '{checkpoint_file}'.")
+        raise
+
+    elapsed = time.monotonic() - started_at
+    processed = checkpoint["next_index"] - start_index
+    success_count = counts['created'] + counts['updated'] + counts['unknown']
+
+    # A complete import without failures needs no checkpoint anymore
+    if checkpoint["next_index"] == total and not checkpoint["failed"] and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+    print(f"\n📊 Import Summary:")
+    print(f"   ✅ Successful: {success_count} ({counts['created']} created, {counts['updated']} updated)")
+    print(f"   ❌ Failed: {counts['failed']}")
+    for error, count in sorted(errors.items(), key=lambda item: -item[1]):
+        print(f"      {count} x {error}")
+    if start_index > 0:
+        print(f"   ⏭️  Skipped (already imported before): {start_index}")
+    print(f"   📋 Total: {total}")
+    print(f"   ⏱️  {processed} entries in {elapsed:.1f} s: {processed / max(elapsed, 1e-9):.0f} entries/s")
+    if checkpoint["failed"]:
+        print(f"   Failed entries are listed in checkpoint file '{checkpoint_file}'")
+
+
 def main():
     """
     Main entry point for the script.
@@ -93,15 +344,34 @@ def main():
                        help=f'Basic Auth username (default: {HTTP_AUTH_USERNAME})')
     parser.add_argument('--password', default=HTTP_AUTH_PASSWORD,
                        help=f'Basic Auth password (default: {HTTP_AUTH_PASSWORD})')
+    parser.add_argument('--bulk', action='store_true',
+                       help='Use the high-throughput, resumable bulk mode for large files')
+    parser.add_argument('--concurrency', type=int, default=BULK_CONCURRENCY,
+                       help=f'Bulk mode: number of concurrent requests (default: {BULK_CONCURRENCY})')
+    parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE,
+                       help=f'Bulk mode: entries per batch request, 1 to post single entries (default: {BULK_BATCH_SIZE})')
+    parser.add_argument('--checkpoint',
+                       help='Bulk mode: checkpoint file (default: <filename>.checkpoint)')
 
     args = parser.parse_args()
 
-    import_data(
-        filename=args.filename,
-        api_base=args.api_base,
-        username=args.username,
-        password=args.password
-    )
+    if args.bulk:
+        import_data_bulk(
+            filename=args.filename,
+            api_base=args.api_base,
+            username=args.username,
+            password=args.password,
+            concurrency=max(1, args.concurrency),
+            batch_size=max(1, args.batch_size),
+            checkpoint_file=args.checkpoint
+        )
+    else:
+        import_data(
+            filename=args.filename,
+            api_base=args.api_base,
+            username=args.username,
+            password=args.password
+        )
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
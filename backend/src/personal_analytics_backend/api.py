@@ -2,17 +2,34 @@ from fastapi import FastAPI, HTTPException, Request, status, Response, Depends,
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from fastapi.responses import JSONResponse
+from fastapi.encoders import jsonable_encoder
 from pydantic import ValidationError
 from fastapi.exceptions import RequestValidationError
 import logging
 import uuid
-from typing import List, Optional
-from datetime import datetime, timedelta
+from typing import List, Optional, Dict, Any, Tuple
+from datetime import datetime, timedelta, date, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import hashlib
+import base64
+import binascii
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import csv
-import json
 import io
+import calendar
+import orjson
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # Optional, only needed for /export/columnar?format=arrow
+    pyarrow = None
 from fastapi.responses import StreamingResponse
 from sqlmodel import Session, select
+from sqlalchemy import literal_column, cast, false, func, literal, null, text, true, tuple_, union_all, update, BigInteger, Date, Integer, SmallInteger
+from sqlalchemy.dialects.postgresql import BIT
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from urllib.parse import urlparse
 
 from .logging_config import setup_logging
@@ -20,8 +37,14 @@ setup_logging()
 logger = logging.getLogger(__name__)
 
 from . settings import settings
-from .models import HealthEntry, HealthEntryCreate, HealthEntryRead, HealthEntryUpdate
-from .database import get_session, create_db_and_tables
+from .models import HealthEntry, HealthEntryCreate, HealthEntryRead, HealthEntryUpdate, UserMetricStats, UserDataVersion, UserStreak, ActivityRegistry, ACTIVITY_BITS, METRIC_FIELDS, METRIC_COLUMNS
+from .database import get_session, engine, async_engine, async_if_enabled, streaming_body
+from .migrations import run_migrations
+from .cache import stats_cache
+from .invalidation import InvalidationListener
+from .metrics import MetricsMiddleware, render_metrics
+from .profiling import ProfiledRoute, ProfilingMiddleware
+from . import stats_engine
 
 
 
@@ -33,14 +56,23 @@ async def lifespan(app: FastAPI):
         print(f"Debug mode enabled.")
 
     logger.info("Running on_startup tasks...")
-    create_db_and_tables()
+    run_migrations(engine)
+
+    # Keep the stats cache of this worker in sync with writes handled by other workers
+    invalidation_listener = None
+    if settings.stats_cache_size > 0:
+        invalidation_listener = InvalidationListener(engine, stats_cache, url=settings.database_listen_url)
+        invalidation_listener.start()
 
     yield
     # Shutdown
     logger.info("Backend shutting down")
+    if invalidation_listener is not None:
+        invalidation_listener.stop()
 
 
 app = FastAPI(title="Personal Analytics API", version="0.1.0", lifespan=lifespan)
+app.router.route_class = ProfiledRoute  # Before any route is added
 
 app.add_middleware(
     CORSMiddleware,
@@ -48,8 +80,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["X-Operation"] # custom header to tell frontend on submit if the entry was created or updated.
+    expose_headers=["X-Operation", "X-Next-Cursor", "ETag", "Last-Modified", "Server-Timing"] # X-Operation: custom header to tell frontend on submit if the entry was created or updated.
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(ProfilingMiddleware)
 
 
 
@@ -169,80 +203,356 @@ async def validation_exception_handler(request: Request, exc: ValidationError):
     )
 
 
+# Limits for POST /entries/batch. Each chunk is written with a single multi-row statement.
+BATCH_MAX_ENTRIES = 5000
+BATCH_CHUNK_SIZE = 500
+
+# Columns that identify an entry and are never overwritten when an upsert hits an existing row.
+UPSERT_IMMUTABLE_FIELDS = {"id", "uid", "date"}
+
+# Add this to the RETURNING clause of an upsert: xmax is 0 only for freshly inserted rows.
+UPSERT_INSERTED_FLAG = literal_column("(xmax = 0)").label("inserted")
+
+
+def _normalize_entry_date(entry: HealthEntryCreate):
+    """
+    Rewrite entry.date as zero-padded YYYY-MM-DD and set entry.day_of_week (Monday=0, Sunday=6).
+    strptime() also accepts e.g. '2024-1-5', which would otherwise be stored as a separate day.
+    Raises ValueError if the date is not a YYYY-MM-DD date.
+    """
+    parsed = datetime.strptime(entry.date, "%Y-%m-%d").date()
+    entry.date = parsed.isoformat()
+    entry.day_of_week = parsed.weekday()
+
+
+def _upsert_update_fields(entry: HealthEntryCreate) -> frozenset:
+    """
+    The columns an upsert of this entry overwrites on conflict: only the fields the client
+    actually sent (never uid/date), plus the day_of_week derived from the date.
+    """
+    return frozenset((entry.model_fields_set - UPSERT_IMMUTABLE_FIELDS) | {"day_of_week"})
+
+
+def _entry_to_row(entry: HealthEntryCreate) -> Dict[str, Any]:
+    """Column values for inserting the entry, including defaults like id and timestamp."""
+    db_entry = HealthEntry(**entry.model_dump())
+    return {column.name: getattr(db_entry, column.name) for column in HealthEntry.__table__.columns}
+
+
+def _missing_required_fields(row: Dict[str, Any]) -> List[str]:
+    """
+    The NOT NULL columns without a value in row, e.g. energy when the client left it out.
+    Such a row cannot be inserted, only update the existing entry of its uid and date.
+    """
+    return [column.name for column in HealthEntry.__table__.columns if not column.nullable and row[column.name] is None]
+
+
+def _build_entry_update(row: Dict[str, Any], update_fields):
+    """
+    Build an UPDATE of the columns in update_fields of the existing entry with the row's uid and
+    date, for rows that cannot be inserted. Returns its columns, and a false UPSERT_INSERTED_FLAG.
+    """
+    table = HealthEntry.__table__
+    return update(table).where(table.c.uid == row["uid"], table.c.date == row["date"]).values(
+        {field: row[field] for field in update_fields}
+    ).returning(*table.columns, false().label("inserted"))
+
+
+def _build_entries_upsert(rows: List[Dict[str, Any]], update_fields):
+    """
+    Build an INSERT ... ON CONFLICT (uid, date) DO UPDATE statement for one or more rows.
+
+    On conflict, only the columns in update_fields are overwritten. The caller adds the RETURNING clause it needs, typically including UPSERT_INSERTED_FLAG.
+    """
+    stmt = pg_insert(HealthEntry.__table__).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=["uid", "date"],
+        set_={field: stmt.excluded[field] for field in update_fields},
+    )
+
+
 @app.post("/entries/", response_model=HealthEntryRead)
+@async_if_enabled
 def submit_entry(entry: HealthEntryCreate, session: Session = Depends(get_session)):
+    """
+    Create the entry for the user and date, or update it if it exists.
 
+    This is a single INSERT ... ON CONFLICT ... RETURNING statement, so concurrent duplicate
+    submits cannot race between a lookup and the write. An entry without some of the optional
+    metrics cannot be inserted, so it only updates the fields it sets in the existing entry.
+    """
     if not entry.uid:
         raise HTTPException(status_code=400, detail="User ID (uid) is required")
 
     # Use the date from the submitted entry, not today!
-    target_date = entry.date
+    try:
+        _normalize_entry_date(entry)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date, expected YYYY-MM-DD")
+
+    row = _entry_to_row(entry)
+    missing_fields = _missing_required_fields(row)
+    if missing_fields:
+        result = session.execute(_build_entry_update(row, _upsert_update_fields(entry))).one_or_none()
+        if result is None:
+            raise HTTPException(status_code=400, detail=f"Missing fields for a new entry: {', '.join(missing_fields)}")
+    else:
+        stmt = _build_entries_upsert([row], _upsert_update_fields(entry))
+        result = session.execute(stmt.returning(*HealthEntry.__table__.columns, UPSERT_INSERTED_FLAG)).one()
+    session.commit()
+    stats_cache.bump_version(entry.uid)
 
-    # Calculate day_of_week from the date (Monday=0, Sunday=6)
-    date_obj = datetime.strptime(target_date, "%Y-%m-%d").date()
-    computed_day_of_week = date_obj.weekday()  # Store in variable
-    entry.day_of_week = computed_day_of_week
+    row = dict(result._mapping)
+    inserted = row.pop("inserted")
+    db_entry = HealthEntry(**row)
 
-    existing_entry = session.exec(
-        select(HealthEntry).where(HealthEntry.date == target_date,
-               HealthEntry.uid == entry.uid)
-    ).first()
+    return Response(
+         content=db_entry.json(),
+         status_code=201 if inserted else 200,
+         headers={"X-Operation": "created" if inserted else "updated"}
+    )
 
-    if existing_entry:
-        # Update existing entry - EXCLUDE DATE from updates
-        update_data = entry.dict(exclude_unset=True, exclude={'date', 'uid'})
-        for field, value in update_data.items():
-            setattr(existing_entry, field, value)
 
-        existing_entry.day_of_week = computed_day_of_week
+@app.post("/entries/batch")
+@async_if_enabled
+def submit_entries_batch(entries: List[HealthEntryCreate], session: Session = Depends(get_session)):
+    """
+    Create or update many entries at once, e.g., when backfilling history.
 
-        session.add(existing_entry)
-        session.commit()
-        session.refresh(existing_entry)
+    All entries are validated before anything is written. They are then written in chunks,
+    with one multi-row upsert per chunk, inside a single transaction. The 'operation' reported
+    for each entry is the same information that POST /entries/ sends in the X-Operation header.
+    Entries without some of the optional metrics must update an existing entry, as in POST /entries/.
+    """
+    if not entries:
+        raise HTTPException(status_code=400, detail="No entries submitted")
+    if len(entries) > BATCH_MAX_ENTRIES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ENTRIES} entries per batch are allowed")
+
+    errors = []
+    seen_keys = {}
+    for index, entry in enumerate(entries):
+        if not entry.uid:
+            errors.append(f"Entry {index}: User ID (uid) is required")
+            continue
+        try:
+            _normalize_entry_date(entry)
+        except ValueError:
+            errors.append(f"Entry {index}: invalid date '{entry.date}', expected YYYY-MM-DD")
+            continue
+        # A single INSERT ... ON CONFLICT statement cannot touch the same row twice.
+        key = (entry.uid, entry.date)
+        if key in seen_keys:
+            errors.append(f"Entry {index}: duplicate of entry {seen_keys[key]} (same uid and date)")
+            continue
+        seen_keys[key] = index
+
+    if errors:
+        raise HTTPException(status_code=400, detail=errors)
+
+    results_by_key = {}
+    for chunk_start in range(0, len(entries), BATCH_CHUNK_SIZE):
+        chunk = entries[chunk_start:chunk_start + BATCH_CHUNK_SIZE]
+
+        # Rows in one statement share the set of columns to update, so group the chunk by
+        # the fields each entry actually set. Exports re-imported as a whole form a single group.
+        # Entries without some optional metrics can only update their existing entry, one by one.
+        groups = {}
+        for index, entry in enumerate(chunk, start=chunk_start):
+            row = _entry_to_row(entry)
+            missing_fields = _missing_required_fields(row)
+            if not missing_fields:
+                groups.setdefault(_upsert_update_fields(entry), []).append(row)
+                continue
+            result = session.execute(_build_entry_update(row, _upsert_update_fields(entry))).one_or_none()
+            if result is None:
+                errors.append(f"Entry {index}: missing fields for a new entry: {', '.join(missing_fields)}")
+            else:
+                results_by_key[(result.uid, result.date)] = result
+
+        table = HealthEntry.__table__
+        for update_fields, rows in groups.items():
+            stmt = _build_entries_upsert(rows, update_fields).returning(
+                table.c.id, table.c.uid, table.c.date, UPSERT_INSERTED_FLAG
+            )
+            for result in session.execute(stmt).all():
+                results_by_key[(result.uid, result.date)] = result
 
-        return Response(
-             content=existing_entry.json(),
-             status_code=200,
-             headers={"X-Operation": "updated"}
-        )
-    else:
-        # Create new entry
-        db_entry = HealthEntry.from_orm(entry)
-        session.add(db_entry)
-        session.commit()
-        session.refresh(db_entry)
-
-        return Response(
-             content=db_entry.json(),
-             status_code=201,
-             headers={"X-Operation": "created"}
-        )
+    if errors:
+        session.rollback()
+        raise HTTPException(status_code=400, detail=errors)
+    session.commit()
+    for uid in {entry.uid for entry in entries}:
+        stats_cache.bump_version(uid)
+
+    results = []
+    for index, entry in enumerate(entries):
+        result = results_by_key[(entry.uid, entry.date)]
+        results.append({
+            "index": index,
+            "id": result.id,
+            "uid": result.uid,
+            "date": result.date,
+            "operation": "created" if result.inserted else "updated",
+        })
+
+    created_count = sum(1 for result in results if result["operation"] == "created")
+    return {
+        "created": created_count,
+        "updated": len(results) - created_count,
+        "results": results,
+    }
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of an ETag against the value of an If-None-Match header"""
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque_tag for tag in if_none_match.split(","))
+
+
+def _not_modified_check(day_relative: bool = False):
+    """
+    Dependency for GET endpoints whose response only depends on the entries of the user in the
+    'uid' query parameter (and on the other query parameters). Sets a weak ETag and Last-Modified,
+    derived from the user's data version, which costs a primary key lookup. If the client already
+    has the current response, answers 304 right away, before the endpoint queries anything.
+
+    day_relative endpoints, like /entries/today, also change at midnight without any write.
+    """
+    def check(
+        request: Request,
+        response: Response,
+        uid: str = Query(..., description="User ID required"),
+        session: Session = Depends(get_session)
+    ):
+        stored = session.exec(
+            select(UserDataVersion.version, UserDataVersion.updated_at).where(UserDataVersion.uid == uid)
+        ).first()
+        version, last_modified = stored if stored else (0, None)
+
+        today = datetime.now().date() if day_relative else None
+        if today is not None:
+            midnight = datetime.combine(today, datetime.min.time()).astimezone()
+            last_modified = max(last_modified, midnight) if last_modified else midnight
+
+        etag_source = f"{request.url.path}|{uid}|{version}|{last_modified.isoformat() if last_modified else ''}|{today or ''}"
+        headers = {
+            "ETag": f'W/"{hashlib.sha1(etag_source.encode()).hexdigest()[:20]}"',
+            # Per-user data: browsers may store it, but must revalidate it
+            "Cache-Control": "private, no-cache",
+        }
+        if last_modified:
+            headers["Last-Modified"] = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
 
+        if_none_match = request.headers.get("if-none-match")
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_none_match is not None:
+            not_modified = _etag_matches(if_none_match, headers["ETag"])
+        elif if_modified_since is not None and last_modified:
+            try:
+                not_modified = last_modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                not_modified = False
+        else:
+            not_modified = False
 
-@app.get("/entries/", response_model=List[HealthEntryRead])
+        if not_modified:
+            raise HTTPException(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        response.headers.update(headers)
+
+    return async_if_enabled(check)
+
+
+def _encode_entries_cursor(entry_date: str, entry_id: str) -> str:
+    """Opaque cursor for the entries after (date, id), in the descending order of GET /entries/"""
+    return base64.urlsafe_b64encode(orjson.dumps([entry_date, entry_id])).decode().rstrip("=")
+
+
+def _decode_entries_cursor(cursor: str):
+    """(date, id) from a cursor of _encode_entries_cursor()"""
+    try:
+        entry_date, entry_id = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(entry_date, str) or not isinstance(entry_id, str):
+            raise ValueError("cursor must hold two strings")
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return entry_date, entry_id
+
+
+def _entry_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """The fields listed in a fields= parameter, None for all fields"""
+    if not fields:
+        return None
+    names = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    unknown = [name for name in names if name not in HealthEntryRead.model_fields]
+    if unknown or not names:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}. Valid fields: {', '.join(HealthEntryRead.model_fields)}")
+    return names
+
+
+@app.get("/entries/", response_model=List[HealthEntryRead], dependencies=[Depends(_not_modified_check())])
+@async_if_enabled
 def read_all_entries(
-    skip: int = 0,
-    limit: int = 100,
+    response: Response,
+    skip: int = Query(0, ge=0, description="Deprecated, use cursor. Number of entries to skip."),
+    limit: int = Query(100, ge=1, le=1000),
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor header of the previous page"),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return, e.g. date,mood,pain. Default: all"),
     uid: str = Query(..., description="User ID required"),
     session: Session = Depends(get_session)
 ):
-    """Get all health entries with optional filtering"""
+    """
+    Get the health entries of a user, newest first, with optional filtering.
 
-    query = select(HealthEntry).where(HealthEntry.uid == uid)  # Filter by UID
+    If there are more entries, the response has an X-Next-Cursor header. Pass its value as cursor
+    to get the next page. Unlike skip, a cursor takes the database straight to the next page,
+    however deep it is. With fields, only these fields are queried and returned.
+    """
+    if cursor and skip:
+        raise HTTPException(status_code=400, detail="Use either cursor or skip, not both")
+    field_names = _entry_fields(fields)
+
+    if field_names is None:
+        query = select(HealthEntry)
+    else:
+        # id and date are needed for the cursor
+        query = select(*(getattr(HealthEntry, name) for name in dict.fromkeys(field_names + ["date", "id"])))
+    query = query.where(HealthEntry.uid == uid)  # Filter by UID
 
     if start_date:
         query = query.where(HealthEntry.date >= start_date)
     if end_date:
         query = query.where(HealthEntry.date <= end_date)
+    if cursor:
+        after_date, after_id = _decode_entries_cursor(cursor)
+        # date <= after_date on its own lets the (uid, date) index start right at the page
+        query = query.where(
+            HealthEntry.date <= after_date,
+            tuple_(HealthEntry.date, HealthEntry.id) < tuple_(after_date, after_id)
+        )
 
-    query = query.order_by(HealthEntry.date.desc()).offset(skip).limit(limit)
+    # One more row than requested tells whether there is a next page
+    query = query.order_by(HealthEntry.date.desc(), HealthEntry.id.desc()).offset(skip).limit(limit + 1)
+    rows = session.exec(query).all()
 
-    entries = session.exec(query).all()
-    return entries
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = _encode_entries_cursor(rows[-1].date, rows[-1].id)
 
-@app.get("/entries/today", response_model=Optional[HealthEntryRead])
+    if field_names is None:
+        return rows
+    # Not validated against HealthEntryRead, which requires all fields
+    return JSONResponse(
+        content=jsonable_encoder([{name: row._mapping[name] for name in field_names} for row in rows]),
+        headers=dict(response.headers),
+    )
+
+@app.get("/entries/today", response_model=Optional[HealthEntryRead], dependencies=[Depends(_not_modified_check(day_relative=True))])
+@async_if_enabled
 def read_today_entry(uid: str = Query(..., description="User ID required"), session: Session = Depends(get_session)):
     """Get today's entry if it exists"""
     today = datetime.now().date().isoformat()
@@ -252,6 +562,7 @@ def read_today_entry(uid: str = Query(..., description="User ID required"), sess
     return entry
 
 @app.get("/entries/{entry_id}", response_model=HealthEntryRead)
+@async_if_enabled
 def read_entry(entry_id: str, session: Session = Depends(get_session)):
     """Get a specific entry by ID"""
     entry = session.exec(
@@ -262,14 +573,17 @@ def read_entry(entry_id: str, session: Session = Depends(get_session)):
     return entry
 
 @app.delete("/entries/{entry_id}")
+@async_if_enabled
 def delete_entry(entry_id: str, session: Session = Depends(get_session)):
     """Delete an entry"""
     entry = session.get(HealthEntry, entry_id)
     if not entry:
         raise HTTPException(status_code=404, detail="Entry not found")
 
+    uid = entry.uid
     session.delete(entry)
     session.commit()
+    stats_cache.bump_version(uid)
 
     return {"message": "Entry deleted successfully"}
 
@@ -277,364 +591,802 @@ def delete_entry(entry_id: str, session: Session = Depends(get_session)):
 def root():
     return {"message": "Personal Analytics API is running"}
 
+# How long /health/ready waits for the database before it reports the worker as not ready.
+READINESS_TIMEOUT_SECONDS = 2.0
+
+# A single thread runs the readiness queries, so a hanging database cannot tie up more than one.
+_readiness_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="readiness-check")
+
+
+def _pool_stats() -> Dict[str, Any]:
+    """State of the connection pool serving the requests, as far as the pool class reports it"""
+    pool = (async_engine.sync_engine if async_engine is not None else engine).pool
+    stats = {"class": type(pool).__name__}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, name, None)
+        if callable(method):
+            stats[name] = method()
+    return stats
+
+
+def _check_database(estimate_rows: bool) -> Dict[str, Any]:
+    """SELECT 1, and optionally the planner's estimate of the number of entries, without a scan"""
+    started = datetime.now()
+    with engine.connect() as connection:
+        connection.execute(text(f"SET LOCAL statement_timeout = {int(READINESS_TIMEOUT_SECONDS * 1000)}"))
+        connection.execute(text("SELECT 1"))
+        result = {"latency_ms": round((datetime.now() - started).total_seconds() * 1000, 2)}
+        if estimate_rows:
+            # -1 if the table was never vacuumed or analyzed
+            reltuples = connection.execute(
+                text("SELECT reltuples FROM pg_class WHERE oid = 'healthentry'::regclass")
+            ).scalar()
+            result["entries_estimate"] = int(reltuples) if reltuples is not None and reltuples >= 0 else None
+    return result
+
+
+def _readiness(estimate_rows: bool):
+    """(ready, details) for the readiness endpoints"""
+    future = _readiness_executor.submit(_check_database, estimate_rows)
+    try:
+        return True, {"database": future.result(timeout=READINESS_TIMEOUT_SECONDS), "pool": _pool_stats()}
+    except FutureTimeoutError:
+        error = f"No answer from the database within {READINESS_TIMEOUT_SECONDS} seconds"
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    logger.warning(f"Readiness check failed: {error}")
+    return False, {"error": error, "pool": _pool_stats()}
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics in text format, see metrics.py"""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/health/live")
+def liveness_check():
+    """Liveness probe: the worker is up and serving requests. Does not touch the database."""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+def readiness_check(estimate_rows: bool = Query(False, description="Include the estimated number of entries")):
+    """Readiness probe: the database answers in time. Answers 503 otherwise."""
+    ready, details = _readiness(estimate_rows)
+    if not ready:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"status": "unavailable", **details})
+    return {"status": "ready", **details}
+
+
 @app.get("/health")
-def health_check(session: Session = Depends(get_session)):
-    count = session.exec(select(HealthEntry)).all()
-    return {"status": "healthy", "entries_count": len(count)}
+def health_check():
+    """
+    Overall health, kept for existing monitoring. Like /health/ready, with the estimated number of
+    entries as entries_count. Prefer /health/live and /health/ready for load balancer probes.
+    """
+    ready, details = _readiness(estimate_rows=True)
+    if not ready:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"status": "unhealthy", **details})
+    return {
+        "status": "healthy",
+        "entries_count": details["database"]["entries_estimate"],
+        "stats_cache": stats_cache.info(),
+        **details
+    }
+
 
+# Metrics of /stats/metrics-over-time if the request names none
+DEFAULT_TIMELINE_METRICS = ["mood", "pain", "energy", "sleep_quality", "sexual_wellbeing"]
 
-@app.get("/stats/metrics-over-time")
+
+def _requested_metrics(metrics: Optional[List[str]], default: List[str]) -> List[str]:
+    """
+    The metric names of a query parameter that can be repeated and hold comma-separated names,
+    checked against the registry in models.METRIC_COLUMNS. default if there are none.
+    """
+    names = [name.strip() for value in metrics or [] for name in value.split(",") if name.strip()]
+    if not names:
+        return default
+    unknown = [name for name in names if name not in METRIC_COLUMNS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown metrics: {', '.join(unknown)}. Valid metrics: {', '.join(METRIC_COLUMNS)}")
+    return list(dict.fromkeys(names))
+
+
+@app.get("/stats/metrics-over-time", dependencies=[Depends(_not_modified_check(day_relative=True))])
+@async_if_enabled
+@stats_cache.cached
 def get_metrics_over_time(
     days: int = 30,  # Default to last 30 days
-    metrics: List[str] = None,  # Optional: specific metrics to return
+    metrics: Optional[List[str]] = Query(
+        None, description="Metrics to return, as repeated or comma-separated values. Default: mood, pain, energy, sleep_quality, sexual_wellbeing"
+    ),
+    bucket: str = Query("day", pattern="^(day|week|month)$", description="Aggregate the entries per day, week or month"),
+    max_points: Optional[int] = Query(None, ge=3, description="Downsample to at most this many points, keeping peaks and dips"),
     uid: str = Query(..., description="User ID required"),  # Add UID parameter
     session: Session = Depends(get_session)
 ):
-    """Get metrics data for visualization over time"""
+    """
+    Get metrics data for visualization over time, as one list of values per metric.
+
+    With bucket=week or month, each date is the first day of a week (Monday) or month, the metric
+    values are the averages over its entries, and 'min', 'max' and 'count' hold the minimum,
+    maximum and number of values per metric and bucket. Buckets without entries are left out.
+
+    With max_points, longer series are downsampled with largest-triangle-three-buckets: every
+    metric picks its share of max_points points, and the dates picked by any metric are returned.
+    """
+    metrics = _requested_metrics(metrics, DEFAULT_TIMELINE_METRICS)
 
     # Calculate date range
     end_date = datetime.now().date()
     start_date = end_date - timedelta(days=days)
-
-    # Query entries in date range
-    query = select(HealthEntry).where(
+    conditions = (
         HealthEntry.uid == uid,
         HealthEntry.date >= start_date.isoformat(),
         HealthEntry.date <= end_date.isoformat()
-    ).order_by(HealthEntry.date)
+    )
 
-    entries = session.exec(query).all()
+    if bucket == "day":
+        # Only the needed columns, as plain tuples, which the covering (uid, date) index can answer
+        query = select(HealthEntry.date, *(METRIC_COLUMNS[metric] for metric in metrics)).where(
+            *conditions
+        ).order_by(HealthEntry.date)
 
-    # Default metrics if none specified
-    if metrics is None:
-        metrics = ["mood", "pain", "energy", "sleep_quality", "sexual_wellbeing"]
+        rows = session.execute(query).all()
+        columns = list(zip(*rows)) if rows else [()] * (1 + len(metrics))
 
-    # Structure data for frontend
-    result = {
-        "dates": [],
-        "metrics": {metric: [] for metric in metrics}
-    }
+        result = {
+            "dates": list(columns[0]),
+            "metrics": {metric: list(values) for metric, values in zip(metrics, columns[1:])}
+        }
+    else:
+        result = _bucketed_metrics(session, bucket, metrics, conditions)
 
-    for entry in entries:
-        result["dates"].append(entry.date)
-        for metric in metrics:
-            value = getattr(entry, metric, None)
-            result["metrics"][metric].append(value)
+    if max_points is not None and len(result["dates"]) > max_points:
+        result = _downsampled_metrics(result, max_points)
+    return result
+
+
+# Aggregates per bucket of /stats/metrics-over-time, 'metrics' holds the averages
+BUCKET_AGGREGATES = {"metrics": func.avg, "min": func.min, "max": func.max, "count": func.count}
 
+
+def _bucketed_metrics(session: Session, bucket: str, metrics: List[str], conditions) -> Dict[str, Any]:
+    """Per week or month aggregates of the metrics over the entries matching conditions, computed in SQL"""
+    bucket_start = cast(func.date_trunc(bucket, cast(HealthEntry.date, Date)), Date).label("bucket_start")
+    query = select(
+        bucket_start,
+        *(aggregate(METRIC_COLUMNS[metric]) for aggregate in BUCKET_AGGREGATES.values() for metric in metrics)
+    ).where(*conditions).group_by(bucket_start).order_by(bucket_start)
+
+    rows = session.execute(query).all()
+    columns = list(zip(*rows)) if rows else [()] * (1 + len(BUCKET_AGGREGATES) * len(metrics))
+
+    result = {"dates": [bucket_date.isoformat() for bucket_date in columns[0]]}
+    for a, name in enumerate(BUCKET_AGGREGATES):
+        result[name] = {}
+        for m, metric in enumerate(metrics):
+            values = columns[1 + a * len(metrics) + m]
+            if name == "metrics":
+                values = [round(float(value), 2) if value is not None else None for value in values]
+            result[name][metric] = list(values)
     return result
 
+
+def _downsampled_metrics(result: Dict[str, Any], max_points: int) -> Dict[str, Any]:
+    """result of /stats/metrics-over-time with only the points that LTTB keeps, see get_metrics_over_time()"""
+    x = stats_engine.day_numbers(result["dates"])
+    # With more metrics than max_points, every metric still keeps one point
+    share = max(max_points // max(len(result["metrics"]), 1), 1)
+    kept = set()
+    for values in result["metrics"].values():
+        y = np.array([np.nan if value is None else value for value in values], dtype=float)
+        kept.update(stats_engine.lttb_indices(x, y, share).tolist())
+    kept = sorted(kept)
+
+    downsampled = {"dates": [result["dates"][i] for i in kept]}
+    for name, series in result.items():
+        if name != "dates":
+            downsampled[name] = {metric: [values[i] for i in kept] for metric, values in series.items()}
+    return downsampled
+
 from sqlalchemy import func, text
 from typing import List, Dict, Any
-import statistics
+
+# Day of week bucket in user_metric_stats that holds the stats over all days.
+ALL_DAYS = -1
+
+
+def _user_metric_stats(session: Session, uid: str, *conditions) -> Dict[tuple, UserMetricStats]:
+    """
+    The user's rows from user_metric_stats matching the conditions,
+    keyed by (day_of_week, metric_a, metric_b).
+    """
+    rows = session.exec(
+        select(UserMetricStats).where(UserMetricStats.uid == uid, *conditions)
+    ).all()
+    return {(row.day_of_week, row.metric_a, row.metric_b): row for row in rows}
+
+
+def _rounded_mean(stats: Dict[tuple, UserMetricStats], day_of_week: int, metric: str) -> float:
+    """Mean of a metric from user_metric_stats rows, rounded to 2 decimals. 0 if there are no values."""
+    row = stats.get((day_of_week, metric, metric))
+    return round(row.mean_a, 2) if row and row.n else 0.0
+
 
 @app.get("/stats/weekday-averages")
+@async_if_enabled
+@stats_cache.cached
 def get_weekday_averages(uid: str = Query(..., description="User ID required"), session: Session = Depends(get_session)):
-    """Get average metrics per weekday"""
-    result = session.exec(
-        select(
-            HealthEntry.day_of_week,
-            func.avg(HealthEntry.mood).label('avg_mood'),
-            func.avg(HealthEntry.pain).label('avg_pain'),
-            func.avg(HealthEntry.energy).label('avg_energy'),
-            func.avg(HealthEntry.sleep_quality).label('avg_sleep_quality'),
-            func.avg(HealthEntry.sexual_wellbeing).label('avg_sexual_wellbeing'),
-            func.count(HealthEntry.id).label('entry_count')
-        ).where(HealthEntry.uid == uid)
-        .group_by(HealthEntry.day_of_week)
-        .order_by(HealthEntry.day_of_week)
-    ).all()
+    """
+    Get average metrics per weekday.
+    Read from the precomputed user_metric_stats, so this does not depend on the number of entries.
+    """
+    stats = _user_metric_stats(
+        session, uid, UserMetricStats.day_of_week != ALL_DAYS, UserMetricStats.metric_a == UserMetricStats.metric_b
+    )
 
     # Convert to frontend-friendly format
     weekdays = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
 
     averages = []
-    for row in result:
+    for day_of_week, weekday in enumerate(weekdays):
+        count = stats.get((day_of_week, '*', '*'))
+        if not count or count.n <= 0:
+            continue
         averages.append({
-            'weekday': weekdays[row.day_of_week],
-            'day_of_week': row.day_of_week,
-            'avg_mood': round(float(row.avg_mood or 0), 2),
-            'avg_pain': round(float(row.avg_pain or 0), 2),
-            'avg_energy': round(float(row.avg_energy or 0), 2),
-            'avg_sleep_quality': round(float(row.avg_sleep_quality or 0), 2),
-            'avg_sexual_wellbeing': round(float(row.avg_sexual_wellbeing or 0), 2),
-            'entry_count': row.entry_count
+            'weekday': weekday,
+            'day_of_week': day_of_week,
+            'avg_mood': _rounded_mean(stats, day_of_week, 'mood'),
+            'avg_pain': _rounded_mean(stats, day_of_week, 'pain'),
+            'avg_energy': _rounded_mean(stats, day_of_week, 'energy'),
+            'avg_sleep_quality': _rounded_mean(stats, day_of_week, 'sleep_quality'),
+            'avg_sexual_wellbeing': _rounded_mean(stats, day_of_week, 'sexual_wellbeing'),
+            'entry_count': count.n
         })
 
     return averages
 
+# The metrics correlated with each other by /stats/correlations.
+CORRELATION_METRICS = ['mood', 'pain', 'energy', 'sleep_quality', 'sexual_wellbeing', 'stress_level_work', 'stress_level_home']
+
+
+def _pearson_correlations_from_stats(session: Session, uid: str):
+    """/stats/correlations with method=pearson, from the sums in user_metric_stats."""
+    metrics = ['*'] + CORRELATION_METRICS
+    stats = _user_metric_stats(
+        session, uid, UserMetricStats.day_of_week == ALL_DAYS,
+        UserMetricStats.metric_a.in_(metrics), UserMetricStats.metric_b.in_(metrics)
+    )
+    # Stats rows stay behind (with n = 0) when all entries of a user are deleted
+    count = stats.get((ALL_DAYS, '*', '*'))
+    if not count or count.n == 0:
+        return {"error": "Insufficient data for correlation analysis"}
+
+    n_metrics = len(CORRELATION_METRICS)
+    correlations = np.full((n_metrics, n_metrics), np.nan)
+    sample_sizes = np.zeros((n_metrics, n_metrics), dtype=int)
+    for i, metric1 in enumerate(CORRELATION_METRICS):
+        for j in range(i + 1, n_metrics):
+            # Pairs are stored once, with the metric names in code point order (COLLATE "C")
+            metric_a, metric_b = sorted((metric1, CORRELATION_METRICS[j]))
+            row = stats.get((ALL_DAYS, metric_a, metric_b))
+            if row is None:
+                continue
+            corr = stats_engine.pearson_from_sums(row.n, row.sum_a, row.sum_b, row.sum_aa, row.sum_bb, row.sum_ab)
+            correlations[i, j] = np.nan if corr is None else corr
+            sample_sizes[i, j] = row.n
+
+    # Sorted by absolute correlation strength
+    return stats_engine.correlation_pairs(CORRELATION_METRICS, correlations, sample_sizes)
+
+
 @app.get("/stats/correlations")
-def get_correlations(uid: str = Query(..., description="User ID required"), session: Session = Depends(get_session)):
-    """Calculate correlations between different metrics"""
-    # Get all entries with the metrics we want to correlate
-    entries = session.exec(
-        select(
-            HealthEntry.mood,
-            HealthEntry.pain,
-            HealthEntry.energy,
-            HealthEntry.sleep_quality,
-            HealthEntry.sexual_wellbeing,
-            HealthEntry.stress_level_work,
-            HealthEntry.stress_level_home
-        ).where(
-            HealthEntry.uid == uid,
-            HealthEntry.mood.isnot(None),
-            HealthEntry.pain.isnot(None)
-        )
-    ).all()
+@async_if_enabled
+@stats_cache.cached
+def get_correlations(
+    uid: str = Query(..., description="User ID required"),
+    method: str = Query("pearson", pattern="^(pearson|spearman)$", description="pearson or spearman"),
+    session: Session = Depends(get_session)
+):
+    """
+    Calculate correlations between different metrics.
+    Each pair uses all days on which both metrics were recorded.
+    Pearson correlations come from the precomputed user_metric_stats, Spearman needs the raw values.
+    """
+    if method == "pearson":
+        return _pearson_correlations_from_stats(session, uid)
 
-    if not entries:
+    # Get the metrics we want to correlate, one row per day
+    _, values = stats_engine.rows_to_matrix(
+        session.exec(stats_engine.metric_matrix_query(uid, CORRELATION_METRICS)).all(),
+        len(CORRELATION_METRICS)
+    )
+
+    if len(values) == 0:
         return {"error": "Insufficient data for correlation analysis"}
 
-    # Convert to lists for each metric
-    metrics_data = {}
-    metric_fields = ['mood', 'pain', 'energy', 'sleep_quality', 'sexual_wellbeing', 'stress_level_work', 'stress_level_home']
-
-    for field in metric_fields:
-        metrics_data[field] = [getattr(entry, field) for entry in entries if getattr(entry, field) is not None]
-
-    # Calculate correlations
-    correlations = []
-    for i, metric1 in enumerate(metric_fields):
-        for j, metric2 in enumerate(metric_fields):
-            if i < j:  # Avoid duplicates and self-correlation
-                data1 = metrics_data[metric1]
-                data2 = metrics_data[metric2]
-
-                # Ensure we have matching pairs (same length)
-                min_len = min(len(data1), len(data2))
-                if min_len > 1:
-                    corr = statistics.correlation(data1[:min_len], data2[:min_len])
-                    correlations.append({
-                        'metric1': metric1,
-                        'metric2': metric2,
-                        'correlation': round(corr, 3),
-                        'sample_size': min_len
-                    })
-
-    # Sort by absolute correlation strength
-    correlations.sort(key=lambda x: abs(x['correlation']), reverse=True)
-
-    return correlations
+    correlations, sample_sizes = stats_engine.correlation_matrix(values, method=method)
+
+    # Sorted by absolute correlation strength
+    return stats_engine.correlation_pairs(CORRELATION_METRICS, correlations, sample_sizes)
+
+# Metric pairs reported by /stats/lagged-correlations: (key, metric today, metric tomorrow)
+LAGGED_CORRELATION_PAIRS = [
+    ('pain_today_vs_mood_tomorrow', 'pain', 'mood'),
+    ('mood_today_vs_pain_tomorrow', 'mood', 'pain'),
+    ('sexual_wellbeing_today_vs_mood_tomorrow', 'sexual_wellbeing', 'mood'),
+    ('pain_today_vs_energy_tomorrow', 'pain', 'energy'),
+    ('sleep_quality_today_vs_mood_tomorrow', 'sleep_quality', 'mood'),
+    ('work_stress_today_vs_mood_tomorrow', 'stress_level_work', 'mood'),
+    ('home_stress_today_vs_mood_tomorrow', 'stress_level_home', 'mood'),
+]
+
+# Upper bound for the max_lag parameter of /stats/cross-correlation, in days.
+CROSS_CORRELATION_MAX_LAG = 90
+
+
+def _load_daily_metrics(session: Session, uid: str, metrics: List[str]) -> np.ndarray:
+    """The user's metrics on a gap-aware daily grid, see stats_engine.daily_series()."""
+    dates, values = stats_engine.rows_to_matrix(
+        session.exec(stats_engine.metric_matrix_query(uid, metrics)).all(), len(metrics)
+    )
+    return stats_engine.daily_series(dates, values)
+
 
 @app.get("/stats/lagged-correlations")
-def get_lagged_correlations(session: Session = Depends(get_session)):
-    """Check if pain today predicts mood tomorrow (and other lagged relationships)"""
+@async_if_enabled
+@stats_cache.cached
+def get_lagged_correlations(uid: str = Query(..., description="User ID required"), session: Session = Depends(get_session)):
+    """
+    Check if pain today predicts mood tomorrow (and other lagged relationships).
+    Only pairs of consecutive calendar days are used.
+    """
+    daily = _load_daily_metrics(session, uid, CORRELATION_METRICS)
+    correlations, sample_sizes = stats_engine.lagged_correlations(daily, max_lag=1)
+
+    index = {metric: i for i, metric in enumerate(CORRELATION_METRICS)}
+    pair_count = int(sample_sizes[0, index['pain'], index['mood']])
+    if pair_count < 5:  # Need minimum data points
+        return {"error": "Insufficient data for lagged correlation analysis"}
+
+    result = {'pair_count': pair_count}
+    for key, metric_today, metric_tomorrow in LAGGED_CORRELATION_PAIRS:
+        corr = correlations[0, index[metric_today], index[metric_tomorrow]]
+        result[key] = round(float(0 if np.isnan(corr) else corr), 3)
+    return result
+
+
+@app.get("/stats/cross-correlation")
+@async_if_enabled
+@stats_cache.cached
+def get_cross_correlation(
+    uid: str = Query(..., description="User ID required"),
+    max_lag: int = Query(7, ge=1, le=CROSS_CORRELATION_MAX_LAG, description="Largest lag in days"),
+    session: Session = Depends(get_session)
+):
+    """
+    Lagged correlations of every metric with every metric, for every lag from 1 to max_lag days.
+
+    'correlations' and 'sample_sizes' are indexed [lag - 1][i][j], for metric i on a day and
+    metric j lag days later, with metrics in the order given in 'metrics'. Missing days are
+    respected: only pairs of days exactly lag days apart are used. Correlations that are undefined
+    (too few pairs or no variance) are null. 'strongest' lists the strongest relationships.
+    """
+    daily = _load_daily_metrics(session, uid, CORRELATION_METRICS)
+    if len(daily) < 2:
+        return {"error": "Insufficient data for cross-correlation analysis"}
+
+    correlations, sample_sizes = stats_engine.lagged_correlations(daily, max_lag)
+    rounded = np.round(correlations, 3)
+
+    strongest = []
+    for lag_index, i, j in np.argwhere(~np.isnan(correlations)):
+        strongest.append({
+            'metric1': CORRELATION_METRICS[i],
+            'metric2': CORRELATION_METRICS[j],
+            'lag': int(lag_index) + 1,
+            'correlation': float(rounded[lag_index, i, j]),
+            'sample_size': int(sample_sizes[lag_index, i, j])
+        })
+    strongest.sort(key=lambda x: abs(x['correlation']), reverse=True)
+
+    return {
+        'metrics': CORRELATION_METRICS,
+        'lags': list(range(1, max_lag + 1)),
+        'days': len(daily),
+        'correlations': [
+            [[None if np.isnan(value) else float(value) for value in row] for row in matrix]
+            for matrix in rounded
+        ],
+        'sample_sizes': sample_sizes.tolist(),
+        'strongest': strongest[:20]
+    }
+
+# Limits of /stats/rolling
+ROLLING_MAX_WINDOW = 365
+ROLLING_DEFAULT_WINDOWS = [7, 30]
+
+
+def _rounded_series(values: np.ndarray) -> List[Optional[float]]:
+    """A float array as a JSON list, rounded to 3 decimals, with None for NaN"""
+    return [None if np.isnan(value) else round(float(value), 3) for value in values]
+
+
+@app.get("/stats/rolling")
+@async_if_enabled
+@stats_cache.cached
+def get_rolling_stats(
+    metrics: Optional[List[str]] = Query(None, description="Metrics, as repeated or comma-separated values. Default: as for metrics-over-time"),
+    window: Optional[List[str]] = Query(None, description=f"Window lengths in days, e.g. 7,30. Default: 7,30. At most {ROLLING_MAX_WINDOW}."),
+    ewma_alpha: Optional[float] = Query(None, gt=0, le=1, description="Also return the exponentially weighted moving average with this smoothing factor"),
+    days: Optional[int] = Query(None, ge=1, description="Only return the last days days. Default: all"),
+    uid: str = Query(..., description="User ID required"),
+    session: Session = Depends(get_session)
+):
+    """
+    Rolling mean and standard deviation of metrics over the last window days of every calendar
+    day, and optionally their EWMA. Days without an entry are included in the dates with None as
+    value, and do not count in the windows (see stats_engine.rolling_mean_std() and ewma()).
+    Values before the returned range are used for the first windows, so these are complete.
+    """
+    metrics = _requested_metrics(metrics, DEFAULT_TIMELINE_METRICS)
     try:
-        # Raw SQL for lagged analysis - updated to match your actual model fields
-        query = text("""
-            WITH daily_entries AS (
-                SELECT
-                    date,
-                    mood,
-                    pain,
-                    energy,
-                    sexual_wellbeing,
-                    sleep_quality,
-                    stress_level_work,
-                    stress_level_home,
-                    LAG(mood) OVER (ORDER BY date) as next_day_mood,
-                    LAG(pain) OVER (ORDER BY date) as next_day_pain,
-                    LAG(energy) OVER (ORDER BY date) as next_day_energy,
-                    LAG(sexual_wellbeing) OVER (ORDER BY date) as next_day_sexual_wellbeing,
-                    LAG(sleep_quality) OVER (ORDER BY date) as next_day_sleep_quality
-                FROM healthentry
-                WHERE mood IS NOT NULL AND pain IS NOT NULL
-                ORDER BY date
-            )
-            SELECT
-                COUNT(*) as pair_count,
-                CORR(pain, next_day_mood) as pain_vs_next_mood,
-                CORR(mood, next_day_pain) as mood_vs_next_pain,
-                CORR(sexual_wellbeing, next_day_mood) as sexual_wellbeing_vs_next_mood,
-                CORR(pain, next_day_energy) as pain_vs_next_energy,
-                CORR(sleep_quality, next_day_mood) as sleep_vs_next_mood,
-                CORR(stress_level_work, next_day_mood) as work_stress_vs_next_mood,
-                CORR(stress_level_home, next_day_mood) as home_stress_vs_next_mood
-            FROM daily_entries
-            WHERE next_day_mood IS NOT NULL
-        """)
-
-        result = session.exec(query).first()
-
-        if not result or result.pair_count < 5:  # Need minimum data points
-            return {"error": "Insufficient data for lagged correlation analysis"}
-
-        return {
-            'pair_count': result.pair_count,
-            'pain_today_vs_mood_tomorrow': round(float(result.pain_vs_next_mood or 0), 3),
-            'mood_today_vs_pain_tomorrow': round(float(result.mood_vs_next_pain or 0), 3),
-            'sexual_wellbeing_today_vs_mood_tomorrow': round(float(result.sexual_wellbeing_vs_next_mood or 0), 3),
-            'pain_today_vs_energy_tomorrow': round(float(result.pain_vs_next_energy or 0), 3),
-            'sleep_quality_today_vs_mood_tomorrow': round(float(result.sleep_vs_next_mood or 0), 3),
-            'work_stress_today_vs_mood_tomorrow': round(float(result.work_stress_vs_next_mood or 0), 3),
-            'home_stress_today_vs_mood_tomorrow': round(float(result.home_stress_vs_next_mood or 0), 3),
+        windows = sorted({int(value) for item in window or [] for value in item.split(",") if value.strip()}) or ROLLING_DEFAULT_WINDOWS
+    except ValueError:
+        raise HTTPException(status_code=400, detail="window must be comma-separated numbers of days")
+    if not all(1 <= length <= ROLLING_MAX_WINDOW for length in windows):
+        raise HTTPException(status_code=400, detail=f"Windows must be between 1 and {ROLLING_MAX_WINDOW} days")
+
+    first_day = None
+    start_date = None
+    if days is not None:
+        first_day = (datetime.now().date() - timedelta(days=days - 1)).isoformat()
+        # The days before the first returned day that its windows reach back to
+        start_date = (datetime.now().date() - timedelta(days=days - 1 + max(windows) - 1)).isoformat()
+        if ewma_alpha is not None:
+            start_date = None  # The EWMA depends on all earlier values
+
+    dates, values = stats_engine.rows_to_matrix(
+        session.exec(stats_engine.metric_matrix_query(uid, metrics, start_date=start_date)).all(), len(metrics)
+    )
+    daily = stats_engine.daily_series(dates, values)
+    grid_dates = stats_engine.daily_dates(dates)
+
+    rolling = {length: stats_engine.rolling_mean_std(daily, length) for length in windows}
+    smoothed = stats_engine.ewma(daily, ewma_alpha) if ewma_alpha is not None else None
+
+    # Cut off the days before the requested range, which were only loaded for the windows
+    offset = 0
+    if first_day is not None:
+        offset = next((i for i, day in enumerate(grid_dates) if day >= first_day), len(grid_dates))
+
+    result = {"dates": grid_dates[offset:], "windows": windows, "metrics": {}}
+    if ewma_alpha is not None:
+        result["ewma_alpha"] = ewma_alpha
+    for m, metric in enumerate(metrics):
+        series = {
+            "values": _rounded_series(daily[offset:, m]),
+            "rolling": {
+                str(length): {"mean": _rounded_series(mean[offset:, m]), "std": _rounded_series(std[offset:, m])}
+                for length, (mean, std) in rolling.items()
+            },
         }
+        if smoothed is not None:
+            series["ewma"] = _rounded_series(smoothed[offset:, m])
+        result["metrics"][metric] = series
+    return result
+
+
+def _metric_sums(metrics: List[str], prefix: str) -> list:
+    """Number of days and count and sum of every metric, labeled prefix + name, for an aggregate query"""
+    columns = [func.count().label(f"{prefix}days")]
+    for metric in metrics:
+        columns.append(func.count(METRIC_COLUMNS[metric]).label(f"{prefix}n_{metric}"))
+        columns.append(func.sum(METRIC_COLUMNS[metric]).label(f"{prefix}sum_{metric}"))
+    return columns
+
+
+def _activity_mask(bit):
+    """The mask of an activity bit in HealthEntry.activities_bits, as a BIGINT"""
+    return cast(literal(1), BigInteger).op("<<")(bit)
+
+
+def _activity_stats_query(uid: str, metrics: List[str], activity: Optional[str]):
+    """
+    One row per activity of the user with the count and sum of every metric over the days with
+    the activity, next to the same over all days of the user. One row with a NULL activity if the
+    user has no activities (or none at all).
+
+    The days' activities are read from the activities_bits mask, which is in the covering index,
+    so this is an index-only scan of the user's entries.
+    """
+    registry = ActivityRegistry.__table__
+    per_activity = select(registry.c.name.label("activity"), *_metric_sums(metrics, "")).select_from(
+        HealthEntry.__table__.join(registry, HealthEntry.activities_bits.op("&")(_activity_mask(registry.c.bit)) != 0)
+    ).where(HealthEntry.uid == uid)
+    if activity is not None:
+        per_activity = per_activity.where(registry.c.name == activity)
+    per_activity = per_activity.group_by(registry.c.name).subquery("per_activity")
+
+    activity_count = func.bit_count(cast(HealthEntry.activities_bits, BIT(64)))
+    totals = select(
+        *_metric_sums(metrics, "total_"), func.avg(activity_count).label("total_activities_per_day")
+    ).where(HealthEntry.uid == uid).subquery("totals")
+    return select(totals, per_activity).select_from(totals.outerjoin(per_activity, true()))
+
+
+@app.get("/stats/activities")
+@async_if_enabled
+@stats_cache.cached
+def get_activity_stats(
+    metrics: Optional[List[str]] = Query(None, description="Metrics, as repeated or comma-separated values. Default: as for correlations"),
+    activity: Optional[str] = Query(None, description="Only this activity"),
+    uid: str = Query(..., description="User ID required"),
+    session: Session = Depends(get_session)
+):
+    """
+    How often the user does each activity, and how each metric differs on days with the activity
+    from days without it. Aggregated in the database, in a single query over the entries.
+
+    activities_per_day is the mean number of activities done per day (null without entries).
+    For each activity (most frequent first): days (days with the activity), frequency (share of
+    all days), and per metric the mean on days with and without the activity and their difference.
+    Means are null if there are no such days.
+    """
+    metrics = _requested_metrics(metrics, CORRELATION_METRICS)
+    rows = session.execute(_activity_stats_query(uid, metrics, activity)).mappings().all()
+
+    total_days = rows[0]["total_days"] if rows else 0
+    activities_per_day = rows[0]["total_activities_per_day"] if rows else None
+    result = {
+        "total_days": total_days,
+        "activities_per_day": round(float(activities_per_day), 2) if activities_per_day is not None else None,
+        "activities": [],
+    }
+    for row in rows:
+        if row["activity"] is None:
+            continue
+        impact = {}
+        for metric in metrics:
+            n_with, sum_with = row[f"n_{metric}"], row[f"sum_{metric}"] or 0
+            n_without = row[f"total_n_{metric}"] - n_with
+            sum_without = (row[f"total_sum_{metric}"] or 0) - sum_with
+            mean_with = round(sum_with / n_with, 2) if n_with else None
+            mean_without = round(sum_without / n_without, 2) if n_without else None
+            impact[metric] = {
+                "mean_with": mean_with,
+                "mean_without": mean_without,
+                "difference": round(mean_with - mean_without, 2) if n_with and n_without else None,
+            }
+        result["activities"].append({
+            "activity": row["activity"],
+            "days": row["days"],
+            "frequency": round(row["days"] / total_days, 3),
+            "metrics": impact,
+        })
+    result["activities"].sort(key=lambda item: (-item["days"], item["activity"]))
+    return result
+
+
+def _streak_summary(streak: Optional[UserStreak]) -> Dict[str, Any]:
+    """Length and bounds of a streak, length 0 if there is none"""
+    return {
+        'length': streak.length if streak else 0,
+        'start_date': streak.start_date if streak else None,
+        'end_date': streak.end_date if streak else None
+    }
 
-    except SQLAlchemyError as e:
-        logger.error(f"Database error in lagged-correlations: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail="Database error occurred while calculating correlations"
-        )
-    except Exception as e:
-        logger.error(f"Unexpected error in lagged-correlations: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail="An unexpected error occurred"
-        )
 
 @app.get("/stats/summary")
+@async_if_enabled
+@stats_cache.cached
 def get_summary_stats(uid: str = Query(..., description="User ID required"), session: Session = Depends(get_session)):
-    """Get overall summary statistics"""
-    result = session.exec(
+    """
+    Get overall summary statistics.
+    Counts and averages are read from the precomputed user_metric_stats, streaks from user_streak.
+    current_streak ends today or yesterday (length 0 otherwise), longest_streak is the longest
+    run of consecutive days, the latest one on ties. Both are null if the user has no entries.
+    """
+    stats = _user_metric_stats(
+        session, uid, UserMetricStats.day_of_week == ALL_DAYS, UserMetricStats.metric_a == UserMetricStats.metric_b
+    )
+    count = stats.get((ALL_DAYS, '*', '*'))
+
+    # First and last date come straight from the (uid, date) index
+    date_range = session.exec(
         select(
-            func.count(HealthEntry.id).label('total_entries'),
             func.min(HealthEntry.date).label('first_entry'),
-            func.max(HealthEntry.date).label('last_entry'),
-            func.avg(HealthEntry.mood).label('avg_mood'),
-            func.avg(HealthEntry.pain).label('avg_pain'),
-            func.avg(HealthEntry.energy).label('avg_energy'),
-            func.avg(HealthEntry.sexual_wellbeing).label('avg_sexual_wellbeing'),
-            func.avg(HealthEntry.step_count).label('avg_step_count')
+            func.max(HealthEntry.date).label('last_entry')
         ).where(HealthEntry.uid == uid)
     ).first()
 
-    # Most recent streak of entries
-    streak_query = text("""
-        WITH dates AS (
-            SELECT date::date as entry_date,
-                   LAG(date::date) OVER (ORDER BY date) as prev_date
-            FROM healthentry
-            WHERE uid = :user_id
-            ORDER BY date
-        ),
-        gaps AS (
-            SELECT entry_date,
-                   CASE
-                       WHEN prev_date IS NULL THEN 1
-                       WHEN entry_date - prev_date = 1 THEN 0
-                       ELSE 1
-                   END as gap_flag
-            FROM dates
-        ),
-        groups AS (
-            SELECT entry_date,
-                   SUM(gap_flag) OVER (ORDER BY entry_date) as group_id
-            FROM gaps
-        )
-        SELECT group_id,
-               COUNT(*) as streak_length,
-               MIN(entry_date) as start_date,
-               MAX(entry_date) as end_date
-        FROM groups
-        GROUP BY group_id
-        ORDER BY streak_length DESC
-        LIMIT 1
-    """)
-
-    streak_result = session.execute(streak_query, {"user_id": uid}).first()
+    # The streaks are maintained by triggers, each is one lookup in an index of user_streak
+    current_streak = session.exec(
+        select(UserStreak).where(UserStreak.uid == uid).order_by(UserStreak.end_date.desc()).limit(1)
+    ).first()
+    longest_streak = session.exec(
+        select(UserStreak).where(UserStreak.uid == uid)
+        .order_by(UserStreak.length.desc(), UserStreak.end_date.desc()).limit(1)
+    ).first()
+    # A streak is current until a day without an entry has passed, so an entry can still be made today
+    if current_streak and current_streak.end_date < datetime.now().date() - timedelta(days=1):
+        current_streak = None
 
     return {
-        'total_entries': result.total_entries,
+        'total_entries': count.n if count else 0,
         'date_range': {
-            'first': result.first_entry,
-            'last': result.last_entry
+            'first': date_range.first_entry if date_range else None,
+            'last': date_range.last_entry if date_range else None
         },
         'averages': {
-            'mood': round(float(result.avg_mood or 0), 2),
-            'pain': round(float(result.avg_pain or 0), 2),
-            'energy': round(float(result.avg_energy or 0), 2),
-            'sexual_wellbeing': round(float(result.avg_sexual_wellbeing or 0), 2)
+            'mood': _rounded_mean(stats, ALL_DAYS, 'mood'),
+            'pain': _rounded_mean(stats, ALL_DAYS, 'pain'),
+            'energy': _rounded_mean(stats, ALL_DAYS, 'energy'),
+            'sexual_wellbeing': _rounded_mean(stats, ALL_DAYS, 'sexual_wellbeing')
         },
-        'current_streak': {
-            'length': streak_result.streak_length if streak_result else 0,
-            'start_date': streak_result.start_date if streak_result else None,
-            'end_date': streak_result.end_date if streak_result else None
-        } if streak_result else None
+        'current_streak': _streak_summary(current_streak) if longest_streak else None,
+        'longest_streak': _streak_summary(longest_streak) if longest_streak else None
     }
 
 
-@app.get("/export/csv")
-def export_all_data_csv(session: Session = Depends(get_session)):
+# Number of rows fetched per round trip from the server-side cursor of the streaming exports.
+EXPORT_CHUNK_SIZE = 1000
+
+# The HealthEntry columns exported by /export/csv, in order. day_name and is_weekend are computed.
+CSV_EXPORT_COLUMNS = [
+    'id', 'uid', 'date', 'timestamp', 'day_of_week', 'day_name', 'is_weekend',
+    'mood', 'pain', 'energy',
+    'allergy_state', 'allergy_medication',
+    'had_sex', 'sexual_wellbeing', 'sleep_quality',
+    'stress_level_work', 'stress_level_home',
+    'physical_activity', 'step_count', 'weather_enjoyment',
+    'daily_comments'
+]
+
+# The HealthEntry columns exported by /export/json and /export/ndjson. activities_bits is the
+# internal form of daily_activities, see models.py.
+JSON_EXPORT_COLUMNS = [column for column in HealthEntry.__table__.columns if column.name != 'activities_bits']
+
+
+def _export_filter(query, uid: Optional[str], start_date: Optional[str] = None, end_date: Optional[str] = None):
+    if uid:
+        query = query.where(HealthEntry.uid == uid)
+    if start_date:
+        query = query.where(HealthEntry.date >= start_date)
+    if end_date:
+        query = query.where(HealthEntry.date <= end_date)
+    return query
+
+
+def _export_rows_query(columns, uid: Optional[str], start_date: Optional[str], end_date: Optional[str]):
     """
-    Export all health data as CSV for analysis in pandas/excel.
-    Note that this export all data, not limited to a specific user.
+    Select the columns of the entries to export, to be read through a server-side cursor in chunks.
+    Ordering by (uid, date) follows the unique index, so no sort is needed before the first row arrives.
     """
+    return _export_filter(select(*columns), uid, start_date, end_date).order_by(
+        HealthEntry.uid, HealthEntry.date
+    ).execution_options(yield_per=EXPORT_CHUNK_SIZE)
 
-    # Get all entries ordered by date
-    entries = session.exec(
-        select(HealthEntry).order_by(HealthEntry.date)
-    ).all()
 
-    if not entries:
+def _ensure_export_not_empty(session: Session, uid: Optional[str], start_date: Optional[str], end_date: Optional[str]):
+    if session.execute(_export_filter(select(HealthEntry.id), uid, start_date, end_date).limit(1)).first() is None:
         raise HTTPException(status_code=404, detail="No data to export")
 
-    # Create CSV in memory
+
+def _export_activities(session: Session, uid: Optional[str], start_date: Optional[str], end_date: Optional[str]) -> List[Tuple[str, Optional[int]]]:
+    """
+    The activities done in the exported entries as (name, bit), by name. The names come from the
+    bits set in any of the entries, an aggregate over the covering index. Only if the activity
+    registry is full, the keys of daily_activities that have no bit are added, with bit None.
+    """
+    registry = ActivityRegistry.__table__
+    used_bits = _export_filter(
+        select(func.bit_or(HealthEntry.activities_bits)), uid, start_date, end_date
+    ).scalar_subquery()
+    registered = select(registry.c.name, registry.c.bit).where(
+        used_bits.op("&")(_activity_mask(registry.c.bit)) != 0
+    )
+
+    activity_keys = _export_filter(
+        select(func.jsonb_object_keys(HealthEntry.daily_activities).label("name"))
+        .where(func.jsonb_typeof(HealthEntry.daily_activities) == "object"),
+        uid, start_date, end_date
+    ).subquery("activity_keys")
+    # The database skips the scan of daily_activities while this is false
+    registry_full = select(func.count()).select_from(registry).scalar_subquery() >= ACTIVITY_BITS
+    unregistered = select(activity_keys.c.name, cast(null(), SmallInteger).label("bit")).where(
+        registry_full, activity_keys.c.name.not_in(select(registry.c.name))
+    ).distinct()
+
+    query = union_all(registered, unregistered).order_by("name")
+    return [(name, bit) for name, bit in session.execute(query).all()]
+
+
+def _stream_csv_export(session: Session, query, activities: List[Tuple[str, int]]):
+    """
+    Yield the CSV export chunk by chunk. The rows are read through a server-side cursor,
+    so memory use does not depend on the number of exported rows.
+    """
     output = io.StringIO()
     writer = csv.writer(output)
 
-    # Define CSV headers - include all fields from your model
-    headers = [
-        'id', 'uid', 'date', 'timestamp', 'day_of_week', 'day_name', 'is_weekend',
-        'mood', 'pain', 'energy',
-        'allergy_state', 'allergy_medication',
-        'had_sex', 'sexual_wellbeing', 'sleep_quality',
-        'stress_level_work', 'stress_level_home',
-        'physical_activity', 'step_count', 'weather_enjoyment',
-        'daily_comments'
-    ]
+    try:
+        writer.writerow(CSV_EXPORT_COLUMNS + [name for name, _ in activities])
+        yield output.getvalue()
+
+        for rows in session.execute(query).partitions():
+            output.seek(0)
+            output.truncate(0)
+            for entry in rows:
+                day_of_week = entry.day_of_week
+                row = [
+                    entry.id,
+                    entry.uid or 'default',
+                    entry.date,
+                    entry.timestamp.isoformat() if entry.timestamp else '',
+                    day_of_week,
+                    calendar.day_name[day_of_week] if day_of_week is not None else '',
+                    day_of_week >= 5 if day_of_week is not None else '',
+                    entry.mood,
+                    entry.pain,
+                    entry.energy,
+                    entry.allergy_state,
+                    entry.allergy_medication,
+                    entry.had_sex,
+                    entry.sexual_wellbeing,
+                    entry.sleep_quality,
+                    entry.stress_level_work,
+                    entry.stress_level_home,
+                    entry.physical_activity,
+                    entry.step_count,
+                    entry.weather_enjoyment,
+                    entry.daily_comments or ''  # Handle None values
+                ]
+
+                # Add activity columns (1 for present, 0 for absent)
+                activities_bits = entry.activities_bits
+                for activity, bit in activities:
+                    if bit is not None:
+                        row.append((activities_bits >> bit) & 1)
+                    else:
+                        row.append(1 if (entry.daily_activities or {}).get(activity) == 1 else 0)
+
+                writer.writerow(row)
+            yield output.getvalue()
+    finally:
+        # The response is streamed after the endpoint returned, so close the session here.
+        session.close()
+
 
-    # Add daily_activities columns (flatten the JSON)
-    # Get all possible activity keys from the first entry that has activities
-    activity_columns = set()
-    for entry in entries:
-        if entry.daily_activities:
-            activity_columns.update(entry.daily_activities.keys())
-
-    # Sort activity columns for consistent ordering
-    activity_columns = sorted(activity_columns)
-    headers.extend(activity_columns)
-
-    writer.writerow(headers)
-
-    # Write data rows
-    for entry in entries:
-        row = [
-            entry.id,
-            entry.uid or 'default',
-            entry.date,
-            entry.timestamp.isoformat() if entry.timestamp else '',
-            entry.day_of_week,
-            entry.day_name if hasattr(entry, 'day_name') else '',  # Use computed property
-            entry.is_weekend if hasattr(entry, 'is_weekend') else '',  # Use computed property
-            entry.mood,
-            entry.pain,
-            entry.energy,
-            entry.allergy_state,
-            entry.allergy_medication,
-            entry.had_sex,
-            entry.sexual_wellbeing,
-            entry.sleep_quality,
-            entry.stress_level_work,
-            entry.stress_level_home,
-            entry.physical_activity,
-            entry.weather_enjoyment,
-            entry.daily_comments or ''  # Handle None values
-        ]
-
-        # Add activity columns (1 for present, 0 for absent)
-        activities = entry.daily_activities or {}
-        for activity in activity_columns:
-            row.append(1 if activities.get(activity) == 1 else 0)
-
-        writer.writerow(row)
-
-    # Return as downloadable CSV file
-    output.seek(0)
+@app.get("/export/csv")
+@async_if_enabled
+def export_all_data_csv(
+    uid: Optional[str] = Query(None, description="Only export the entries of this user"),
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    session: Session = Depends(get_session)
+):
+    """
+    Export health data as CSV for analysis in pandas/excel.
+    Note that this exports the data of all users, unless a uid is given.
+    The CSV is streamed, ordered by user and date.
+    """
+    _ensure_export_not_empty(session, uid, start_date, end_date)
+
+    activities = _export_activities(session, uid, start_date, end_date)
+    columns = [getattr(HealthEntry, column) for column in CSV_EXPORT_COLUMNS if column not in ('day_name', 'is_weekend')]
+    columns.append(HealthEntry.activities_bits)
+    if any(bit is None for _, bit in activities):
+        columns.append(HealthEntry.daily_activities)
+    query = _export_rows_query(columns, uid, start_date, end_date)
     today = datetime.now().strftime("%Y-%m-%d")
 
     return StreamingResponse(
-        iter([output.getvalue()]),
+        streaming_body(session, _stream_csv_export(session, query, activities)),
         media_type="text/csv",
         headers={
             "Content-Disposition": f"attachment; filename=health_data_export_{today}.csv",
@@ -643,37 +1395,203 @@ def export_all_data_csv(session: Session = Depends(get_session)):
     )
 
 
+def _stream_json_export(session: Session, query, ndjson: bool):
+    """
+    Yield the JSON export chunk by chunk, as a JSON array or as NDJSON (one object per line).
+    The rows are read through a server-side cursor, so memory use does not depend on the number of exported rows.
+    """
+    try:
+        first = True
+        if not ndjson:
+            yield b"[\n"
+        for rows in session.execute(query).partitions():
+            chunk = []
+            for row in rows:
+                entry_dict = dict(row._mapping)
+                # Add computed properties
+                day_of_week = entry_dict['day_of_week']
+                entry_dict['day_name'] = calendar.day_name[day_of_week] if day_of_week is not None else None
+                entry_dict['is_weekend'] = day_of_week >= 5 if day_of_week is not None else None
+                if ndjson:
+                    chunk.append(orjson.dumps(entry_dict))
+                    chunk.append(b"\n")
+                else:
+                    if not first:
+                        chunk.append(b",\n")
+                    chunk.append(orjson.dumps(entry_dict, option=orjson.OPT_INDENT_2))
+                first = False
+            yield b"".join(chunk)
+        if not ndjson:
+            yield b"\n]\n"
+    finally:
+        # The response is streamed after the endpoint returned, so close the session here.
+        session.close()
+
+
 @app.get("/export/json")
-def export_all_data_json(session: Session = Depends(get_session)):
+@async_if_enabled
+def export_all_data_json(
+    uid: Optional[str] = Query(None, description="Only export the entries of this user"),
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    session: Session = Depends(get_session)
+):
     """
-    Export all health data as JSON.
-    Note that this export all data, not limited to a specific user.
+    Export health data as a JSON array.
+    Note that this exports the data of all users, unless a uid is given.
+    The array is streamed, ordered by user and date.
     """
+    _ensure_export_not_empty(session, uid, start_date, end_date)
 
-    entries = session.exec(
-        select(HealthEntry).order_by(HealthEntry.date)
-    ).all()
+    query = _export_rows_query(JSON_EXPORT_COLUMNS, uid, start_date, end_date)
+    today = datetime.now().strftime("%Y-%m-%d")
 
-    if not entries:
-        raise HTTPException(status_code=404, detail="No data to export")
+    return StreamingResponse(
+        streaming_body(session, _stream_json_export(session, query, ndjson=False)),
+        media_type="application/json",
+        headers={
+            "Content-Disposition": f"attachment; filename=health_data_export_{today}.json"
+        }
+    )
 
-    # Convert to list of dicts
-    data = []
-    for entry in entries:
-        entry_dict = entry.dict()
-        # Convert datetime to ISO string for JSON serialization
-        entry_dict['timestamp'] = entry.timestamp.isoformat() if entry.timestamp else None
-        # Add computed properties
-        entry_dict['day_name'] = entry.day_name
-        entry_dict['is_weekend'] = entry.is_weekend
-        data.append(entry_dict)
+
+@app.get("/export/ndjson")
+@async_if_enabled
+def export_all_data_ndjson(
+    uid: Optional[str] = Query(None, description="Only export the entries of this user"),
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    session: Session = Depends(get_session)
+):
+    """
+    Export health data as NDJSON, i.e., one JSON object per line.
+    Note that this exports the data of all users, unless a uid is given.
+    The lines are streamed, ordered by user and date.
+    """
+    _ensure_export_not_empty(session, uid, start_date, end_date)
+
+    query = _export_rows_query(JSON_EXPORT_COLUMNS, uid, start_date, end_date)
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    return StreamingResponse(
+        streaming_body(session, _stream_json_export(session, query, ndjson=True)),
+        media_type="application/x-ndjson",
+        headers={
+            "Content-Disposition": f"attachment; filename=health_data_export_{today}.ndjson"
+        }
+    )
+
+
+# Marks missing values in the integer arrays of the columnar export.
+COLUMNAR_MISSING = -1
+
+
+def _columnar_arrays(session: Session, query, activity_names: List[str]) -> Dict[str, np.ndarray]:
+    """
+    Read the rows of the columnar export query chunk by chunk into one typed array per column.
+    The query selects uid, then only integers, so each chunk converts to a 2-D array in one step.
+    """
+    uids = []
+    blocks = []
+    for rows in session.execute(query).partitions():
+        uids.extend(row[0] for row in rows)
+        blocks.append(np.array([row[1:] for row in rows], dtype=np.int32))
+
+    n_values = 2 + len(METRIC_FIELDS) + len(activity_names)
+    values = np.concatenate(blocks) if blocks else np.empty((0, n_values), dtype=np.int32)
+    uid_names, uid_index = np.unique(np.array(uids, dtype=str), return_inverse=True)
+
+    arrays = {
+        "uid": uid_names,
+        "uid_index": uid_index.astype(np.int32),
+        "date": values[:, 0],  # days since 1970-01-01
+        "day_of_week": values[:, 1].astype(np.int8),
+    }
+    for i, metric in enumerate(METRIC_FIELDS):
+        arrays[metric] = values[:, 2 + i].astype(np.int16)
+    arrays["activity_names"] = np.array(activity_names, dtype=str)
+    arrays["activities"] = values[:, 2 + len(METRIC_FIELDS):].astype(np.uint8)
+    return arrays
+
+
+def _columnar_to_arrow(arrays: Dict[str, np.ndarray]) -> bytes:
+    """Serialize the columnar arrays as an Arrow IPC stream, with proper nulls and types."""
+    columns = {
+        "uid": pyarrow.DictionaryArray.from_arrays(arrays["uid_index"], arrays["uid"]),
+        "date": pyarrow.array(arrays["date"], type=pyarrow.date32()),
+        "day_of_week": pyarrow.array(arrays["day_of_week"], mask=arrays["day_of_week"] == COLUMNAR_MISSING),
+    }
+    for metric in METRIC_FIELDS:
+        columns[metric] = pyarrow.array(arrays[metric], mask=arrays[metric] == COLUMNAR_MISSING)
+    for i, activity in enumerate(arrays["activity_names"]):
+        columns[f"activity_{activity}"] = pyarrow.array(arrays["activities"][:, i])
+    table = pyarrow.table(columns)
+
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+@app.get("/export/columnar")
+@async_if_enabled
+def export_columnar(
+    uid: Optional[str] = Query(None, description="Only export the entries of this user"),
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    format: str = Query("npz", pattern="^(npz|arrow)$", description="npz (NumPy) or arrow (Arrow IPC stream)"),
+    session: Session = Depends(get_session)
+):
+    """
+    Export the metrics as typed arrays, one per column, for fast loading in NumPy/pandas.
+
+    The npz bundle contains, one element per entry and ordered by user and date:
+    'date' (int32, days since 1970-01-01), 'day_of_week' (int8), one int16 array per metric,
+    'uid_index' (int32, index into 'uid', which lists the user IDs), and 'activities',
+    a uint8 matrix with one column per name in 'activity_names' (1 = activity done).
+    Missing values are -1. Load it with numpy.load(..., allow_pickle=False).
+    The arrow format contains the same data as a table, with nulls for missing values.
+    """
+    if format == "arrow" and pyarrow is None:
+        raise HTTPException(status_code=501, detail="Arrow export requires the pyarrow package on the server")
+
+    _ensure_export_not_empty(session, uid, start_date, end_date)
+
+    activities = _export_activities(session, uid, start_date, end_date)
+    activity_names = [name for name, _ in activities]
+
+    def int_or_missing(column):
+        return func.coalesce(column, COLUMNAR_MISSING)
+
+    columns = [
+        HealthEntry.uid,
+        (cast(HealthEntry.date, Date) - date(1970, 1, 1)).label("day_number"),
+        int_or_missing(HealthEntry.day_of_week),
+    ]
+    columns += [int_or_missing(getattr(HealthEntry, metric)) for metric in METRIC_FIELDS]
+    columns += [
+        HealthEntry.activities_bits.op(">>")(bit).op("&")(1) if bit is not None
+        else cast(func.coalesce(HealthEntry.daily_activities[activity].astext == "1", false()), Integer)
+        for activity, bit in activities
+    ]
+    arrays = _columnar_arrays(session, _export_rows_query(columns, uid, start_date, end_date), activity_names)
 
     today = datetime.now().strftime("%Y-%m-%d")
+    if format == "arrow":
+        content = _columnar_to_arrow(arrays)
+        media_type = "application/vnd.apache.arrow.stream"
+        filename = f"health_data_export_{today}.arrow"
+    else:
+        output = io.BytesIO()
+        np.savez(output, **arrays)
+        content = output.getvalue()
+        media_type = "application/octet-stream"
+        filename = f"health_data_export_{today}.npz"
 
     return Response(
-        content=json.dumps(data, indent=2, ensure_ascii=False),
-        media_type="application/json",
+        content=content,
+        media_type=media_type,
         headers={
-            "Content-Disposition": f"attachment; filename=health_data_export_{today}.json"
+            "Content-Disposition": f"attachment; filename={filename}"
         }
-    )
\ No newline at end of file
+    )
@@ -0,0 +1,147 @@
+"""
+In-process cache for the responses of the /stats/* endpoints.
+
+The stats page loads several stats endpoints on every view, and their results only change when
+the user's entries change. Responses are cached per worker, keyed by the user, the endpoint, its
+query parameters and the user's data version. Every write to a user's entries bumps that version,
+so cached responses of the user are never served after a change.
+
+Writes handled by other workers or hosts reach this worker's cache through the invalidation
+listener (see invalidation.py). While it is not listening, the user's data version is read from
+the database for every lookup instead.
+"""
+
+import functools
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Tuple
+
+from sqlmodel import Session, select
+
+from .metrics import STATS_CACHE_LOOKUPS
+from .models import UserDataVersion
+from .settings import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class StatsCache:
+    """
+    Size-bounded LRU cache with per-user data versions. Thread-safe, as FastAPI runs sync endpoints
+    in a thread pool. A max_entries of 0 disables caching.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[tuple, Any]" = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        # Whether lookups must check the version in the database, see set_listening()
+        self.verify_versions = False
+
+    def version(self, uid: str) -> int:
+        """The current data version of the user"""
+        with self._lock:
+            return self._versions.get(uid, 0)
+
+    def bump_version(self, uid: str):
+        """
+        Mark the user's data as changed: drop their cached responses, and make sure responses
+        computed from the old data while this happens are never hit.
+        """
+        with self._lock:
+            self._versions[uid] = self._versions.get(uid, 0) + 1
+            for key in [key for key in self._entries if key[0] == uid]:
+                del self._entries[key]
+
+    def set_listening(self, listening: bool):
+        """
+        Called by the invalidation listener when it starts or stops listening. Notifications may
+        have been missed in between, so the cached responses are dropped either way.
+        """
+        with self._lock:
+            self.verify_versions = not listening
+            self._entries.clear()
+
+    def get(self, key: tuple) -> Tuple[bool, Any]:
+        """(True, value) if key is cached, (False, None) otherwise. Counts hits and misses."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                STATS_CACHE_LOOKUPS.labels("hit").inc()
+                return True, self._entries[key]
+            self.misses += 1
+            STATS_CACHE_LOOKUPS.labels("miss").inc()
+            return False, None
+
+    def put(self, key: tuple, value: Any, version: int):
+        """
+        Cache value under key, whose first item is the uid, evicting the least recently used
+        entries beyond max_entries. version is the user's data version from before value was
+        computed: if it changed since, value may be stale and is not stored.
+        """
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if self._versions.get(key[0], 0) != version:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all cached responses, e.g. in tests. Counters and versions are kept."""
+        with self._lock:
+            self._entries.clear()
+
+    def info(self) -> Dict[str, int]:
+        """Hit and miss counters and the current size"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "max_size": self.max_entries,
+            }
+
+    def cached(self, endpoint):
+        """
+        Decorator for a stats endpoint that takes the user as 'uid' and a database 'session'.
+        Put it below @app.get(). FastAPI passes all parameters as keyword arguments, and
+        functools.wraps keeps the signature FastAPI reads the parameters from.
+        """
+        @functools.wraps(endpoint)
+        def wrapper(**kwargs):
+            uid = kwargs["uid"]
+            params = tuple(sorted(
+                (name, tuple(value) if isinstance(value, list) else value)
+                for name, value in kwargs.items() if name != "session"
+            ))
+            # Some stats are relative to today, e.g. the last 30 days
+            today = datetime.now().date().isoformat()
+            version = self.version(uid)
+            stored_version = _stored_version(kwargs["session"], uid) if self.verify_versions else None
+            key = (uid, endpoint.__name__, params, today, version, stored_version)
+
+            found, value = self.get(key)
+            if found:
+                return value
+            value = endpoint(**kwargs)
+            self.put(key, value, version)
+            return value
+
+        return wrapper
+
+
+def _stored_version(session: Session, uid: str) -> int:
+    """The user's data version in the database, 0 if the user has never written an entry"""
+    return session.exec(select(UserDataVersion.version).where(UserDataVersion.uid == uid)).first() or 0
+
+
+stats_cache = StatsCache(settings.stats_cache_size)
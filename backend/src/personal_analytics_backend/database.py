@@ -1,19 +1,112 @@
-
-from sqlmodel import SQLModel, create_engine, Session
+from fastapi import Depends
+from sqlmodel import create_engine, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_session, create_async_engine
+from sqlalchemy.pool import NullPool
+import functools
+import inspect
 import os
 
 import logging
 logger = logging.getLogger(__name__)
 
 from .settings import settings
+from .metrics import InstrumentedAsyncAdaptedQueuePool, InstrumentedQueuePool, instrument_engine
+from .profiling import profile_engine
+
 
+def _pool_options(pool_class) -> dict:
+    """Keyword arguments for create_engine() that set up the connection pool from the settings"""
+    if settings.db_pgbouncer:
+        # PgBouncer pools the connections. Holding on to them here would only tie up PgBouncer's.
+        return {"poolclass": NullPool}
+    return {
+        "poolclass": pool_class,
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+    }
 
-engine = create_engine(settings.database_url)
 
-def create_db_and_tables():
-    logger.info("Creating database and tables...")
-    SQLModel.metadata.create_all(engine)
+# psycopg2 never uses prepared statements, so it works with PgBouncer as it is
+engine = create_engine(settings.database_url, **_pool_options(InstrumentedQueuePool))
+instrument_engine(engine)
+profile_engine(engine)
 
 def get_session():
     with Session(engine) as session:
-        yield session
\ No newline at end of file
+        yield session
+
+
+# Async mode (PA_ASYNC_DATABASE=true): the endpoints decorated with async_if_enabled run on the
+# event loop with an AsyncSession, using the async driver of psycopg 3. A request waiting for the
+# database then does not hold one of the threads of the thread pool, which limits the number of
+# requests a worker can have in flight in the default mode. Migrations, health checks and the
+# invalidation listener keep using the sync engine above.
+async_engine = None
+if settings.async_database:
+    async_engine = create_async_engine(
+        make_url(settings.database_url).set(drivername="postgresql+psycopg"),
+        # psycopg 3 prepares statements that run often, which PgBouncer's transaction mode breaks
+        connect_args={"prepare_threshold": None} if settings.db_pgbouncer else {},
+        **_pool_options(InstrumentedAsyncAdaptedQueuePool),
+    )
+    instrument_engine(async_engine.sync_engine)
+    profile_engine(async_engine.sync_engine)
+
+async def get_async_session():
+    async with AsyncSession(async_engine) as session:
+        yield session
+
+
+def async_if_enabled(endpoint):
+    """
+    Decorator for an endpoint, or a dependency, that takes a database 'session'. Put it below
+    @app.get() and friends. In the default mode, it returns the endpoint unchanged.
+
+    In async mode, it returns an async endpoint that gets an AsyncSession and runs the sync
+    endpoint through AsyncSession.run_sync(). Its queries then wait for the database without
+    blocking the event loop or a thread, while the code of the endpoint stays the same. Note that
+    computations in the endpoint do run on the event loop, so they should be quick (or cached).
+    Streamed responses need streaming_body() to read from the session.
+    """
+    if not settings.async_database:
+        return endpoint
+
+    @functools.wraps(endpoint)
+    async def run_on_async_session(**kwargs):
+        session = kwargs.pop("session")
+        return await session.run_sync(lambda sync_session: endpoint(session=sync_session, **kwargs))
+
+    # FastAPI reads the parameters from the signature, where the session dependency changes
+    signature = inspect.signature(endpoint)
+    run_on_async_session.__signature__ = signature.replace(parameters=[
+        parameter.replace(annotation=AsyncSession, default=Depends(get_async_session)) if name == "session" else parameter
+        for name, parameter in signature.parameters.items()
+    ])
+    return run_on_async_session
+
+
+def streaming_body(session: Session, chunks):
+    """
+    Body for a StreamingResponse whose chunks are generated from session after the endpoint
+    returned. In async mode, session is the sync session of an AsyncSession, which can only do
+    I/O inside AsyncSession.run_sync(), so every chunk is generated in there, on the event loop.
+    """
+    proxy = async_session(session)
+    if proxy is None:
+        return chunks
+
+    async def chunks_from_async_session():
+        done = object()
+        try:
+            while (chunk := await proxy.run_sync(lambda _: next(chunks, done))) is not done:
+                yield chunk
+        finally:
+            # Runs the generator's cleanup if the client went away
+            await proxy.run_sync(lambda _: chunks.close())
+
+    return chunks_from_async_session()
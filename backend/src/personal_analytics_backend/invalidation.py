@@ -0,0 +1,104 @@
+"""
+Invalidation of the stats cache across worker processes and hosts.
+
+Every statement that writes entries sends the affected uids with NOTIFY (see migration 4 in
+migrations.py). Each worker process runs an InvalidationListener: a thread with its own database
+connection that LISTENs for these notifications and bumps the users' versions in the worker's
+stats cache. While that connection is down, the cache reads the users' data versions from the
+database on every lookup instead (see StatsCache.set_listening()), until the listener reconnects.
+"""
+
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from typing import Optional
+
+from sqlalchemy.engine import Engine, make_url
+
+from .cache import StatsCache
+from .migrations import DATA_CHANGED_CHANNEL
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class InvalidationListener:
+    """
+    Background thread that evicts cached data of users whose entries were changed by any worker.
+    The connection is checked with a query after heartbeat_interval seconds without traffic, so
+    silently dropped connections are noticed too. The connection goes to url if given, e.g. to
+    bypass PgBouncer, and otherwise to the database of engine.
+    """
+
+    def __init__(self, engine: Engine, cache: StatsCache, heartbeat_interval: float = 30.0, reconnect_delay: float = 5.0,
+                 url: Optional[str] = None):
+        self.engine = engine
+        self.url = make_url(url) if url else engine.url
+        self.cache = cache
+        self.heartbeat_interval = heartbeat_interval
+        self.reconnect_delay = reconnect_delay
+        self.backend_pid = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # Until the first LISTEN succeeded, notifications can be missed
+        self.cache.set_listening(False)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="cache-invalidation-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _connect(self):
+        """A new autocommit connection to url, listening on the channel"""
+        args, kwargs = self.engine.dialect.create_connect_args(self.url)
+        connection = psycopg2.connect(*args, **kwargs)
+        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {DATA_CHANGED_CHANNEL}")
+        return connection
+
+    def _run(self):
+        while not self._stop.is_set():
+            connection = None
+            try:
+                connection = self._connect()
+                self.backend_pid = connection.get_backend_pid()
+                self.cache.set_listening(True)
+                logger.info(f"Listening for data changes on channel '{DATA_CHANGED_CHANNEL}'")
+                self._listen(connection)
+            except (psycopg2.Error, OSError) as e:
+                logger.warning(
+                    f"Cache invalidation listener is not connected, checking data versions in the database instead: {e}"
+                )
+            finally:
+                self.cache.set_listening(False)
+                self.backend_pid = None
+                if connection is not None:
+                    connection.close()
+            self._stop.wait(self.reconnect_delay)
+
+    def _listen(self, connection):
+        last_traffic = time.monotonic()
+        while not self._stop.is_set():
+            # Short timeout, so that stop() does not have to wait for long
+            readable, _, _ = select.select([connection], [], [], 1.0)
+            if readable:
+                connection.poll()
+                last_traffic = time.monotonic()
+            elif time.monotonic() - last_traffic > self.heartbeat_interval:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                last_traffic = time.monotonic()
+
+            while connection.notifies:
+                notification = connection.notifies.pop(0)
+                self.cache.bump_version(notification.payload)
@@ -0,0 +1,172 @@
+"""
+Prometheus metrics, served in text format by /metrics.
+
+Under gunicorn, every worker process counts for itself. To aggregate over all workers, set
+PROMETHEUS_MULTIPROC_DIR to an empty directory before the app is imported (deployment/
+gunicorn_conf.py does this). The workers then write their values to files in there, and /metrics
+combines the files of all workers, whichever worker answers the scrape. Without the variable,
+/metrics reports the numbers of the answering process only, which is fine for a single uvicorn.
+"""
+
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Buckets for database round trips, which are mostly well below the default buckets
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HTTP_REQUESTS = Counter(
+    "pa_http_requests", "HTTP requests handled", ["method", "route", "status"]
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "pa_http_request_duration_seconds", "Time until the response was sent completely", ["method", "route", "status"]
+)
+DB_QUERIES = Counter(
+    "pa_db_queries", "SQL statements executed", ["operation"]
+)
+DB_QUERY_DURATION = Histogram(
+    "pa_db_query_duration_seconds", "Execution time of SQL statements", ["operation"], buckets=DB_BUCKETS
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "pa_db_pool_checkout_wait_seconds", "Time spent waiting for a connection from the pool", buckets=DB_BUCKETS
+)
+DB_POOL_IN_USE = Gauge(
+    "pa_db_pool_connections_in_use", "Connections checked out from the pool", multiprocess_mode="livesum"
+)
+DB_POOL_OPEN = Gauge(
+    "pa_db_pool_connections_open", "Database connections opened by the pool and not closed yet", multiprocess_mode="livesum"
+)
+DB_POOL_EVENTS = Counter(
+    "pa_db_pool_events", "Connection pool events: connect, close, invalidate, checkout_timeout", ["event"]
+)
+STATS_CACHE_LOOKUPS = Counter(
+    "pa_stats_cache_lookups", "Lookups in the /stats/* response cache", ["result"]
+)
+
+# Route label for requests that did not match any route, to keep the number of series bounded
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            DB_POOL_EVENTS.labels("checkout_timeout").inc()
+            logger.warning(f"No free database connection within the pool timeout: {self.status()}")
+            raise
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    """InstrumentedQueuePool for the async engine"""
+
+
+def instrument_engine(engine: Engine):
+    """
+    Count and time the statements of engine, and track the connections of its pool. Connections
+    opened, closed and invalidated (e.g. found broken by the pre-ping after a database restart)
+    are counted and logged.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["metrics_query_start"].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        DB_QUERIES.labels(operation).inc()
+        DB_QUERY_DURATION.labels(operation).observe(elapsed)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get("metrics_query_start"):
+            context.connection.info["metrics_query_start"].pop()
+
+    @event.listens_for(engine.pool, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_IN_USE.inc()
+
+    @event.listens_for(engine.pool, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        DB_POOL_IN_USE.dec()
+
+    @event.listens_for(engine.pool, "connect")
+    def connect(dbapi_connection, connection_record):
+        DB_POOL_OPEN.inc()
+        DB_POOL_EVENTS.labels("connect").inc()
+        logger.debug(f"Opened database connection, pool: {engine.pool.status()}")
+
+    @event.listens_for(engine.pool, "close")
+    def close(dbapi_connection, connection_record):
+        DB_POOL_OPEN.dec()
+        DB_POOL_EVENTS.labels("close").inc()
+        logger.debug(f"Closed database connection, pool: {engine.pool.status()}")
+
+    @event.listens_for(engine.pool, "close_detached")
+    def close_detached(dbapi_connection):
+        DB_POOL_OPEN.dec()
+        DB_POOL_EVENTS.labels("close").inc()
+
+    @event.listens_for(engine.pool, "invalidate")
+    def invalidate(dbapi_connection, connection_record, exception):
+        DB_POOL_EVENTS.labels("invalidate").inc()
+        logger.warning(f"Invalidated database connection: {exception}")
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that counts and times requests by route template, e.g. /entries/{entry_id},
+    rather than by path. Times until the last byte was sent, so streamed exports count in full.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500  # If the app raises before it starts a response
+
+        async def send_and_record_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            route = getattr(scope.get("route"), "path", UNMATCHED_ROUTE)
+            labels = (scope["method"], route, str(status_code))
+            HTTP_REQUESTS.labels(*labels).inc()
+            HTTP_REQUEST_DURATION.labels(*labels).observe(time.perf_counter() - started)
+
+
+def render_metrics():
+    """(body, content type) of the metrics of this process, or of all workers in multiprocess mode"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
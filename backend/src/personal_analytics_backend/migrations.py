@@ -0,0 +1,513 @@
+"""
+Versioned database schema migrations.
+
+Each migration has a version number, a description and the SQL to apply. Applied versions are
+recorded in the schema_migrations table, and pending ones are applied in order at startup.
+All pending migrations run in one transaction, guarded by an advisory lock, so that several
+gunicorn workers starting at the same time do not race each other.
+
+To change the schema, append a new migration to MIGRATIONS. Never edit one that was released,
+and keep the table definitions in models.py in sync with the result.
+
+You can also apply migrations and list their state from the command line:
+
+    python -m personal_analytics_backend.migrations
+"""
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Arbitrary application-wide key for pg_advisory_xact_lock().
+MIGRATIONS_LOCK_KEY = 727470001
+
+# The metric columns read by the /stats/* endpoints. They are included in the (uid, date) index
+# so these queries can be answered from the index alone. This describes the index as the latest
+# migration leaves it, for models.py. Migrations spell out their columns themselves, so changing
+# this list needs a new migration that rebuilds the index.
+STATS_INDEX_INCLUDE_COLUMNS = (
+    "day_of_week", "mood", "pain", "energy", "sleep_quality", "sexual_wellbeing",
+    "stress_level_work", "stress_level_home", "step_count", "activities_bits",
+)
+
+# Channel on which migration 4's trigger announces the uids whose entries changed. Frozen.
+DATA_CHANGED_CHANNEL = "healthentry_changed"
+
+# The metrics tracked in user_metric_stats by migration 3. Frozen: a later change of the tracked
+# metrics needs a new migration that replaces healthentry_stats_trigger() and rebuilds the table.
+_USER_METRIC_STATS_METRICS = (
+    "mood", "pain", "energy", "sleep_quality", "sexual_wellbeing",
+    "stress_level_work", "stress_level_home", "step_count",
+)
+_USER_METRIC_STATS_VALUES = ", ".join(
+    ["('*', 1::bigint)"] + [f"('{metric}', r.{metric}::bigint)" for metric in _USER_METRIC_STATS_METRICS]
+)
+
+
+def _user_metric_stats_upsert(changed_rows: str) -> str:
+    """
+    SQL that adds the rows of changed_rows, a subquery of healthentry rows plus a sign column
+    (1 to add a row, -1 to remove it), to user_metric_stats. The rows are aggregated first, so each
+    stats row is written once per statement, however many entries it covers. Metric names are
+    compared with COLLATE "C" so the order of a pair does not depend on the database locale.
+    """
+    return f"""
+        INSERT INTO user_metric_stats AS s (uid, day_of_week, metric_a, metric_b, n, sum_a, sum_b, sum_aa, sum_bb, sum_ab)
+        SELECT r.uid, buckets.day_of_week, a.metric, b.metric, sum(r.sign),
+               sum(r.sign * a.value), sum(r.sign * b.value),
+               sum(r.sign * a.value * a.value), sum(r.sign * b.value * b.value), sum(r.sign * a.value * b.value)
+        FROM ({changed_rows}) AS r
+        CROSS JOIN LATERAL (VALUES (-1), (r.day_of_week)) AS buckets(day_of_week)
+        CROSS JOIN LATERAL (VALUES {_USER_METRIC_STATS_VALUES}) AS a(metric, value)
+        CROSS JOIN LATERAL (VALUES {_USER_METRIC_STATS_VALUES}) AS b(metric, value)
+        WHERE buckets.day_of_week IS NOT NULL
+          AND a.value IS NOT NULL AND b.value IS NOT NULL
+          AND (a.metric = b.metric OR (
+              buckets.day_of_week = -1 AND a.metric <> '*' AND b.metric <> '*'
+              AND a.metric COLLATE "C" < b.metric COLLATE "C"
+          ))
+        GROUP BY r.uid, buckets.day_of_week, a.metric, b.metric
+        ORDER BY r.uid, buckets.day_of_week, a.metric, b.metric
+        ON CONFLICT (uid, day_of_week, metric_a, metric_b) DO UPDATE SET
+            n = s.n + EXCLUDED.n,
+            sum_a = s.sum_a + EXCLUDED.sum_a,
+            sum_b = s.sum_b + EXCLUDED.sum_b,
+            sum_aa = s.sum_aa + EXCLUDED.sum_aa,
+            sum_bb = s.sum_bb + EXCLUDED.sum_bb,
+            sum_ab = s.sum_ab + EXCLUDED.sum_ab
+    """
+
+
+# List of (version, description, sql). Statements within sql are separated by semicolons.
+MIGRATIONS = [
+    (
+        1,
+        "Create healthentry table",
+        # Matches what SQLModel's create_all() created before migrations existed, so that
+        # existing databases are picked up as they are.
+        """
+        CREATE TABLE IF NOT EXISTS healthentry (
+            uid VARCHAR NOT NULL,
+            date VARCHAR NOT NULL,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            day_of_week INTEGER,
+            mood INTEGER NOT NULL,
+            pain INTEGER NOT NULL,
+            energy INTEGER NOT NULL,
+            allergy_state INTEGER NOT NULL,
+            allergy_medication INTEGER NOT NULL,
+            had_sex INTEGER NOT NULL,
+            sexual_wellbeing INTEGER NOT NULL,
+            sleep_quality INTEGER NOT NULL,
+            stress_level_work INTEGER NOT NULL,
+            stress_level_home INTEGER NOT NULL,
+            physical_activity INTEGER NOT NULL,
+            step_count INTEGER NOT NULL,
+            weather_enjoyment INTEGER NOT NULL,
+            daily_activities JSONB,
+            daily_comments VARCHAR,
+            id VARCHAR NOT NULL,
+            PRIMARY KEY (id)
+        );
+        CREATE INDEX IF NOT EXISTS ix_healthentry_uid ON healthentry (uid);
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_healthentry_date ON healthentry (date);
+        """,
+    ),
+    (
+        2,
+        "Replace single-column indexes with a covering unique (uid, date) index",
+        # The old unique index on date alone allowed only one entry per day across all users.
+        # Every query filters by uid and then orders or ranges by date, so (uid, date) serves
+        # them all, and the INCLUDE columns allow index-only scans for the stats queries.
+        """
+        DROP INDEX IF EXISTS ix_healthentry_date;
+        DROP INDEX IF EXISTS ix_healthentry_uid;
+        DROP INDEX IF EXISTS uq_healthentry_uid_date;
+        CREATE UNIQUE INDEX uq_healthentry_uid_date ON healthentry (uid, date)
+            INCLUDE (day_of_week, mood, pain, energy, sleep_quality, sexual_wellbeing,
+                     stress_level_work, stress_level_home, step_count);
+        ANALYZE healthentry;
+        """,
+    ),
+    (
+        3,
+        "Add per-user sufficient statistics, maintained by a trigger on healthentry",
+        # One row per user, weekday bucket (0-6, or -1 for all days) and pair of metrics, holding
+        # the count, sums, sums of squares and the sum of cross-products over the entries in which
+        # both metrics are present. Metric '*' with value 1 counts entries. Per weekday, only the
+        # diagonal (metric_a = metric_b) is kept. Statement-level triggers apply the changed rows of
+        # each write as one aggregated delta (old rows out, new rows in), inside its transaction.
+        # Rows that drop to n = 0 are kept.
+        f"""
+        CREATE TABLE user_metric_stats (
+            uid VARCHAR NOT NULL,
+            day_of_week SMALLINT NOT NULL,
+            metric_a VARCHAR NOT NULL,
+            metric_b VARCHAR NOT NULL,
+            n BIGINT NOT NULL,
+            sum_a BIGINT NOT NULL,
+            sum_b BIGINT NOT NULL,
+            sum_aa BIGINT NOT NULL,
+            sum_bb BIGINT NOT NULL,
+            sum_ab BIGINT NOT NULL,
+            PRIMARY KEY (uid, day_of_week, metric_a, metric_b)
+        );
+
+        CREATE FUNCTION healthentry_stats_trigger() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                {_user_metric_stats_upsert("SELECT new_rows.*, 1 AS sign FROM new_rows")};
+            ELSIF TG_OP = 'UPDATE' THEN
+                {_user_metric_stats_upsert(
+                    "SELECT new_rows.*, 1 AS sign FROM new_rows UNION ALL SELECT old_rows.*, -1 AS sign FROM old_rows"
+                )};
+            ELSE
+                {_user_metric_stats_upsert("SELECT old_rows.*, -1 AS sign FROM old_rows")};
+            END IF;
+            RETURN NULL;
+        END
+        $$;
+
+        CREATE TRIGGER healthentry_stats_insert
+            AFTER INSERT ON healthentry REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION healthentry_stats_trigger();
+        CREATE TRIGGER healthentry_stats_update
+            AFTER UPDATE ON healthentry REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION healthentry_stats_trigger();
+        CREATE TRIGGER healthentry_stats_delete
+            AFTER DELETE ON healthentry REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION healthentry_stats_trigger();
+
+        {_user_metric_stats_upsert("SELECT h.*, 1 AS sign FROM healthentry AS h")};
+        """,
+    ),
+    (
+        4,
+        "Add per-user data versions, bumped and announced with NOTIFY on every write",
+        # Each statement that writes entries bumps the version of every affected user once, and
+        # sends their uid on the data changed channel. Notifications are only delivered when the
+        # transaction commits. The workers evict cached data of these users, and fall back to
+        # comparing versions while they cannot listen.
+        f"""
+        CREATE TABLE user_data_version (
+            uid VARCHAR PRIMARY KEY,
+            version BIGINT NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL
+        );
+
+        CREATE FUNCTION user_data_version_bump(uids VARCHAR[]) RETURNS void
+        LANGUAGE sql AS $$
+            INSERT INTO user_data_version AS v (uid, version, updated_at)
+            SELECT DISTINCT changed.uid, 1, now() FROM unnest(uids) AS changed(uid)
+            ORDER BY changed.uid
+            ON CONFLICT (uid) DO UPDATE SET version = v.version + 1, updated_at = EXCLUDED.updated_at;
+
+            SELECT pg_notify('{DATA_CHANGED_CHANNEL}', changed.uid) FROM unnest(uids) AS changed(uid);
+        $$;
+
+        CREATE FUNCTION healthentry_version_trigger() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM user_data_version_bump(ARRAY(SELECT uid FROM new_rows));
+            ELSIF TG_OP = 'UPDATE' THEN
+                PERFORM user_data_version_bump(ARRAY(SELECT uid FROM new_rows UNION SELECT uid FROM old_rows));
+            ELSE
+                PERFORM user_data_version_bump(ARRAY(SELECT uid FROM old_rows));
+            END IF;
+            RETURN NULL;
+        END
+        $$;
+
+        CREATE TRIGGER healthentry_version_insert
+            AFTER INSERT ON healthentry REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION healthentry_version_trigger();
+        CREATE TRIGGER healthentry_version_update
+            AFTER UPDATE ON healthentry REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION healthentry_version_trigger();
+        CREATE TRIGGER healthentry_version_delete
+            AFTER DELETE ON healthentry REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION healthentry_version_trigger();
+
+        INSERT INTO user_data_version (uid, version, updated_at)
+        SELECT uid, 1, now() FROM healthentry GROUP BY uid;
+        """,
+    ),
+    (
+        5,
+        "Add a GIN index on daily_activities for containment queries",
+        # jsonb_path_ops only supports @>, but is smaller and faster than the default jsonb_ops.
+        # Dropped by migration 6, as the activities_bits mask replaced the containment queries.
+        """
+        CREATE INDEX ix_healthentry_daily_activities ON healthentry
+            USING GIN (daily_activities jsonb_path_ops);
+        """,
+    ),
+    (
+        6,
+        "Add the activities of each entry as a bit mask, with a registry of the activity bits",
+        # activity_registry gives every activity name a bit, 0 to 62. A row trigger sets
+        # activities_bits from daily_activities on every write, registering names it has not seen
+        # (under a table lock, so concurrent writes cannot take the same bit). Registered names
+        # keep their bit forever, and names beyond 63 are only kept in daily_activities. The mask
+        # is included in the covering index, so per-activity stats are index-only scans, and the
+        # GIN index of migration 5 has no queries left.
+        """
+        CREATE TABLE activity_registry (
+            bit SMALLINT PRIMARY KEY CHECK (bit BETWEEN 0 AND 62),
+            name VARCHAR NOT NULL UNIQUE
+        );
+
+        ALTER TABLE healthentry ADD COLUMN activities_bits BIGINT NOT NULL DEFAULT 0;
+
+        CREATE FUNCTION activity_bits(activities JSONB) RETURNS BIGINT
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            bits BIGINT;
+        BEGIN
+            IF jsonb_typeof(activities) IS DISTINCT FROM 'object' THEN
+                RETURN 0;
+            END IF;
+
+            IF EXISTS (
+                SELECT 1 FROM jsonb_object_keys(activities) AS key
+                WHERE key NOT IN (SELECT name FROM activity_registry)
+            ) AND (SELECT count(*) FROM activity_registry) < 63 THEN
+                LOCK TABLE activity_registry IN SHARE ROW EXCLUSIVE MODE;
+                INSERT INTO activity_registry (bit, name)
+                SELECT new_names.bit, new_names.name
+                FROM (
+                    SELECT (SELECT coalesce(max(bit), -1) FROM activity_registry)
+                           + row_number() OVER (ORDER BY key) AS bit,
+                           key AS name
+                    FROM jsonb_object_keys(activities) AS key
+                    WHERE key NOT IN (SELECT name FROM activity_registry)
+                ) AS new_names
+                WHERE new_names.bit <= 62;
+            END IF;
+
+            SELECT coalesce(bit_or(1::bigint << r.bit), 0) INTO bits
+            FROM jsonb_each_text(activities) AS a
+            JOIN activity_registry AS r ON r.name = a.key
+            WHERE a.value = '1';
+            RETURN bits;
+        END
+        $$;
+
+        CREATE FUNCTION healthentry_activities_bits_trigger() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' AND NEW.daily_activities IS NOT DISTINCT FROM OLD.daily_activities THEN
+                NEW.activities_bits := OLD.activities_bits;
+            ELSE
+                NEW.activities_bits := activity_bits(NEW.daily_activities);
+            END IF;
+            RETURN NEW;
+        END
+        $$;
+
+        INSERT INTO activity_registry (bit, name)
+        SELECT row_number() OVER (ORDER BY names.name) - 1, names.name
+        FROM (
+            SELECT DISTINCT jsonb_object_keys(daily_activities) AS name
+            FROM healthentry WHERE jsonb_typeof(daily_activities) = 'object'
+        ) AS names
+        ORDER BY names.name
+        LIMIT 63;
+
+        UPDATE healthentry SET activities_bits = activity_bits(daily_activities)
+        WHERE jsonb_typeof(daily_activities) = 'object' AND daily_activities <> '{}';
+
+        CREATE TRIGGER healthentry_activities_bits
+            BEFORE INSERT OR UPDATE ON healthentry
+            FOR EACH ROW EXECUTE FUNCTION healthentry_activities_bits_trigger();
+
+        DROP INDEX ix_healthentry_daily_activities;
+        DROP INDEX uq_healthentry_uid_date;
+        CREATE UNIQUE INDEX uq_healthentry_uid_date ON healthentry (uid, date)
+            INCLUDE (day_of_week, mood, pain, energy, sleep_quality, sexual_wellbeing,
+                     stress_level_work, stress_level_home, step_count, activities_bits);
+        ANALYZE healthentry;
+        """,
+    ),
+    (
+        7,
+        "Add per-user streaks of consecutive days, maintained by a trigger on healthentry",
+        # One row per run of consecutive days with an entry. For the days a statement adds or
+        # removes, the trigger deletes the runs containing or touching them (at most two per day),
+        # and rebuilds runs from the entries in those runs and days only. Runs are maximal, so no
+        # other run can merge with the rebuilt ones. Updates that keep uid and date change nothing.
+        # Dates are matched as zero-padded YYYY-MM-DD strings, with index range scans. Older rows
+        # may have unpadded dates like '2024-3-2' (see _normalize_entry_date() in api.py), which
+        # are matched as dates instead, through a partial index that holds only these rows. The
+        # statistics on length(date) let the planner see that the partial index is (nearly) empty.
+        """
+        CREATE INDEX ix_healthentry_unpadded_date ON healthentry (uid) WHERE length(date) <> 10;
+        CREATE STATISTICS healthentry_date_length ON (length(date)) FROM healthentry;
+
+        CREATE TABLE user_streak (
+            uid VARCHAR NOT NULL,
+            start_date DATE NOT NULL,
+            end_date DATE NOT NULL,
+            length INTEGER NOT NULL,
+            PRIMARY KEY (uid, start_date)
+        );
+        CREATE INDEX ix_user_streak_uid_end_date ON user_streak (uid, end_date);
+        CREATE INDEX ix_user_streak_uid_length ON user_streak (uid, length, end_date);
+
+        CREATE FUNCTION user_streak_rebuild(changed_uids VARCHAR[], changed_days DATE[]) RETURNS void
+        LANGUAGE sql AS $$
+            WITH changed AS (
+                SELECT DISTINCT c.uid, c.day FROM unnest(changed_uids, changed_days) AS c(uid, day)
+            ),
+            removed AS (
+                DELETE FROM user_streak AS s
+                USING changed
+                CROSS JOIN LATERAL (
+                    SELECT candidate.start_date, candidate.end_date FROM user_streak AS candidate
+                    WHERE candidate.uid = changed.uid AND candidate.start_date <= changed.day + 1
+                    ORDER BY candidate.start_date DESC
+                    LIMIT 2
+                ) AS near
+                WHERE near.end_date >= changed.day - 1
+                  AND s.uid = changed.uid AND s.start_date = near.start_date
+                RETURNING s.uid, s.start_date, s.end_date
+            ),
+            windows AS (
+                SELECT uid, start_date AS first_day, end_date AS last_day FROM removed
+                UNION
+                SELECT uid, day, day FROM changed
+            ),
+            days AS (
+                SELECT h.uid, h.date::date AS day
+                FROM windows AS w
+                JOIN healthentry AS h ON h.uid = w.uid
+                    AND h.date BETWEEN to_char(w.first_day, 'YYYY-MM-DD') AND to_char(w.last_day, 'YYYY-MM-DD')
+                    AND length(h.date) = 10
+                UNION
+                SELECT h.uid, h.date::date AS day
+                FROM windows AS w
+                JOIN healthentry AS h ON h.uid = w.uid
+                    AND length(h.date) <> 10 AND h.date::date BETWEEN w.first_day AND w.last_day
+            ),
+            runs AS (
+                SELECT uid, day, day - (row_number() OVER (PARTITION BY uid ORDER BY day))::int AS run
+                FROM days
+            )
+            INSERT INTO user_streak (uid, start_date, end_date, length)
+            SELECT uid, min(day), max(day), count(*) FROM runs
+            GROUP BY uid, run
+            ORDER BY uid, min(day);
+        $$;
+
+        CREATE FUNCTION healthentry_streak_trigger() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            uids VARCHAR[];
+            days DATE[];
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                SELECT array_agg(uid), array_agg(date::date) INTO uids, days FROM new_rows;
+            ELSIF TG_OP = 'UPDATE' THEN
+                SELECT array_agg(uid), array_agg(date::date) INTO uids, days FROM (
+                    (SELECT uid, date FROM new_rows EXCEPT SELECT uid, date FROM old_rows)
+                    UNION
+                    (SELECT uid, date FROM old_rows EXCEPT SELECT uid, date FROM new_rows)
+                ) AS moved;
+            ELSE
+                SELECT array_agg(uid), array_agg(date::date) INTO uids, days FROM old_rows;
+            END IF;
+            IF uids IS NOT NULL THEN
+                PERFORM user_streak_rebuild(uids, days);
+            END IF;
+            RETURN NULL;
+        END
+        $$;
+
+        CREATE TRIGGER healthentry_streak_insert
+            AFTER INSERT ON healthentry REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION healthentry_streak_trigger();
+        CREATE TRIGGER healthentry_streak_update
+            AFTER UPDATE ON healthentry REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION healthentry_streak_trigger();
+        CREATE TRIGGER healthentry_streak_delete
+            AFTER DELETE ON healthentry REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION healthentry_streak_trigger();
+
+        INSERT INTO user_streak (uid, start_date, end_date, length)
+        SELECT uid, min(day), max(day), count(*)
+        FROM (
+            SELECT uid, date::date AS day,
+                   date::date - (row_number() OVER (PARTITION BY uid ORDER BY date::date))::int AS run
+            FROM healthentry
+        ) AS runs
+        GROUP BY uid, run;
+        ANALYZE healthentry;
+        """,
+    ),
+]
+
+
+def get_applied_versions(connection) -> set:
+    """Versions recorded in schema_migrations. Creates the table if needed."""
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description VARCHAR NOT NULL,
+            applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        )
+    """))
+    return set(connection.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+
+def run_migrations(engine: Engine) -> list:
+    """
+    Apply all pending migrations in order. Returns the list of versions that were applied.
+    """
+    applied_now = []
+    with engine.begin() as connection:
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+        applied = get_applied_versions(connection)
+
+        for version, description, sql in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"Applying database migration {version}: {description}")
+            connection.execute(text(sql))
+            connection.execute(
+                text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description)"),
+                {"version": version, "description": description}
+            )
+            applied_now.append(version)
+
+    if applied_now:
+        logger.info(f"Applied {len(applied_now)} database migration(s), schema is at version {applied_now[-1]}")
+    else:
+        logger.info("Database schema is up to date")
+    return applied_now
+
+
+def main():
+    """
+    Apply pending migrations to the database configured in the environment and print the state.
+    """
+    from .logging_config import setup_logging
+    from .database import engine
+
+    setup_logging()
+    run_migrations(engine)
+
+    with engine.connect() as connection:
+        applied = {row.version: row for row in connection.execute(
+            text("SELECT version, applied_at FROM schema_migrations")
+        )}
+    for version, description, _ in MIGRATIONS:
+        print(f"{version:4d}  {applied[version].applied_at:%Y-%m-%d %H:%M:%S}  {description}")
+
+
+if __name__ == "__main__":
+    main()
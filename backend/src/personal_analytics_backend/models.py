@@ -1,14 +1,26 @@
-from datetime import datetime
+from datetime import date, datetime
 from typing import Optional, Dict, Any
 from sqlmodel import SQLModel, Field, Column
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy import Integer
+from sqlalchemy import Integer, Index, BigInteger, SmallInteger, DateTime, text
 import calendar
 import uuid
 
+from .migrations import STATS_INDEX_INCLUDE_COLUMNS
+
+# The integer metric columns of HealthEntry, in model order.
+METRIC_FIELDS = [
+    "mood", "pain", "energy",
+    "allergy_state", "allergy_medication",
+    "had_sex", "sexual_wellbeing", "sleep_quality",
+    "stress_level_work", "stress_level_home",
+    "physical_activity", "step_count", "weather_enjoyment",
+]
+
+
 class HealthEntryBase(SQLModel):
-    uid: str = Field(index=True)  # Add user identifier field
-    date: str = Field(index=True, unique=True)
+    uid: str  # User identifier. Indexed together with date, see HealthEntry.
+    date: str
     timestamp: datetime = Field(default_factory=datetime.now)
     day_of_week: Optional[int] = Field(  # Store in DB for querying
         sa_column=Column(Integer),
@@ -48,10 +60,29 @@ class HealthEntryBase(SQLModel):
 
 
 class HealthEntry(HealthEntryBase, table=True):
+    # One entry per user and day. Upserts rely on this via ON CONFLICT (uid, date).
+    # The schema is managed by migrations.py, keep this in sync with it.
+    __table_args__ = (
+        Index(
+            "uq_healthentry_uid_date", "uid", "date", unique=True,
+            postgresql_include=STATS_INDEX_INCLUDE_COLUMNS,
+        ),
+        # Rows with unpadded legacy dates like '2024-3-2', for the streak trigger of migration 7
+        Index("ix_healthentry_unpadded_date", "uid", postgresql_where=text("length(date) <> 10")),
+    )
+
     id: Optional[str] = Field(
         default_factory=lambda: str(uuid.uuid4()),
         primary_key=True
     )
+    # The activities done on the day (value 1 in daily_activities) as a bit mask, with the bits
+    # from ActivityRegistry. Set by a database trigger on every write (see migration 6), so the
+    # app only ever reads it. Not part of the API, which uses daily_activities.
+    activities_bits: int = Field(
+        default=0, exclude=True,
+        sa_column=Column(BigInteger, nullable=False, server_default="0")
+    )
+
     @property
     def is_weekend(self) -> bool:
         """Convenience property: Saturday=5, Sunday=6"""
@@ -63,6 +94,84 @@ class HealthEntry(HealthEntryBase, table=True):
         return calendar.day_name[self.day_of_week]
 
 
+# Registry of the metric columns that requests may select by name, e.g. ?metrics=mood,pain.
+# Names from requests are only ever looked up in here, never passed to getattr() or into SQL.
+METRIC_COLUMNS = {name: HealthEntry.__table__.c[name] for name in METRIC_FIELDS}
+
+
+# Bits 0 to 62 of HealthEntry.activities_bits, so the mask stays a non-negative BIGINT.
+ACTIVITY_BITS = 63
+
+
+class ActivityRegistry(SQLModel, table=True):
+    """
+    Bit position of every activity name in HealthEntry.activities_bits. Names are registered by
+    the database trigger the first time an entry uses them, and keep their bit forever. Names
+    beyond the first ACTIVITY_BITS stay in daily_activities only.
+    """
+    __tablename__ = "activity_registry"
+
+    bit: int = Field(primary_key=True, sa_type=SmallInteger)
+    name: str = Field(unique=True)
+
+
+class UserMetricStats(SQLModel, table=True):
+    """
+    Per-user sufficient statistics over the metrics of all entries: counts, sums, sums of squares
+    and sums of cross-products, overall and per weekday. Maintained by database triggers on every
+    write to healthentry (see migration 3 in migrations.py), so the app only ever reads it.
+
+    For a pair of metrics, the sums are over the entries in which both are present. Metric '*' has
+    the value 1 for every entry, so its n is the number of entries.
+    """
+    __tablename__ = "user_metric_stats"
+
+    uid: str = Field(primary_key=True)
+    day_of_week: int = Field(primary_key=True, sa_type=SmallInteger)  # 0=Monday, ..., 6=Sunday, -1 = all days
+    metric_a: str = Field(primary_key=True)
+    metric_b: str = Field(primary_key=True)
+    n: int = Field(sa_type=BigInteger)
+    sum_a: int = Field(sa_type=BigInteger)
+    sum_b: int = Field(sa_type=BigInteger)
+    sum_aa: int = Field(sa_type=BigInteger)
+    sum_bb: int = Field(sa_type=BigInteger)
+    sum_ab: int = Field(sa_type=BigInteger)
+
+    @property
+    def mean_a(self) -> Optional[float]:
+        return self.sum_a / self.n if self.n else None
+
+
+class UserDataVersion(SQLModel, table=True):
+    """
+    Per-user counter that is bumped by every statement that writes the user's entries, with the
+    time of the last change. Maintained by database triggers (see migration 4 in migrations.py).
+    """
+    __tablename__ = "user_data_version"
+
+    uid: str = Field(primary_key=True)
+    version: int = Field(sa_type=BigInteger)
+    updated_at: datetime = Field(sa_type=DateTime(timezone=True))
+
+
+class UserStreak(SQLModel, table=True):
+    """
+    A run of consecutive days on which the user has an entry, from start_date to end_date.
+    Maintained by database triggers on every write to healthentry (see migration 7 in
+    migrations.py), which only rebuild the runs around the changed days.
+    """
+    __tablename__ = "user_streak"
+    __table_args__ = (
+        Index("ix_user_streak_uid_end_date", "uid", "end_date"),
+        Index("ix_user_streak_uid_length", "uid", "length", "end_date"),
+    )
+
+    uid: str = Field(primary_key=True)
+    start_date: date = Field(primary_key=True)
+    end_date: date
+    length: int
+
+
 # For API - SQLModel handles serialization automatically
 class HealthEntryCreate(HealthEntryBase):
     # Only include fields that the frontend should send
@@ -0,0 +1,202 @@
+"""
+Per-request profiling of the database work and the time spent in the endpoint.
+
+ProfilingMiddleware starts a RequestProfile for every request. The engine events added by
+profile_engine() record every SQL statement in the profile of the current request, and
+ProfiledRoute times the endpoint function and the route as a whole (dependencies, validation and
+serialization). Each response then gets a Server-Timing header like
+
+    Server-Timing: db;dur=3.1;desc="2 queries", handler;dur=0.4, serialize;dur=0.9, total;dur=5.2
+
+which the browser developer tools show in the timing tab of the request. db is the time in SQL
+statements, handler the time in the endpoint function outside of them, serialize the rest of the
+route (dependencies, validation and serialization), and total the whole request. For streamed
+responses, statements run after the header was sent are not included.
+
+Statements slower than PA_SLOW_QUERY_MS are logged with their parameters, and with the output of
+EXPLAIN ANALYZE if PA_SLOW_QUERY_EXPLAIN is true (SELECT statements only, as EXPLAIN ANALYZE
+executes the statement once more). Requests with more than PA_QUERY_COUNT_WARNING statements are
+logged as possible N+1 query patterns.
+"""
+
+import collections
+import functools
+import inspect
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+
+from .settings import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RequestProfile:
+    """Time and statements of one request. Times are in seconds."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.db_time = 0.0
+        self.endpoint_time: Optional[float] = None
+        self.endpoint_db_time = 0.0
+        self.route_time: Optional[float] = None
+        self.statements = collections.Counter()
+
+    def record_statement(self, statement: str, elapsed: float):
+        self.query_count += 1
+        self.db_time += elapsed
+        self.statements[statement] += 1
+
+    def server_timing(self) -> str:
+        """Value for the Server-Timing header, durations in milliseconds"""
+        timings = [f'db;dur={self.db_time * 1000:.1f};desc="{self.query_count} queries"']
+        if self.endpoint_time is not None:
+            handler_time = max(self.endpoint_time - self.endpoint_db_time, 0.0)
+            timings.append(f"handler;dur={handler_time * 1000:.1f}")
+        if self.route_time is not None and self.endpoint_time is not None:
+            outside_db_time = self.db_time - self.endpoint_db_time
+            serialize_time = max(self.route_time - self.endpoint_time - outside_db_time, 0.0)
+            timings.append(f"serialize;dur={serialize_time * 1000:.1f}")
+        timings.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(timings)
+
+
+# The profile of the request being handled. Sync endpoints run in a thread pool, which copies
+# the context, so they see the same profile object.
+current_profile: ContextVar[Optional[RequestProfile]] = ContextVar("current_profile", default=None)
+
+
+def _timed_endpoint(endpoint):
+    """Wrap an endpoint function so that it records its own run time in the current profile"""
+
+    def record(started: float, db_time_before: float, profile: Optional[RequestProfile]):
+        if profile is not None:
+            profile.endpoint_time = time.perf_counter() - started
+            profile.endpoint_db_time = profile.db_time - db_time_before
+
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def timed(*args, **kwargs):
+            profile = current_profile.get()
+            started, db_time_before = time.perf_counter(), profile.db_time if profile else 0.0
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                record(started, db_time_before, profile)
+    else:
+        @functools.wraps(endpoint)
+        def timed(*args, **kwargs):
+            profile = current_profile.get()
+            started, db_time_before = time.perf_counter(), profile.db_time if profile else 0.0
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                record(started, db_time_before, profile)
+    return timed
+
+
+class ProfiledRoute(APIRoute):
+    """APIRoute that records the time of the endpoint function and of the whole route"""
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, endpoint, **kwargs)
+        # FastAPI looks up dependant.call on every request
+        self.dependant.call = _timed_endpoint(self.dependant.call)
+
+    def get_route_handler(self):
+        route_handler = super().get_route_handler()
+
+        async def profiled_route_handler(request):
+            started = time.perf_counter()
+            try:
+                return await route_handler(request)
+            finally:
+                profile = current_profile.get()
+                if profile is not None:
+                    profile.route_time = time.perf_counter() - started
+
+        return profiled_route_handler
+
+
+def _explain_analyze(conn, statement: str, parameters) -> str:
+    """EXPLAIN ANALYZE output for a statement, on the same connection and in a savepoint"""
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute("EXPLAIN ANALYZE " + statement, parameters)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        finally:
+            cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+        return plan
+    except Exception as e:
+        return f"EXPLAIN ANALYZE failed: {e}"
+    finally:
+        cursor.close()
+
+
+def profile_engine(engine: Engine):
+    """Record the statements of engine in the current request profile, and log slow statements"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("profiling_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["profiling_query_start"].pop()
+        profile = current_profile.get()
+        if profile is not None:
+            profile.record_statement(statement, elapsed)
+
+        slow_query_ms = settings.slow_query_ms
+        if slow_query_ms > 0 and elapsed * 1000 >= slow_query_ms:
+            message = f"Slow SQL statement ({elapsed * 1000:.1f} ms): {statement}\nParameters: {parameters!r:.1000}"
+            if settings.slow_query_explain and not executemany and statement.lstrip().upper().startswith("SELECT"):
+                message += "\n" + _explain_analyze(conn, statement, parameters)
+            logger.warning(message)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get("profiling_query_start"):
+            context.connection.info["profiling_query_start"].pop()
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles every request, see the module docstring"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+
+        async def send_with_server_timing(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("Server-Timing", profile.server_timing())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_server_timing)
+        finally:
+            current_profile.reset(token)
+            query_count_warning = settings.query_count_warning
+            if 0 < query_count_warning < profile.query_count:
+                statement, repeats = profile.statements.most_common(1)[0]
+                route = getattr(scope.get("route"), "path", scope["path"])
+                logger.warning(
+                    f"{scope['method']} {route} ran {profile.query_count} SQL statements, possibly an N+1 query pattern. "
+                    f"Most repeated ({repeats} times): {statement:.300}"
+                )
@@ -19,6 +19,49 @@ class PaBackendSettings:
             raise ValueError("PA_DATABASE_URL environment variable is not set.")
         return db_url
 
+    @property
+    def database_listen_url(self):
+        """
+        Database for the LISTEN connection of the cache invalidation listener. LISTEN does not work
+        through PgBouncer in transaction pooling mode, so point this at the database server itself.
+        """
+        return os.getenv("PA_DATABASE_LISTEN_URL") or self.database_url
+
+    # Connection pool of each worker process. A worker opens up to db_pool_size + db_max_overflow
+    # connections for requests, plus one for the cache invalidation listener.
+    @property
+    def db_pool_size(self):
+        """Connections kept open in the pool"""
+        return int(os.getenv("PA_DB_POOL_SIZE", "5"))
+
+    @property
+    def db_max_overflow(self):
+        """Connections opened beyond db_pool_size under load, closed again when returned"""
+        return int(os.getenv("PA_DB_MAX_OVERFLOW", "10"))
+
+    @property
+    def db_pool_timeout(self):
+        """Seconds a request waits for a free connection before it fails"""
+        return float(os.getenv("PA_DB_POOL_TIMEOUT", "30"))
+
+    @property
+    def db_pool_recycle(self):
+        """Connections older than this many seconds are replaced on checkout. -1 keeps them forever."""
+        return int(os.getenv("PA_DB_POOL_RECYCLE", "1800"))
+
+    @property
+    def db_pool_pre_ping(self):
+        """Whether to test connections on checkout, to replace connections broken by a database restart"""
+        return os.getenv("PA_DB_POOL_PRE_PING", "true").lower() == "true"
+
+    @property
+    def db_pgbouncer(self):
+        """
+        Whether PA_DATABASE_URL points at PgBouncer in transaction pooling mode. The workers then
+        do not pool connections themselves, and do not use prepared statements.
+        """
+        return os.getenv("PA_DB_PGBOUNCER", "false").lower() == "true"
+
     @property
     def allowed_origins(self):
         origins = json.loads(os.getenv("PA_ALLOWED_ORIGINS", "[]"))
@@ -26,6 +69,31 @@ class PaBackendSettings:
             raise ValueError("PA_ALLOWED_ORIGINS environment variable is not set. Please set a JSON array of allowed origins.")
         return origins
 
+    @property
+    def stats_cache_size(self):
+        """Maximum number of cached /stats/* responses per worker process. 0 disables the cache."""
+        return int(os.getenv("PA_STATS_CACHE_SIZE", "1024"))
+
+    @property
+    def async_database(self):
+        """Whether the endpoints run on the event loop with an async database driver, see database.py"""
+        return os.getenv("PA_ASYNC_DATABASE", "false").lower() == "true"
+
+    @property
+    def slow_query_ms(self):
+        """SQL statements taking at least this many milliseconds are logged. 0 disables the log."""
+        return float(os.getenv("PA_SLOW_QUERY_MS", "250"))
+
+    @property
+    def slow_query_explain(self):
+        """Whether to add the EXPLAIN ANALYZE output of slow SELECT statements to the log"""
+        return os.getenv("PA_SLOW_QUERY_EXPLAIN", "false").lower() == "true"
+
+    @property
+    def query_count_warning(self):
+        """Requests running more SQL statements than this are logged as possible N+1 queries. 0 disables it."""
+        return int(os.getenv("PA_QUERY_COUNT_WARNING", "20"))
+
 
 settings = PaBackendSettings()
 
@@ -0,0 +1,297 @@
+"""
+Vectorized statistics over the metric columns of a user's entries.
+
+The stats endpoints load the metric columns they need once, into a 2-D float array with one row
+per entry (day) and one column per metric, where NaN marks a missing value. The functions in here
+then work on whole arrays at once, instead of looping over metrics and values in Python.
+"""
+
+from datetime import date, datetime
+from typing import List, Optional, Tuple
+
+import numpy as np
+from sqlmodel import select
+
+from .models import HealthEntry
+
+
+def metric_matrix_query(uid: str, metrics: List[str], start_date: Optional[str] = None, end_date: Optional[str] = None):
+    """
+    Select date plus the given metric columns of a user's entries, ordered by date.
+    Feed the result rows to rows_to_matrix().
+    """
+    query = select(HealthEntry.date, *[getattr(HealthEntry, metric) for metric in metrics]).where(HealthEntry.uid == uid)
+    if start_date:
+        query = query.where(HealthEntry.date >= start_date)
+    if end_date:
+        query = query.where(HealthEntry.date <= end_date)
+    return query.order_by(HealthEntry.date)
+
+
+def rows_to_matrix(rows, n_metrics: int) -> Tuple[List[str], np.ndarray]:
+    """
+    Split (date, metric, metric, ...) rows into the list of dates and a float array of shape
+    (n_rows, n_metrics), with NaN for missing (NULL) values.
+    """
+    rows = list(rows)
+    dates = [row[0] for row in rows]
+    values = np.array([tuple(row[1:]) for row in rows], dtype=float).reshape(len(rows), n_metrics)
+    return dates, values
+
+
+def cross_pearson_matrix(a: np.ndarray, b: np.ndarray, min_periods: int = 2) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pairwise-complete Pearson correlation of every column of a with every column of b, in one
+    vectorized pass. a and b must have the same number of rows, which are paired up row by row.
+
+    For each pair of columns, only the rows in which both values are present are used.
+    Returns (correlations, sample_sizes), both of shape (n_columns_a, n_columns_b). Correlations
+    are NaN for pairs with fewer than min_periods common rows, or without variance.
+    """
+    present_a = ~np.isnan(a)
+    present_b = ~np.isnan(b)
+    mask_a = present_a.astype(float)
+    mask_b = present_b.astype(float)
+    x = np.where(present_a, a, 0.0)
+    y = np.where(present_b, b, 0.0)
+
+    # Entry [i, j] of each of these sums over the rows where both a[:, i] and b[:, j] are present.
+    n = mask_a.T @ mask_b
+    sum_x = x.T @ mask_b
+    sum_y = mask_a.T @ y
+    sum_xx = (x * x).T @ mask_b
+    sum_yy = mask_a.T @ (y * y)
+    sum_xy = x.T @ y
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = sum_xy - sum_x * sum_y / n
+        var_x = sum_xx - sum_x * sum_x / n
+        var_y = sum_yy - sum_y * sum_y / n
+        correlations = cov / np.sqrt(var_x * var_y)
+
+    # Guard against rounding slightly outside [-1, 1], and mark unusable pairs. A constant column
+    # may come out with a tiny variance instead of 0 due to rounding, hence the relative tolerance.
+    correlations = np.clip(correlations, -1.0, 1.0)
+    degenerate = (n < min_periods) | ~(var_x > 1e-10 * sum_xx) | ~(var_y > 1e-10 * sum_yy)
+    correlations[degenerate] = np.nan
+    return correlations, n.astype(int)
+
+
+def pearson_matrix(values: np.ndarray, min_periods: int = 2) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pairwise-complete Pearson correlation of all columns of values with each other.
+    Returns (correlations, sample_sizes), both of shape (n_metrics, n_metrics).
+    """
+    return cross_pearson_matrix(values, values, min_periods)
+
+
+def pearson_from_sums(n: int, sum_a: int, sum_b: int, sum_aa: int, sum_bb: int, sum_ab: int) -> Optional[float]:
+    """
+    Pearson correlation from sufficient statistics, e.g. a UserMetricStats row. With integer sums
+    this is exact up to the final division. None if n < 2 or either variable has no variance.
+    """
+    if n < 2:
+        return None
+    cov = n * sum_ab - sum_a * sum_b
+    var_a = n * sum_aa - sum_a * sum_a
+    var_b = n * sum_bb - sum_b * sum_b
+    if var_a <= 0 or var_b <= 0:
+        return None
+    return max(-1.0, min(1.0, cov / (var_a * var_b) ** 0.5))
+
+
+def rankdata(column: np.ndarray) -> np.ndarray:
+    """Ranks starting at 1, ties get the average of their ranks. NaN values stay NaN."""
+    ranks = np.full(column.shape, np.nan)
+    present = ~np.isnan(column)
+    _, inverse, counts = np.unique(column[present], return_inverse=True, return_counts=True)
+    average_ranks = np.cumsum(counts) - (counts - 1) / 2.0
+    ranks[present] = average_ranks[inverse]
+    return ranks
+
+
+def spearman_matrix(values: np.ndarray, min_periods: int = 2) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pairwise-complete Spearman rank correlation of all columns of values.
+
+    Columns are ranked once and correlated in one vectorized pass. Ranks depend on which rows
+    are used though, so pairs of columns with differing missing values are re-ranked over their
+    common rows and computed separately. Returns (correlations, sample_sizes) like pearson_matrix().
+    """
+    ranks = np.column_stack([rankdata(values[:, i]) for i in range(values.shape[1])]) if values.size else values
+    correlations, n = pearson_matrix(ranks, min_periods)
+
+    present = ~np.isnan(values)
+    n_metrics = values.shape[1]
+    for i in range(n_metrics):
+        for j in range(i + 1, n_metrics):
+            if np.array_equal(present[:, i], present[:, j]):
+                continue
+            common = present[:, i] & present[:, j]
+            pair_ranks = np.column_stack([rankdata(values[common, i]), rankdata(values[common, j])])
+            pair_correlations, _ = pearson_matrix(pair_ranks, min_periods)
+            correlations[i, j] = correlations[j, i] = pair_correlations[0, 1]
+    return correlations, n
+
+
+def correlation_matrix(values: np.ndarray, method: str = "pearson", min_periods: int = 2) -> Tuple[np.ndarray, np.ndarray]:
+    """Pairwise-complete correlation matrix and sample sizes. method is 'pearson' or 'spearman'."""
+    if method == "spearman":
+        return spearman_matrix(values, min_periods)
+    if method == "pearson":
+        return pearson_matrix(values, min_periods)
+    raise ValueError(f"Unknown correlation method '{method}'")
+
+
+def correlation_pairs(metrics: List[str], correlations: np.ndarray, sample_sizes: np.ndarray) -> List[dict]:
+    """
+    The upper triangle of a correlation matrix as a list of dicts, strongest correlation first.
+    Pairs without a defined correlation are left out.
+    """
+    pairs = []
+    for i, metric1 in enumerate(metrics):
+        for j in range(i + 1, len(metrics)):
+            if np.isnan(correlations[i, j]):
+                continue
+            pairs.append({
+                'metric1': metric1,
+                'metric2': metrics[j],
+                'correlation': round(float(correlations[i, j]), 3),
+                'sample_size': int(sample_sizes[i, j])
+            })
+    pairs.sort(key=lambda x: abs(x['correlation']), reverse=True)
+    return pairs
+
+
+def _parse_date(value: str) -> date:
+    """Parse a stored YYYY-MM-DD date. fromisoformat() is much faster, but rejects '2024-1-5'."""
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def daily_series(dates: List[str], values: np.ndarray) -> np.ndarray:
+    """
+    Spread the rows of values over a gap-aware daily grid from the first to the last date.
+    Row d of the result is the day d days after the first date, all NaN if there is no entry for it.
+    Dates are parsed like POST /entries/ parses them, so older rows like '2024-1-5' work too.
+    """
+    if len(dates) == 0:
+        return np.empty((0, values.shape[1]))
+    days = np.array([_parse_date(value) for value in dates], dtype="datetime64[D]")
+    offsets = (days - days.min()).astype(int)
+    daily = np.full((offsets.max() + 1, values.shape[1]), np.nan)
+    daily[offsets] = values
+    return daily
+
+
+def daily_dates(dates: List[str]) -> List[str]:
+    """The dates of the rows of daily_series(dates, ...), from the first to the last date, as YYYY-MM-DD"""
+    if len(dates) == 0:
+        return []
+    days = np.array([_parse_date(value) for value in dates], dtype="datetime64[D]")
+    return np.arange(days.min(), days.max() + 1).astype(str).tolist()
+
+
+def lagged_correlations(daily: np.ndarray, max_lag: int, min_periods: int = 2) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Lagged Pearson correlations of every metric with every metric, for the lags 1 to max_lag days.
+
+    daily is a gap-aware daily array as returned by daily_series(). Entry [lag - 1, i, j] of the
+    result is the correlation of metric i on a day with metric j lag days later, computed over all
+    pairs of days on which both values exist. Returns (correlations, sample_sizes), both of shape
+    (max_lag, n_metrics, n_metrics).
+    """
+    n_metrics = daily.shape[1]
+    correlations = np.full((max_lag, n_metrics, n_metrics), np.nan)
+    sample_sizes = np.zeros((max_lag, n_metrics, n_metrics), dtype=int)
+    for lag in range(1, min(max_lag, len(daily) - 1) + 1):
+        correlations[lag - 1], sample_sizes[lag - 1] = cross_pearson_matrix(daily[:-lag], daily[lag:], min_periods)
+    return correlations, sample_sizes
+
+
+def day_numbers(dates: List[str]) -> np.ndarray:
+    """Days since 1970-01-01 of stored YYYY-MM-DD dates, as a float array for use as x values"""
+    return np.array([_parse_date(value) for value in dates], dtype="datetime64[D]").astype(int).astype(float)
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Indices of the points that largest-triangle-three-buckets (LTTB) keeps of the series (x, y),
+    sorted by x, to draw it with n_out points: the first and the last point, and from each of
+    n_out - 2 equal buckets in between the point spanning the largest triangle with the point kept
+    before it and the average of the next bucket. This keeps peaks and dips that averaging would
+    flatten. Points with NaN y values are never kept.
+    """
+    valid = np.flatnonzero(~np.isnan(y))
+    if len(valid) <= n_out:
+        return valid
+    if n_out < 3:
+        return valid[np.linspace(0, len(valid) - 1, n_out).round().astype(int)]
+    x, y = x[valid], y[valid]
+
+    # Bucket i (0-based) holds the points edges[i] to edges[i + 1] - 1, excluding the first and last point
+    edges = np.linspace(1, len(x) - 1, n_out - 1).astype(int)
+    kept = np.empty(n_out, dtype=int)
+    kept[0], kept[-1] = 0, len(x) - 1
+    previous = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x, next_y = x[end:edges[i + 2]].mean(), y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        # Twice the triangle areas, the factor does not change the maximum
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        kept[i + 1] = previous
+    return valid[kept]
+
+
+def rolling_mean_std(daily: np.ndarray, window: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Mean and sample standard deviation of each metric over the last window days up to and
+    including each day, from running sums, so in O(n) whatever the window. daily is a gap-aware
+    daily array as returned by daily_series(); missing days do not count. The mean needs one
+    value in the window, the standard deviation two, and is NaN otherwise.
+    """
+    present = ~np.isnan(daily)
+    values = np.where(present, daily, 0.0)
+
+    def window_sums(column_values: np.ndarray) -> np.ndarray:
+        running = np.vstack([np.zeros((1, daily.shape[1])), np.cumsum(column_values, axis=0)])
+        return running[1:] - running[np.maximum(np.arange(1, len(daily) + 1) - window, 0)]
+
+    counts = window_sums(present.astype(float))
+    sums = window_sums(values)
+    sums_of_squares = window_sums(values * values)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(counts >= 1, sums / counts, np.nan)
+        variance = (sums_of_squares - sums * sums / counts) / (counts - 1)
+        std = np.where(counts >= 2, np.sqrt(np.maximum(variance, 0.0)), np.nan)
+    return mean, std
+
+
+def ewma(daily: np.ndarray, alpha: float) -> np.ndarray:
+    """
+    Exponentially weighted moving average of each metric on a gap-aware daily array. The value of
+    a day weighs (1 - alpha) ** d on the day d days later, so missing days let older values fade
+    like any other day. Weights are normalized to the values present (like adjust=True in pandas).
+    NaN before the first value. One pass over the days, vectorized over the metrics.
+    """
+    decay = 1.0 - alpha
+    present = ~np.isnan(daily)
+    values = np.where(present, daily, 0.0)
+    numerator = np.zeros(daily.shape[1])
+    denominator = np.zeros(daily.shape[1])
+    result = np.full(daily.shape, np.nan)
+    for day in range(len(daily)):
+        numerator = numerator * decay + values[day]
+        denominator = denominator * decay + present[day]
+        result[day] = np.where(denominator > 0, numerator / np.where(denominator > 0, denominator, 1.0), np.nan)
+    return result
@@ -1,13 +1,23 @@
 import pytest
 from fastapi.testclient import TestClient
 from fastapi import status
-from unittest.mock import Mock
-from datetime import datetime
+from unittest.mock import Mock, MagicMock
+from datetime import datetime, timezone
+import json
+import io
+import time
+import numpy as np
 from sqlmodel import select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool, QueuePool
 
+from src.personal_analytics_backend import api as api_module
+from src.personal_analytics_backend import database as database_module
 from src.personal_analytics_backend.api import app
 from src.personal_analytics_backend.models import HealthEntry
 from src.personal_analytics_backend.database import get_session
+from src.personal_analytics_backend.cache import stats_cache
+from src.personal_analytics_backend.metrics import InstrumentedQueuePool
 
 
 @pytest.fixture
@@ -167,14 +177,79 @@ def test_get_all_entries_empty(client, mock_session):
         app.dependency_overrides.clear()
 
 
+def test_get_all_entries_next_cursor(client, mock_session, sample_health_entry):
+    """Test that a full page sets X-Next-Cursor, and that bad cursors and fields are rejected"""
+
+    second_entry = HealthEntry(**{**sample_health_entry.model_dump(), "id": "test-id-456", "date": "2024-01-14"})
+    mock_session.exec.return_value.all.return_value = [sample_health_entry, second_entry]
+    app.dependency_overrides[get_session] = lambda: mock_session
+
+    try:
+        response = client.get("/entries/", params={"uid": "user123", "limit": 1})
+        cursor = response.headers["x-next-cursor"]
+        print(f"Next cursor: {cursor}")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert [entry["id"] for entry in response.json()] == ["test-uuid-123"]
+        assert api_module._decode_entries_cursor(cursor) == ("2024-01-15", "test-uuid-123")
+
+        response = client.get("/entries/", params={"uid": "user123", "limit": 2})
+        assert len(response.json()) == 2
+        assert "x-next-cursor" not in response.headers
+
+        for params in ({"cursor": "not-a-cursor"}, {"cursor": cursor, "skip": 5}, {"fields": "mood,password"}):
+            response = client.get("/entries/", params={"uid": "user123", **params})
+            print(f"{params}: {response.json()}")
+            assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_metrics_over_time_selects_requested_columns(client, mock_session):
+    """Test that metrics-over-time queries only date and the requested metrics, and rejects unknown metrics"""
+
+    mock_session.execute.return_value.all.return_value = [("2024-01-14", 7, 3), ("2024-01-15", 8, 2)]
+    app.dependency_overrides[get_session] = lambda: mock_session
+    stats_cache.clear()
+
+    try:
+        response = client.get("/stats/metrics-over-time", params={"uid": "user123", "metrics": "mood,pain"})
+        query = str(mock_session.execute.call_args[0][0])
+        print(f"Query: {query}")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == {"dates": ["2024-01-14", "2024-01-15"], "metrics": {"mood": [7, 8], "pain": [3, 2]}}
+        assert "healthentry.mood" in query and "healthentry.pain" in query
+        assert "daily_activities" not in query and "daily_comments" not in query
+
+        mock_session.execute.return_value.all.return_value = []
+        response = client.get("/stats/metrics-over-time", params={"uid": "user123", "days": 7})
+        assert response.json() == {"dates": [], "metrics": {metric: [] for metric in api_module.DEFAULT_TIMELINE_METRICS}}
+
+        response = client.get("/stats/metrics-over-time", params={"uid": "user123", "metrics": "mood,__class__"})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    finally:
+        app.dependency_overrides.clear()
+        stats_cache.clear()
+
+
+@pytest.fixture
+def mock_engine(monkeypatch):
+    """Mock engine for the health endpoints, with a real connection pool that never connects"""
+    engine = MagicMock()
+    engine.pool = QueuePool(lambda: Mock(), pool_size=5)
+    connection = engine.connect.return_value.__enter__.return_value
+    connection.execute.return_value.scalar.return_value = 1234.0
+    monkeypatch.setattr(api_module, "engine", engine)
+    return engine
+
+
 # Let's also test a simpler endpoint to verify our mocking works
-def test_health_check_endpoint(client, mock_session):
+def test_health_check_endpoint(client, mock_session, mock_engine):
     """Test health check endpoint with mocking"""
 
-    # Mock some entries for the health check
-    mock_entries = [Mock(), Mock(), Mock()]  # 3 mock entries
-    mock_session.exec.return_value.all.return_value = mock_entries
-
     # Override dependency
     app.dependency_overrides[get_session] = lambda: mock_session
 
@@ -187,8 +262,468 @@ def test_health_check_endpoint(client, mock_session):
         assert response.status_code == status.HTTP_200_OK
         data = response.json()
         assert data["status"] == "healthy"
-        # The health endpoint counts entries, so it should see our 3 mock entries
-        assert data["entries_count"] == 3
+        # The entry count is the planner's estimate, the entries themselves are not loaded
+        assert data["entries_count"] == 1234
+        mock_session.exec.assert_not_called()
+
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_liveness_does_not_touch_database(client, mock_engine):
+    """Test that the liveness probe answers without a database connection"""
+    response = client.get("/health/live")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"status": "alive"}
+    mock_engine.connect.assert_not_called()
+
+
+def test_readiness_reports_pool(client, mock_engine):
+    """Test that the readiness probe runs SELECT 1 and reports the connection pool"""
+    response = client.get("/health/ready")
+
+    print(f"Readiness content: {response.text}")
+
+    assert response.status_code == status.HTTP_200_OK
+    data = response.json()
+    assert data["status"] == "ready"
+    assert "entries_estimate" not in data["database"]
+    assert data["pool"]["class"] == "QueuePool"
+    assert data["pool"]["size"] == 5
+    statements = [str(call.args[0]) for call in mock_engine.connect.return_value.__enter__.return_value.execute.call_args_list]
+    assert "SELECT 1" in statements
+
+
+@pytest.mark.parametrize("failure", ["error", "timeout"])
+def test_readiness_unavailable(client, mock_engine, monkeypatch, failure):
+    """Test that the readiness probe answers 503 if the database fails or does not answer in time"""
+    connection = mock_engine.connect.return_value.__enter__.return_value
+    if failure == "error":
+        connection.execute.side_effect = OperationalError("SELECT 1", {}, Exception("connection refused"))
+    else:
+        monkeypatch.setattr(api_module, "READINESS_TIMEOUT_SECONDS", 0.1)
+        connection.execute.side_effect = lambda *args, **kwargs: time.sleep(0.5)
+
+    response = client.get("/health/ready")
+
+    print(f"Readiness content: {response.text}")
+
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.json()["status"] == "unavailable"
+    assert "pool" in response.json()
+
+@pytest.fixture
+def entry_payload():
+    """Minimal payload that can create an entry: the optional metrics are NOT NULL in the database"""
+    return {
+        "uid": "user123",
+        "date": "2024-01-15",
+        "mood": 8,
+        "pain": 2,
+        "energy": 7,
+        "physical_activity": 1,
+        "step_count": 5000,
+        "weather_enjoyment": 6,
+        "allergy_state": 1,
+        "allergy_medication": 0,
+        "had_sex": 1,
+        "sexual_wellbeing": 9,
+        "sleep_quality": 8,
+        "stress_level_work": 3,
+        "stress_level_home": 2,
+    }
+
+
+def test_batch_submit_reports_operation_per_entry(client, mock_session, entry_payload):
+    """Test that the batch endpoint reports created/updated for every submitted entry"""
+
+    second_payload = dict(entry_payload, date="2024-01-16")
+    mock_session.execute.return_value.all.return_value = [
+        Mock(id="id-1", uid="user123", date="2024-01-15", inserted=True),
+        Mock(id="id-2", uid="user123", date="2024-01-16", inserted=False),
+    ]
+
+    app.dependency_overrides[get_session] = lambda: mock_session
+
+    try:
+        response = client.post("/entries/batch", json=[entry_payload, second_payload])
+
+        print(f"Response status: {response.status_code}")
+        print(f"Response content: {response.text}")
+
+        assert response.status_code == status.HTTP_200_OK
+        data = response.json()
+        assert data["created"] == 1
+        assert data["updated"] == 1
+        assert [r["operation"] for r in data["results"]] == ["created", "updated"]
+        assert data["results"][1]["id"] == "id-2"
+
+        # Both entries set the same fields, so they are written with a single statement
+        mock_session.execute.assert_called_once()
+        mock_session.commit.assert_called_once()
+
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_batch_submit_rejects_duplicates_before_writing(client, mock_session, entry_payload):
+    """Test that a batch with two entries for the same user and day is rejected as a whole"""
+
+    app.dependency_overrides[get_session] = lambda: mock_session
+
+    try:
+        response = client.post("/entries/batch", json=[entry_payload, entry_payload])
+
+        print(f"Response status: {response.status_code}")
+        print(f"Response content: {response.text}")
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "duplicate" in response.json()["detail"][0]
+        mock_session.execute.assert_not_called()
+        mock_session.commit.assert_not_called()
+
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_batch_submit_duplicates_with_unpadded_date(client, mock_session, entry_payload):
+    """Test that '2024-1-15' and '2024-01-15' are the same day for the duplicate check"""
+
+    app.dependency_overrides[get_session] = lambda: mock_session
+
+    try:
+        unpadded_payload = dict(entry_payload, date="2024-1-15")
+        response = client.post("/entries/batch", json=[entry_payload, unpadded_payload])
+
+        print(f"Response status: {response.status_code}")
+        print(f"Response content: {response.text}")
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "duplicate" in response.json()["detail"][0]
+        mock_session.execute.assert_not_called()
+
+    finally:
+        app.dependency_overrides.clear()
+
+
+@pytest.mark.parametrize("inserted,expected_status,expected_operation", [
+    (True, status.HTTP_201_CREATED, "created"),
+    (False, status.HTTP_200_OK, "updated"),
+])
+def test_submit_entry_single_upsert(client, mock_session, sample_health_entry, inserted, expected_status, expected_operation):
+    """Test that submitting an entry is one upsert statement, and X-Operation reflects its outcome"""
+
+    row = sample_health_entry.model_dump()
+    row["inserted"] = inserted
+    mock_session.execute.return_value.one.return_value = Mock(_mapping=row)
+
+    app.dependency_overrides[get_session] = lambda: mock_session
+
+    try:
+        payload = {key: value for key, value in row.items() if key not in ("id", "inserted", "timestamp")}
+        response = client.post("/entries/", json=payload)
+
+        print(f"Response status: {response.status_code}")
+        print(f"Response content: {response.text}")
+
+        assert response.status_code == expected_status
+        assert response.headers["X-Operation"] == expected_operation
+        assert response.json()["id"] == "test-uuid-123"
+
+        # No SELECT before the write, and no refresh after it
+        mock_session.execute.assert_called_once()
+        mock_session.exec.assert_not_called()
+        mock_session.refresh.assert_not_called()
+
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_export_csv_streams_chunks(client, mock_session, sample_health_entry):
+    """Test that the CSV export writes the header, then one chunk per cursor partition"""
+
+    row = Mock(**{column: getattr(sample_health_entry, column) for column in sample_health_entry.model_dump()})
+    row.activities_bits = 0b100
+
+    exists_result = Mock()
+    exists_result.first.return_value = ("test-uuid-123",)
+    keys_result = Mock()
+    keys_result.all.return_value = [("gaming", 0), ("reading", 2)]
+    rows_result = Mock()
+    rows_result.partitions.return_value = iter([[row], [row]])
+    mock_session.execute.side_effect = [exists_result, keys_result, rows_result]
+
+    app.dependency_overrides[get_session] = lambda: mock_session
+
+    try:
+        response = client.get("/export/csv?uid=user123")
+
+        print(f"Response status: {response.status_code}")
+        print(f"Response content: {response.text}")
+
+        assert response.status_code == status.HTTP_200_OK
+        lines = response.text.splitlines()
+        header = lines[0].split(",")
+        assert header[-2:] == ["gaming", "reading"]
+        assert len(lines) == 3
+
+        values = dict(zip(header, lines[1].split(",")))
+        assert values["step_count"] == "8500"
+        assert values["day_name"] == "Tuesday"
+        assert values["gaming"] == "0"
+        assert values["reading"] == "1"
+
+        mock_session.close.assert_called_once()
+
+    finally:
+        app.dependency_overrides.clear()
+
+
+@pytest.mark.parametrize("path", ["/export/json", "/export/ndjson"])
+def test_export_json_formats_stream_all_rows(client, mock_session, sample_health_entry, path):
+    """Test that the JSON array and NDJSON exports stream every row with its computed properties"""
+
+    row = Mock(_mapping=sample_health_entry.model_dump())
+
+    exists_result = Mock()
+    exists_result.first.return_value = ("test-uuid-123",)
+    rows_result = Mock()
+    rows_result.partitions.return_value = iter([[row, row], [row]])
+    mock_session.execute.side_effect = [exists_result, rows_result]
+
+    app.dependency_overrides[get_session] = lambda: mock_session
+
+    try:
+        response = client.get(f"{path}?uid=user123&start_date=2024-01-01&end_date=2024-01-31")
+
+        print(f"Response status: {response.status_code}")
+        print(f"Response content: {response.text}")
+
+        assert response.status_code == status.HTTP_200_OK
+        if path == "/export/json":
+            entries = response.json()
+        else:
+            entries = [json.loads(line) for line in response.text.splitlines()]
+        assert len(entries) == 3
+        assert entries[0]["uid"] == "user123"
+        assert entries[0]["day_name"] == "Tuesday"
+        assert entries[0]["is_weekend"] is False
+
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_export_json_no_data(client, mock_session):
+    """Test that the JSON export returns 404 if no entry matches the filters"""
+
+    mock_session.execute.return_value.first.return_value = None
+
+    app.dependency_overrides[get_session] = lambda: mock_session
+
+    try:
+        response = client.get("/export/json?uid=nobody")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_export_columnar_npz(client, mock_session):
+    """Test that the columnar export returns one typed array per column"""
+
+    exists_result = Mock()
+    exists_result.first.return_value = ("test-uuid-123",)
+    keys_result = Mock()
+    keys_result.all.return_value = [("reading", 0)]
+    rows_result = Mock()
+    # uid, day number, day_of_week, the metrics, then one flag per activity
+    rows_result.partitions.return_value = iter([
+        [("user123", 19737, 0) + tuple(range(13)) + (1,)],
+        [("user456", 19738, 1) + (-1,) * 13 + (0,)],
+    ])
+    mock_session.execute.side_effect = [exists_result, keys_result, rows_result]
+
+    app.dependency_overrides[get_session] = lambda: mock_session
+
+    try:
+        response = client.get("/export/columnar")
+
+        print(f"Response status: {response.status_code}")
+
+        assert response.status_code == status.HTTP_200_OK
+        arrays = np.load(io.BytesIO(response.content), allow_pickle=False)
+        assert arrays["date"].dtype == np.int32
+        assert arrays["date"].tolist() == [19737, 19738]
+        assert arrays["mood"].dtype == np.int16
+        assert arrays["mood"].tolist() == [0, -1]
+        assert arrays["step_count"].tolist() == [11, -1]
+        assert arrays["uid"][arrays["uid_index"]].tolist() == ["user123", "user456"]
+        assert arrays["activity_names"].tolist() == ["reading"]
+        assert arrays["activities"].dtype == np.uint8
+        assert arrays["activities"].tolist() == [[1], [0]]
+
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_submit_entry_normalizes_date(client, mock_session, sample_health_entry):
+    """Test that an unpadded date is written zero-padded, so it hits the same (uid, date) row"""
+
+    row = sample_health_entry.model_dump()
+    row["inserted"] = False
+    mock_session.execute.return_value.one.return_value = Mock(_mapping=row)
+
+    app.dependency_overrides[get_session] = lambda: mock_session
+
+    try:
+        payload = {key: value for key, value in row.items() if key not in ("id", "inserted", "timestamp")}
+        payload["date"] = "2024-1-5"
+        response = client.post("/entries/", json=payload)
+
+        print(f"Response status: {response.status_code}")
+
+        assert response.status_code == status.HTTP_200_OK
+        params = mock_session.execute.call_args[0][0].compile().params
+        print(f"Statement parameters: {params}")
+        assert params["date_m0"] == "2024-01-05"
+        # 2024-01-05 was a Friday
+        assert params["day_of_week_m0"] == 4
+
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_stats_responses_cached_until_write(client, mock_session, sample_health_entry):
+    """Test that a repeated stats request skips the database, and a write for the user invalidates it"""
+
+    row = sample_health_entry.model_dump()
+    row["inserted"] = False
+    mock_session.execute.return_value.one.return_value = Mock(_mapping=row)
+
+    app.dependency_overrides[get_session] = lambda: mock_session
+    stats_cache.clear()
+
+    try:
+        first = client.get("/stats/weekday-averages", params={"uid": "user123"})
+        second = client.get("/stats/weekday-averages", params={"uid": "user123"})
+
+        print(f"Cache info: {stats_cache.info()}")
+
+        assert first.json() == second.json()
+        assert mock_session.exec.call_count == 1
+
+        payload = {key: value for key, value in row.items() if key not in ("id", "inserted", "timestamp")}
+        assert client.post("/entries/", json=payload).status_code == status.HTTP_200_OK
+
+        client.get("/stats/weekday-averages", params={"uid": "user123"})
+        assert mock_session.exec.call_count == 2
+
+    finally:
+        app.dependency_overrides.clear()
+        stats_cache.clear()
+
+
+def test_entries_conditional_get(client, mock_session, sample_health_entry):
+    """Test that GET /entries/ answers 304 from the user's data version alone, without querying entries"""
+
+    mock_session.exec.return_value.first.return_value = (3, datetime(2024, 1, 15, 8, 0, tzinfo=timezone.utc))
+    mock_session.exec.return_value.all.return_value = [sample_health_entry]
+
+    app.dependency_overrides[get_session] = lambda: mock_session
+
+    try:
+        first = client.get("/entries/", params={"uid": "user123"})
+        etag = first.headers["ETag"]
+
+        print(f"Response headers: {dict(first.headers)}")
+
+        assert first.status_code == status.HTTP_200_OK
+        assert etag.startswith('W/"')
+        assert first.headers["Last-Modified"] == "Mon, 15 Jan 2024 08:00:00 GMT"
+
+        # Only the version lookup runs for a matching If-None-Match or If-Modified-Since
+        for headers in ({"If-None-Match": etag}, {"If-Modified-Since": first.headers["Last-Modified"]}):
+            mock_session.exec.reset_mock()
+            response = client.get("/entries/", params={"uid": "user123"}, headers=headers)
+            assert response.status_code == status.HTTP_304_NOT_MODIFIED
+            assert response.content == b""
+            assert response.headers["ETag"] == etag
+            mock_session.exec.assert_called_once()
+
+        # A write of the user changes the ETag
+        mock_session.exec.return_value.first.return_value = (4, datetime(2024, 1, 16, 8, 0, tzinfo=timezone.utc))
+        response = client.get("/entries/", params={"uid": "user123"}, headers={"If-None-Match": etag})
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["ETag"] != etag
+        assert len(response.json()) == 1
 
     finally:
-        app.dependency_overrides.clear()
\ No newline at end of file
+        app.dependency_overrides.clear()
+
+
+def test_metrics_count_requests_by_route_template(client, mock_session):
+    """Test that /metrics reports requests per route template and status, not per path"""
+
+    app.dependency_overrides[get_session] = lambda: mock_session
+
+    try:
+        assert client.get("/entries/some-missing-id").status_code == status.HTTP_404_NOT_FOUND
+
+        response = client.get("/metrics")
+        print(f"Metrics content type: {response.headers['content-type']}")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["content-type"].startswith("text/plain")
+        assert 'pa_http_requests_total{method="GET",route="/entries/{entry_id}",status="404"}' in response.text
+        assert "some-missing-id" not in response.text
+
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_server_timing_header(client, mock_session, sample_health_entry):
+    """Test that responses report database, handler and serialization time in Server-Timing"""
+
+    mock_session.exec.return_value.first.return_value = sample_health_entry
+    app.dependency_overrides[get_session] = lambda: mock_session
+
+    try:
+        response = client.get("/entries/test-id-123")
+        server_timing = response.headers["server-timing"]
+        print(f"Server-Timing: {server_timing}")
+
+        assert response.status_code == status.HTTP_200_OK
+        names = [part.split(";")[0] for part in server_timing.split(", ")]
+        assert names == ["db", "handler", "serialize", "total"]
+        assert 'desc="0 queries"' in server_timing
+
+        # Requests that match no route still get the database and total time
+        server_timing = client.get("/no-such-path").headers["server-timing"]
+        assert [part.split(";")[0] for part in server_timing.split(", ")] == ["db", "total"]
+
+    finally:
+        app.dependency_overrides.clear()
+
+
+@pytest.mark.parametrize("pgbouncer", [False, True])
+def test_pool_options_from_settings(monkeypatch, pgbouncer):
+    """Test that the pool settings reach the engine options, and that PgBouncer mode does not pool"""
+    monkeypatch.setenv("PA_DB_POOL_SIZE", "3")
+    monkeypatch.setenv("PA_DB_MAX_OVERFLOW", "2")
+    monkeypatch.setenv("PA_DB_POOL_RECYCLE", "600")
+    monkeypatch.setenv("PA_DB_PGBOUNCER", "true" if pgbouncer else "false")
+
+    options = database_module._pool_options(InstrumentedQueuePool)
+    print(f"Pool options: {options}")
+
+    if pgbouncer:
+        assert options == {"poolclass": NullPool}
+    else:
+        assert options == {
+            "poolclass": InstrumentedQueuePool,
+            "pool_size": 3,
+            "max_overflow": 2,
+            "pool_timeout": 30.0,
+            "pool_recycle": 600,
+            "pool_pre_ping": True,
+        }
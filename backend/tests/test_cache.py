@@ -0,0 +1,87 @@
+from unittest.mock import Mock
+
+from src.personal_analytics_backend.cache import StatsCache
+
+
+def test_lru_eviction_and_counters():
+    """Test that the least recently used entry is evicted and hits and misses are counted"""
+    cache = StatsCache(max_entries=2)
+    cache.put(("a", "summary", 0), 1, version=0)
+    cache.put(("b", "summary", 0), 2, version=0)
+    assert cache.get(("a", "summary", 0)) == (True, 1)  # a is now the most recently used
+    cache.put(("c", "summary", 0), 3, version=0)
+
+    assert cache.get(("b", "summary", 0)) == (False, None)
+    assert cache.get(("a", "summary", 0)) == (True, 1)
+    assert cache.get(("c", "summary", 0)) == (True, 3)
+    assert cache.info() == {"hits": 3, "misses": 1, "size": 2, "max_size": 2}
+
+
+def test_bump_version_drops_user_entries():
+    """Test that a version bump drops the user's entries, and stale results are not stored"""
+    cache = StatsCache(max_entries=10)
+    cache.put(("a", "summary", 0), 1, version=cache.version("a"))
+    cache.put(("b", "summary", 0), 2, version=cache.version("b"))
+
+    stale_version = cache.version("a")
+    cache.bump_version("a")
+    cache.put(("a", "weekday", 0), 3, version=stale_version)  # computed before the bump, arrives after it
+
+    assert cache.version("a") == 1
+    assert cache.info()["size"] == 1
+    assert cache.get(("b", "summary", 0)) == (True, 2)
+    assert cache.get(("a", "weekday", 0)) == (False, None)
+
+
+def test_cached_decorator_keys_on_parameters():
+    """Test that the decorator caches per parameter set, ignoring the session, until the version changes"""
+    cache = StatsCache(max_entries=10)
+    calls = []
+
+    @cache.cached
+    def endpoint(uid: str, max_lag: int = 7, session=None):
+        calls.append((uid, max_lag))
+        return {"uid": uid, "max_lag": max_lag}
+
+    assert endpoint(uid="a", max_lag=7, session=object()) == {"uid": "a", "max_lag": 7}
+    assert endpoint(uid="a", max_lag=7, session=object()) == {"uid": "a", "max_lag": 7}
+    endpoint(uid="a", max_lag=3, session=object())
+    cache.bump_version("a")
+    endpoint(uid="a", max_lag=7, session=object())
+
+    assert calls == [("a", 7), ("a", 3), ("a", 7)]
+
+
+def test_size_zero_disables_cache():
+    """Test that nothing is stored with max_entries 0"""
+    cache = StatsCache(max_entries=0)
+    cache.put(("a", "summary", 0), 1, version=0)
+    assert cache.get(("a", "summary", 0)) == (False, None)
+
+
+def test_versions_read_from_database_while_not_listening():
+    """Test that without the invalidation listener, a changed version in the database is a miss"""
+    cache = StatsCache(max_entries=10)
+    cache.set_listening(False)
+    session = Mock()
+    calls = []
+
+    @cache.cached
+    def endpoint(uid: str, session=None):
+        calls.append(uid)
+        return len(calls)
+
+    session.exec.return_value.first.return_value = 4
+    assert endpoint(uid="a", session=session) == 1
+    assert endpoint(uid="a", session=session) == 1
+    # Another worker wrote an entry of the user
+    session.exec.return_value.first.return_value = 5
+    assert endpoint(uid="a", session=session) == 2
+
+    # Listening again: the database is no longer asked
+    cache.set_listening(True)
+    session.exec.reset_mock()
+    endpoint(uid="a", session=session)
+    endpoint(uid="a", session=session)
+    assert len(calls) == 3
+    session.exec.assert_not_called()
@@ -0,0 +1,915 @@
+"""
+Tests for the schema migrations, and the parts of the app that rely on them, that need a real
+PostgreSQL server.
+
+They use the database from PA_DATABASE_URL (see the CI workflow), but work in a throwaway schema
+so they do not touch the tables of the app. They are skipped if the database is not reachable.
+"""
+
+import io
+import json
+from datetime import date, timedelta
+import time
+import uuid
+from collections import defaultdict
+from typing import List
+
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from sqlalchemy import exc as sqlalchemy_exc
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.personal_analytics_backend.settings import settings
+from src.personal_analytics_backend.migrations import MIGRATIONS, STATS_INDEX_INCLUDE_COLUMNS, run_migrations
+from src.personal_analytics_backend import api
+from src.personal_analytics_backend.api import app, CORRELATION_METRICS
+from src.personal_analytics_backend.database import get_session, get_async_session, async_if_enabled
+from src.personal_analytics_backend.models import HealthEntryRead
+from src.personal_analytics_backend.cache import StatsCache, stats_cache
+from src.personal_analytics_backend.invalidation import InvalidationListener
+from src.personal_analytics_backend.metrics import InstrumentedQueuePool, instrument_engine
+from src.personal_analytics_backend.profiling import profile_engine
+from prometheus_client import REGISTRY
+
+
+SEED_USERS = 60
+SEED_DAYS = 730
+
+
+@pytest.fixture(scope="module")
+def migrated_engine():
+    """Engine whose search_path points at a fresh schema with all migrations applied"""
+    schema = f"pa_test_{uuid.uuid4().hex[:12]}"
+    admin_engine = create_engine(settings.database_url, isolation_level="AUTOCOMMIT")
+    try:
+        with admin_engine.connect() as connection:
+            connection.execute(text(f"CREATE SCHEMA {schema}"))
+    except OperationalError:
+        pytest.skip("PostgreSQL database from PA_DATABASE_URL is not reachable")
+
+    engine = create_engine(settings.database_url, connect_args={"options": f"-csearch_path={schema}"})
+    try:
+        run_migrations(engine)
+        yield engine
+    finally:
+        engine.dispose()
+        with admin_engine.connect() as connection:
+            connection.execute(text(f"DROP SCHEMA {schema} CASCADE"))
+        admin_engine.dispose()
+
+
+@pytest.fixture(scope="module")
+def seeded_engine(migrated_engine):
+    """The migrated engine, with a large table of entries for many users"""
+    with migrated_engine.begin() as connection:
+        connection.execute(text("""
+            INSERT INTO healthentry (
+                id, uid, date, timestamp, day_of_week, mood, pain, energy, allergy_state,
+                allergy_medication, had_sex, sexual_wellbeing, sleep_quality, stress_level_work,
+                stress_level_home, physical_activity, step_count, weather_enjoyment, daily_activities
+            )
+            SELECT
+                md5(u::text || '-' || d::text), 'user' || u, to_char(day, 'YYYY-MM-DD'), day,
+                extract(isodow FROM day)::int - 1, (u + d) % 11, (u * d) % 11, d % 11, d % 3,
+                u % 5, d % 2, (u + 2 * d) % 11, (3 * d) % 11, (u + d) % 7, d % 5,
+                d % 4, (d * 37) % 10000, (u * 7 + d) % 11, '{"outdoor": 1, "reading": 0}'::jsonb
+            FROM generate_series(1, :users) AS u,
+                 generate_series(0, :days - 1) AS d,
+                 LATERAL (SELECT date '2022-01-01' + d AS day) AS days
+        """), {"users": SEED_USERS, "days": SEED_DAYS})
+
+    # VACUUM sets the visibility map, which index-only scans depend on. It cannot run in a transaction.
+    with migrated_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("VACUUM ANALYZE healthentry"))
+        connection.execute(text("VACUUM ANALYZE user_metric_stats"))
+
+    return migrated_engine
+
+
+def _plan_nodes(plan):
+    """All nodes of an EXPLAIN (FORMAT JSON) plan tree, depth first"""
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def test_migrations_are_recorded_and_idempotent(migrated_engine):
+    """Test that all migrations are recorded once, and a second run applies nothing"""
+    assert run_migrations(migrated_engine) == []
+
+    with migrated_engine.connect() as connection:
+        versions = connection.execute(text("SELECT version FROM schema_migrations ORDER BY version")).scalars().all()
+    assert versions == [version for version, _, _ in MIGRATIONS]
+
+
+def test_entries_are_unique_per_user_and_date(migrated_engine):
+    """Test that two users can have an entry for the same date, but one user cannot have two"""
+    with migrated_engine.connect() as connection:
+        indexes = dict(connection.execute(text(
+            "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = 'healthentry'"
+        )).all())
+
+    assert "UNIQUE INDEX uq_healthentry_uid_date ON" in indexes["uq_healthentry_uid_date"]
+    assert "(uid, date)" in indexes["uq_healthentry_uid_date"]
+    # The old global unique index on date must be gone
+    assert "ix_healthentry_date" not in indexes
+    # The GIN index on daily_activities was replaced by activities_bits
+    assert "ix_healthentry_daily_activities" not in indexes
+
+
+def test_covering_index_matches_models(migrated_engine):
+    """Test that the migrated index includes exactly the columns models.py declares"""
+    with migrated_engine.connect() as connection:
+        indexdef = connection.execute(text(
+            "SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND indexname = 'uq_healthentry_uid_date'"
+        )).scalar()
+
+    print(f"Index definition: {indexdef}")
+    assert indexdef.endswith(f"INCLUDE ({', '.join(STATS_INDEX_INCLUDE_COLUMNS)})")
+
+
+# Representative versions of the queries behind the /entries/ and /stats/* endpoints.
+WORKLOAD_QUERIES = {
+    "entries": "SELECT * FROM healthentry WHERE uid = :uid ORDER BY date DESC LIMIT 100",
+    "entries_today": "SELECT * FROM healthentry WHERE uid = :uid AND date = '2023-06-01'",
+    "metrics_over_time": """
+        SELECT date, mood, pain, energy, sleep_quality, sexual_wellbeing FROM healthentry
+        WHERE uid = :uid AND date >= '2023-06-01' AND date <= '2023-07-01' ORDER BY date
+    """,
+    "user_metric_stats": """
+        SELECT * FROM user_metric_stats
+        WHERE uid = :uid AND day_of_week <> -1 AND metric_a = metric_b
+    """,
+    "date_range": "SELECT min(date), max(date) FROM healthentry WHERE uid = :uid",
+    "metric_matrix": """
+        SELECT date, mood, pain, energy, sleep_quality, sexual_wellbeing, stress_level_work, stress_level_home
+        FROM healthentry WHERE uid = :uid ORDER BY date
+    """,
+    "activities": "SELECT date, mood, pain, activities_bits FROM healthentry WHERE uid = :uid",
+}
+
+
+@pytest.mark.parametrize("query_name", sorted(WORKLOAD_QUERIES))
+def test_workload_queries_use_indexes(seeded_engine, query_name):
+    """Test that the per-user queries are served by index scans, not sequential scans"""
+    with seeded_engine.connect() as connection:
+        plan_json = connection.execute(
+            text("EXPLAIN (FORMAT JSON) " + WORKLOAD_QUERIES[query_name]), {"uid": "user7"}
+        ).scalar()
+
+    if isinstance(plan_json, str):
+        plan_json = json.loads(plan_json)
+    node_types = [node["Node Type"] for node in _plan_nodes(plan_json[0]["Plan"])]
+    print(f"Plan node types for {query_name}: {node_types}")
+
+    assert "Seq Scan" not in node_types
+    assert any(node_type in ("Index Scan", "Index Only Scan", "Bitmap Index Scan") for node_type in node_types)
+
+
+@pytest.mark.parametrize("query_name", ["date_range", "metric_matrix", "metrics_over_time", "activities"])
+def test_stats_queries_are_index_only(seeded_engine, query_name):
+    """Test that the stats queries on healthentry are answered from the covering index alone"""
+    with seeded_engine.connect() as connection:
+        plan_json = connection.execute(
+            text("EXPLAIN (FORMAT JSON) " + WORKLOAD_QUERIES[query_name]), {"uid": "user7"}
+        ).scalar()
+
+    if isinstance(plan_json, str):
+        plan_json = json.loads(plan_json)
+    node_types = [node["Node Type"] for node in _plan_nodes(plan_json[0]["Plan"])]
+    print(f"Plan node types for {query_name}: {node_types}")
+
+    assert "Index Only Scan" in node_types
+
+
+STATS_METRICS = ["mood", "pain", "energy", "sleep_quality", "sexual_wellbeing",
+                 "stress_level_work", "stress_level_home", "step_count"]
+
+
+def _expected_user_metric_stats(connection, uid):
+    """user_metric_stats for a user, aggregated from scratch in Python from the user's entries"""
+    entries = connection.execute(
+        text(f"SELECT day_of_week, {', '.join(STATS_METRICS)} FROM healthentry WHERE uid = :uid"), {"uid": uid}
+    ).mappings().all()
+
+    expected = defaultdict(lambda: [0] * 6)
+    for entry in entries:
+        values = {"*": 1, **{metric: entry[metric] for metric in STATS_METRICS}}
+        for day_of_week in (-1, entry["day_of_week"]):
+            for metric_a, a in values.items():
+                for metric_b, b in values.items():
+                    if metric_a != metric_b and (day_of_week != -1 or "*" in (metric_a, metric_b) or metric_a > metric_b):
+                        continue
+                    sums = expected[(day_of_week, metric_a, metric_b)]
+                    for k, value in enumerate((1, a, b, a * a, b * b, a * b)):
+                        sums[k] += value
+    return {key: tuple(sums) for key, sums in expected.items()}
+
+
+def _actual_user_metric_stats(connection, uid):
+    """Nonempty rows of user_metric_stats for a user"""
+    rows = connection.execute(text("""
+        SELECT day_of_week, metric_a, metric_b, n, sum_a, sum_b, sum_aa, sum_bb, sum_ab
+        FROM user_metric_stats WHERE uid = :uid AND n <> 0
+    """), {"uid": uid}).all()
+    return {tuple(row[:3]): tuple(row[3:]) for row in rows}
+
+
+TRIGGER_TEST_INSERT = """
+    INSERT INTO healthentry (
+        id, uid, date, timestamp, day_of_week, mood, pain, energy, allergy_state,
+        allergy_medication, had_sex, sexual_wellbeing, sleep_quality, stress_level_work,
+        stress_level_home, physical_activity, step_count, weather_enjoyment
+    )
+    SELECT
+        'trigger-' || d, 'trigger-user', to_char(day, 'YYYY-MM-DD'), day,
+        extract(isodow FROM day)::int - 1, d % 11, (d * d) % 11, (d + :offset) % 11, 0, 0, 0,
+        (2 * d) % 11, (3 * d + :offset) % 11, d % 7, d % 5, 0, (d * 37 + :offset) % 10000, 5
+    FROM generate_series(0, :days - 1) AS d, LATERAL (SELECT date '2024-01-01' + d AS day) AS days
+    ON CONFLICT (uid, date) DO UPDATE SET
+        mood = EXCLUDED.mood, pain = EXCLUDED.pain, energy = EXCLUDED.energy,
+        sleep_quality = EXCLUDED.sleep_quality, step_count = EXCLUDED.step_count
+"""
+
+
+def test_user_metric_stats_follow_every_write(migrated_engine):
+    """Test that inserts, upserts, updates and deletes keep user_metric_stats equal to a fresh aggregate"""
+    uid = "trigger-user"
+    writes = [
+        ("insert", TRIGGER_TEST_INSERT, {"offset": 0, "days": 50}),
+        ("upsert", TRIGGER_TEST_INSERT, {"offset": 3, "days": 80}),
+        ("update", "UPDATE healthentry SET pain = 10 - pain, day_of_week = 6 WHERE uid = :uid AND mood > 5", {}),
+        ("delete", "DELETE FROM healthentry WHERE uid = :uid AND date < '2024-02-01'", {}),
+    ]
+    for name, sql, params in writes:
+        with migrated_engine.begin() as connection:
+            connection.execute(text(sql), {"uid": uid, **params})
+        with migrated_engine.connect() as connection:
+            expected = _expected_user_metric_stats(connection, uid)
+            print(f"After {name}: {len(expected)} stats rows")
+            assert _actual_user_metric_stats(connection, uid) == expected
+
+    with migrated_engine.begin() as connection:
+        connection.execute(text("DELETE FROM healthentry WHERE uid = :uid"), {"uid": uid})
+    with migrated_engine.connect() as connection:
+        assert _actual_user_metric_stats(connection, uid) == {}
+
+
+def _expected_streaks(connection, uid):
+    """Runs of consecutive entry days of the user, computed from the entries in Python"""
+    days = connection.execute(
+        text("SELECT date::date AS day FROM healthentry WHERE uid = :uid ORDER BY day"), {"uid": uid}
+    ).scalars().all()
+    runs = []
+    for day in days:
+        if runs and runs[-1][1] == day - timedelta(days=1):
+            runs[-1] = (runs[-1][0], day, runs[-1][2] + 1)
+        else:
+            runs.append((day, day, 1))
+    return runs
+
+
+def test_user_streaks_follow_every_write(migrated_engine):
+    """Test that inserts, backfills, updates and deletes keep user_streak equal to the runs of entry days"""
+    uid = "trigger-user"
+    writes = [
+        ("insert", TRIGGER_TEST_INSERT, {"offset": 0, "days": 50}),
+        ("upsert", TRIGGER_TEST_INSERT, {"offset": 3, "days": 80}),
+        ("gaps", "DELETE FROM healthentry WHERE uid = :uid AND date IN ('2024-01-10', '2024-02-01', '2024-02-02')", {}),
+        ("fill gap", TRIGGER_TEST_INSERT, {"offset": 1, "days": 35}),
+        ("move", "UPDATE healthentry SET date = '2024-06-01' WHERE uid = :uid AND date = '2024-01-20'", {}),
+        ("metrics only", "UPDATE healthentry SET mood = 10 - mood WHERE uid = :uid", {}),
+        ("split", "DELETE FROM healthentry WHERE uid = :uid AND date LIKE '%5'", {}),
+    ]
+    for name, sql, params in writes:
+        with migrated_engine.begin() as connection:
+            connection.execute(text(sql), {"uid": uid, **params})
+        with migrated_engine.connect() as connection:
+            expected = _expected_streaks(connection, uid)
+            actual = connection.execute(text(
+                "SELECT start_date, end_date, length FROM user_streak WHERE uid = :uid ORDER BY start_date"
+            ), {"uid": uid}).all()
+            print(f"After {name}: {len(expected)} streaks")
+            assert [tuple(row) for row in actual] == expected
+
+    with migrated_engine.begin() as connection:
+        connection.execute(text("DELETE FROM healthentry WHERE uid = :uid"), {"uid": uid})
+    with migrated_engine.connect() as connection:
+        assert connection.execute(text("SELECT count(*) FROM user_streak WHERE uid = :uid"), {"uid": uid}).scalar() == 0
+
+
+def test_user_streaks_with_unpadded_legacy_dates(migrated_engine):
+    """Test that entries with legacy dates like '2024-3-2' join the streaks of padded dates"""
+    uid = "legacy-user"
+    insert = TRIGGER_TEST_INSERT.replace("'trigger-' || d", "'legacy-' || d").replace("'trigger-user'", ":uid")
+    writes = [
+        ("padded", insert, {"offset": 0, "days": 40}),
+        ("unpadded", "UPDATE healthentry SET date = '2024-2-5' WHERE uid = :uid AND date = '2024-02-05'", {}),
+        ("gap", "DELETE FROM healthentry WHERE uid = :uid AND date IN ('2024-01-20', '2024-02-04')", {}),
+        ("legacy fills gap", """
+            INSERT INTO healthentry (id, uid, date, timestamp, mood, pain, energy, allergy_state, allergy_medication,
+                had_sex, sexual_wellbeing, sleep_quality, stress_level_work, stress_level_home, physical_activity,
+                step_count, weather_enjoyment)
+            VALUES ('legacy-x', :uid, '2024-2-4', now(), 5, 5, 5, 0, 0, 0, 5, 5, 5, 5, 0, 0, 5)
+        """, {}),
+        ("delete legacy", "DELETE FROM healthentry WHERE uid = :uid AND date = '2024-2-5'", {}),
+    ]
+    try:
+        for name, sql, params in writes:
+            with migrated_engine.begin() as connection:
+                connection.execute(text(sql), {"uid": uid, **params})
+            with migrated_engine.connect() as connection:
+                expected = _expected_streaks(connection, uid)
+                actual = connection.execute(text(
+                    "SELECT start_date, end_date, length FROM user_streak WHERE uid = :uid ORDER BY start_date"
+                ), {"uid": uid}).all()
+                print(f"After {name}: {expected}")
+                assert [tuple(row) for row in actual] == expected
+        assert [length for _, _, length in expected] == [19, 15, 4]
+    finally:
+        with migrated_engine.begin() as connection:
+            connection.execute(text("DELETE FROM healthentry WHERE uid = :uid"), {"uid": uid})
+
+
+def test_streak_rebuild_finds_legacy_dates_through_partial_index(seeded_engine):
+    """Test that the rebuild's lookup of unpadded dates reads the partial index, not all entries of the user"""
+    with seeded_engine.connect() as connection:
+        plan = connection.execute(text("""
+            EXPLAIN (FORMAT JSON) SELECT h.date::date FROM healthentry AS h
+            WHERE h.uid = :uid AND length(h.date) <> 10 AND h.date::date BETWEEN date '2023-01-01' AND date '2023-01-03'
+        """), {"uid": "user7"}).scalar()
+    index_names = [node.get("Index Name") for node in _plan_nodes(plan[0]["Plan"])]
+    print(f"Indexes used: {index_names}")
+    assert "ix_healthentry_unpadded_date" in index_names
+
+
+@pytest.fixture
+def seeded_client(seeded_engine):
+    """Test client whose sessions use the seeded test schema"""
+    def get_test_session():
+        with Session(seeded_engine) as session:
+            yield session
+
+    app.dependency_overrides[get_session] = get_test_session
+    stats_cache.clear()
+    try:
+        yield TestClient(app)
+    finally:
+        app.dependency_overrides.clear()
+        stats_cache.clear()
+
+
+def test_stats_endpoints_match_raw_data(seeded_engine, seeded_client):
+    """Test that summary, weekday averages and Pearson correlations from user_metric_stats match the entries"""
+    uid = "user7"
+    with seeded_engine.connect() as connection:
+        raw = connection.execute(text("""
+            SELECT count(*) AS total, min(date) AS first, max(date) AS last,
+                   avg(mood) AS mood, avg(pain) AS pain, avg(energy) AS energy, avg(sexual_wellbeing) AS sexual_wellbeing
+            FROM healthentry WHERE uid = :uid
+        """), {"uid": uid}).mappings().one()
+        raw_weekdays = connection.execute(text("""
+            SELECT day_of_week, avg(mood) AS mood, avg(sleep_quality) AS sleep_quality, count(*) AS total
+            FROM healthentry WHERE uid = :uid GROUP BY day_of_week ORDER BY day_of_week
+        """), {"uid": uid}).mappings().all()
+        values = np.array(connection.execute(
+            text(f"SELECT {', '.join(CORRELATION_METRICS)} FROM healthentry WHERE uid = :uid"), {"uid": uid}
+        ).all(), dtype=float)
+
+    summary = seeded_client.get("/stats/summary", params={"uid": uid}).json()
+    print(f"Summary: {summary}")
+    assert summary["total_entries"] == raw["total"]
+    assert summary["date_range"] == {"first": raw["first"], "last": raw["last"]}
+    for metric in ("mood", "pain", "energy", "sexual_wellbeing"):
+        assert summary["averages"][metric] == round(float(raw[metric]), 2)
+    # The seeded entries are one run of days that ended long ago
+    assert summary["longest_streak"] == {"length": SEED_DAYS, "start_date": raw["first"], "end_date": raw["last"]}
+    assert summary["current_streak"] == {"length": 0, "start_date": None, "end_date": None}
+
+    weekdays = seeded_client.get("/stats/weekday-averages", params={"uid": uid}).json()
+    assert [day["day_of_week"] for day in weekdays] == [row["day_of_week"] for row in raw_weekdays]
+    for day, row in zip(weekdays, raw_weekdays):
+        assert day["entry_count"] == row["total"]
+        assert day["avg_mood"] == round(float(row["mood"]), 2)
+        assert day["avg_sleep_quality"] == round(float(row["sleep_quality"]), 2)
+
+    pairs = seeded_client.get("/stats/correlations", params={"uid": uid}).json()
+    assert len(pairs) > 0
+    expected = np.corrcoef(values, rowvar=False)
+    for pair in pairs:
+        i, j = CORRELATION_METRICS.index(pair["metric1"]), CORRELATION_METRICS.index(pair["metric2"])
+        assert pair["sample_size"] == len(values)
+        assert pair["correlation"] == pytest.approx(expected[i, j], abs=1e-3)
+
+    assert seeded_client.get("/stats/correlations", params={"uid": "nobody"}).json() == {
+        "error": "Insufficient data for correlation analysis"
+    }
+
+    timeline = seeded_client.get(
+        "/stats/metrics-over-time", params={"uid": uid, "days": 100000, "metrics": ["step_count,mood", "pain"]}
+    ).json()
+    with seeded_engine.connect() as connection:
+        raw_timeline = connection.execute(
+            text("SELECT date, step_count, mood, pain FROM healthentry WHERE uid = :uid ORDER BY date"), {"uid": uid}
+        ).all()
+    assert list(timeline["metrics"]) == ["step_count", "mood", "pain"]
+    assert timeline["dates"] == [row.date for row in raw_timeline]
+    for metric in ("step_count", "mood", "pain"):
+        assert timeline["metrics"][metric] == [getattr(row, metric) for row in raw_timeline]
+
+
+def test_summary_current_and_longest_streak(seeded_engine, seeded_client):
+    """Test that the summary tells the streak up to today apart from the longest one"""
+    uid = "streak-user"
+    today = date.today()
+    days = [today - timedelta(days=offset) for offset in (0, 1, 2)] + [today - timedelta(days=offset) for offset in range(10, 15)]
+    try:
+        with seeded_engine.begin() as connection:
+            for day in days:
+                connection.execute(text(
+                    TRIGGER_TEST_INSERT.replace("'trigger-' || d", f"'streak-{day}'")
+                    .replace("'trigger-user'", ":uid").replace("date '2024-01-01'", f"date '{day}'")
+                ), {"uid": uid, "offset": 0, "days": 1})
+
+        summary = seeded_client.get("/stats/summary", params={"uid": uid}).json()
+        print(f"Summary: {summary}")
+        assert summary["current_streak"] == {"length": 3, "start_date": str(days[2]), "end_date": str(days[0])}
+        assert summary["longest_streak"] == {"length": 5, "start_date": str(days[-1]), "end_date": str(days[3])}
+
+        with seeded_engine.begin() as connection:
+            connection.execute(text("DELETE FROM healthentry WHERE uid = :uid AND date >= :day"), {"uid": uid, "day": str(days[1])})
+        stats_cache.bump_version(uid)  # As the invalidation listener would
+        summary = seeded_client.get("/stats/summary", params={"uid": uid}).json()
+        assert summary["current_streak"]["length"] == 0
+        assert summary["longest_streak"]["length"] == 5
+    finally:
+        with seeded_engine.begin() as connection:
+            connection.execute(text("DELETE FROM healthentry WHERE uid = :uid"), {"uid": uid})
+        stats_cache.bump_version(uid)
+    assert seeded_client.get("/stats/summary", params={"uid": uid}).json()["longest_streak"] is None
+
+
+def test_entries_keyset_pagination_with_fields(seeded_engine, seeded_client):
+    """Test that following X-Next-Cursor with a sparse fieldset returns every entry exactly once, in order"""
+    uid = "user11"
+    with seeded_engine.connect() as connection:
+        expected = [tuple(row) for row in connection.execute(
+            text("SELECT date, mood FROM healthentry WHERE uid = :uid AND date >= '2023-06-01' ORDER BY date DESC, id DESC"),
+            {"uid": uid}
+        )]
+
+    pages = []
+    params = {"uid": uid, "start_date": "2023-06-01", "limit": 97, "fields": "date,mood"}
+    while True:
+        response = seeded_client.get("/entries/", params=params)
+        assert response.status_code == 200
+        assert "etag" in response.headers
+        pages.append(response.json())
+        if "x-next-cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["x-next-cursor"]
+    print(f"{len(expected)} entries in {len(pages)} pages")
+
+    assert [len(page) for page in pages[:-1]] == [97] * (len(pages) - 1)
+    assert all(set(entry) == {"date", "mood"} for page in pages for entry in page)
+    assert [(entry["date"], entry["mood"]) for page in pages for entry in page] == expected
+
+    # The index takes the query straight to the page, with no rows skipped on the way
+    after_date, after_id = "2023-09-01", "~"
+    with seeded_engine.connect() as connection:
+        plan = connection.execute(text("""
+            EXPLAIN (ANALYZE, FORMAT JSON)
+            SELECT date, mood, id FROM healthentry
+            WHERE uid = :uid AND date <= :after_date AND (date, id) < (:after_date, :after_id)
+            ORDER BY date DESC, id DESC LIMIT 101
+        """), {"uid": uid, "after_date": after_date, "after_id": after_id}).scalar()
+    index_scans = [node for node in _plan_nodes(plan[0]["Plan"]) if "Index" in node["Node Type"]]
+    assert index_scans and index_scans[0]["Actual Rows"] <= 101 + 1
+
+
+def test_metrics_over_time_buckets_and_downsampling(seeded_engine, seeded_client):
+    """Test week and month aggregates against the raw entries, and that max_points keeps the extremes"""
+    uid = "user5"
+    with seeded_engine.connect() as connection:
+        raw = connection.execute(
+            text("SELECT date::date AS day, mood, energy FROM healthentry WHERE uid = :uid ORDER BY date"), {"uid": uid}
+        ).all()
+
+    for bucket, bucket_start in [("week", lambda day: day - timedelta(days=day.weekday())), ("month", lambda day: day.replace(day=1))]:
+        expected = defaultdict(list)
+        for row in raw:
+            expected[bucket_start(row.day).isoformat()].append(row.mood)
+
+        response = seeded_client.get(
+            "/stats/metrics-over-time", params={"uid": uid, "days": 100000, "bucket": bucket, "metrics": "mood,energy"}
+        )
+        data = response.json()
+        print(f"{bucket}: {len(data['dates'])} buckets")
+        assert response.status_code == 200
+        assert data["dates"] == sorted(expected)
+        assert data["metrics"]["mood"] == [round(sum(values) / len(values), 2) for values in expected.values()]
+        assert data["min"]["mood"] == [min(values) for values in expected.values()]
+        assert data["max"]["mood"] == [max(values) for values in expected.values()]
+        assert data["count"]["mood"] == [len(values) for values in expected.values()]
+
+    data = seeded_client.get(
+        "/stats/metrics-over-time", params={"uid": uid, "days": 100000, "metrics": "mood,energy", "max_points": 60}
+    ).json()
+    print(f"Downsampled {len(raw)} days to {len(data['dates'])}")
+    assert len(data["dates"]) <= 60
+    assert data["dates"] == sorted(data["dates"])
+    assert data["dates"][0] == raw[0].day.isoformat() and data["dates"][-1] == raw[-1].day.isoformat()
+    by_date = {row.day.isoformat(): row for row in raw}
+    assert data["metrics"]["mood"] == [by_date[day].mood for day in data["dates"]]
+    assert max(data["metrics"]["mood"]) == max(row.mood for row in raw)
+    assert min(data["metrics"]["mood"]) == min(row.mood for row in raw)
+
+
+def test_rolling_stats_endpoint(seeded_engine, seeded_client):
+    """Test /stats/rolling on the seeded entries: calendar days, windows over earlier days, EWMA"""
+    uid = "user9"
+    with seeded_engine.begin() as connection:
+        # A gap, which the rolling windows have to skip
+        connection.execute(text("DELETE FROM healthentry WHERE uid = :uid AND date::date BETWEEN '2023-03-01' AND '2023-03-10'"), {"uid": uid})
+        raw = {row.date: row.mood for row in connection.execute(
+            text("SELECT date, mood FROM healthentry WHERE uid = :uid"), {"uid": uid}
+        )}
+    stats_cache.clear()
+
+    response = seeded_client.get("/stats/rolling", params={"uid": uid, "metrics": "mood", "window": "7,30", "ewma_alpha": 0.2})
+    assert response.status_code == 200
+    data = response.json()
+    dates, mood = data["dates"], data["metrics"]["mood"]
+    print(f"{len(dates)} days, windows {data['windows']}")
+
+    assert dates[0] == min(raw) and dates[-1] == max(raw)
+    assert len(dates) == (date.fromisoformat(dates[-1]) - date.fromisoformat(dates[0])).days + 1
+    assert mood["values"] == [raw.get(day) for day in dates]
+    for window in (7, 30):
+        for i in (0, 100, dates.index("2023-03-10"), len(dates) - 1):
+            values = [value for value in mood["values"][max(i - window + 1, 0):i + 1] if value is not None]
+            expected = round(sum(values) / len(values), 3) if values else None
+            assert mood["rolling"][str(window)]["mean"][i] == expected
+    assert len(mood["ewma"]) == len(dates)
+
+    for params in ({"window": "0"}, {"window": "7,x"}, {"metrics": "nope"}, {"ewma_alpha": 1.5}):
+        assert seeded_client.get("/stats/rolling", params={"uid": uid, **params}).status_code in (400, 422)
+
+
+def test_activity_stats_match_raw_data(seeded_engine, seeded_client):
+    """Test /stats/activities against the entries"""
+    uid = "user13"
+    with seeded_engine.begin() as connection:
+        connection.execute(text("""
+            UPDATE healthentry SET daily_activities = CASE
+                WHEN date = '2022-01-01' THEN '[]'::jsonb
+                WHEN date = '2022-01-02' THEN NULL
+                ELSE jsonb_build_object('walk', mood % 2, 'yoga', CASE WHEN pain > 7 THEN 1 ELSE 0 END, 'sauna', 0)
+            END
+            WHERE uid = :uid
+        """), {"uid": uid})
+        raw = connection.execute(
+            text("SELECT mood, pain, daily_activities FROM healthentry WHERE uid = :uid"), {"uid": uid}
+        ).all()
+        connection.execute(text("ANALYZE healthentry"))
+
+    def with_activity(row, activity):
+        return isinstance(row.daily_activities, dict) and row.daily_activities.get(activity) == 1
+
+    data = seeded_client.get("/stats/activities", params={"uid": uid, "metrics": "mood,pain"}).json()
+    print(f"Activity stats: {data}")
+    assert data["total_days"] == len(raw)
+    activities_done = sum(with_activity(row, activity) for row in raw for activity in ("walk", "yoga", "sauna"))
+    assert data["activities_per_day"] == round(activities_done / len(raw), 2)
+    assert [item["activity"] for item in data["activities"]] == sorted(
+        ["walk", "yoga"], key=lambda activity: -sum(with_activity(row, activity) for row in raw)
+    )
+    for item in data["activities"]:
+        days = [row for row in raw if with_activity(row, item["activity"])]
+        other_days = [row for row in raw if not with_activity(row, item["activity"])]
+        assert item["days"] == len(days)
+        assert item["frequency"] == round(len(days) / len(raw), 3)
+        for metric in ("mood", "pain"):
+            mean_with = round(sum(getattr(row, metric) for row in days) / len(days), 2)
+            mean_without = round(sum(getattr(row, metric) for row in other_days) / len(other_days), 2)
+            assert item["metrics"][metric]["mean_with"] == mean_with
+            assert item["metrics"][metric]["mean_without"] == mean_without
+            assert item["metrics"][metric]["difference"] == round(mean_with - mean_without, 2)
+
+    only_yoga = seeded_client.get("/stats/activities", params={"uid": uid, "metrics": "mood,pain", "activity": "yoga"}).json()
+    assert only_yoga["activities"] == [item for item in data["activities"] if item["activity"] == "yoga"]
+    assert seeded_client.get("/stats/activities", params={"uid": "nobody"}).json() == {
+        "total_days": 0, "activities_per_day": None, "activities": []
+    }
+
+
+def test_partial_update_keeps_omitted_fields(seeded_engine, seeded_client):
+    """Test that a POST without the optional metrics updates an existing day, and is rejected for a new one"""
+    uid = "partial-user"
+    entry = {
+        "uid": uid, "date": "2024-03-01", "mood": 5, "pain": 2, "energy": 6, "allergy_state": 0,
+        "allergy_medication": 0, "had_sex": 0, "sexual_wellbeing": 5, "sleep_quality": 7,
+        "stress_level_work": 3, "stress_level_home": 2, "physical_activity": 1, "step_count": 4000,
+        "weather_enjoyment": 6,
+    }
+    partial = {key: value for key, value in entry.items()
+               if key not in ("energy", "physical_activity", "step_count", "weather_enjoyment")}
+    try:
+        assert seeded_client.post("/entries/", json=entry).status_code == 201
+
+        response = seeded_client.post("/entries/", json={**partial, "mood": 9})
+        print(f"Response: {response.json()}")
+        assert response.status_code == 200
+        assert response.headers["X-Operation"] == "updated"
+        assert response.json()["mood"] == 9
+        assert response.json()["energy"] == 6
+        assert response.json()["step_count"] == 4000
+
+        response = seeded_client.post("/entries/batch", json=[
+            {**partial, "mood": 1}, {**entry, "date": "2024-03-02"}
+        ])
+        print(f"Batch response: {response.json()}")
+        assert response.status_code == 200
+        assert [result["operation"] for result in response.json()["results"]] == ["updated", "created"]
+
+        with seeded_engine.connect() as connection:
+            stored = connection.execute(text(
+                "SELECT mood, energy, step_count FROM healthentry WHERE uid = :uid AND date = '2024-03-01'"
+            ), {"uid": uid}).one()
+        assert tuple(stored) == (1, 6, 4000)
+
+        response = seeded_client.post("/entries/", json={**partial, "date": "2024-03-03"})
+        assert response.status_code == 400
+        assert "energy" in response.json()["detail"]
+        response = seeded_client.post("/entries/batch", json=[{**entry, "date": "2024-03-04"}, {**partial, "date": "2024-03-05"}])
+        assert response.status_code == 400
+        with seeded_engine.connect() as connection:
+            assert connection.execute(text(
+                "SELECT count(*) FROM healthentry WHERE uid = :uid"
+            ), {"uid": uid}).scalar() == 2
+    finally:
+        with seeded_engine.begin() as connection:
+            connection.execute(text("DELETE FROM healthentry WHERE uid = :uid"), {"uid": uid})
+
+
+def test_activities_bits_follow_daily_activities(seeded_engine, seeded_client):
+    """Test that activities_bits and the registry follow every write, while the API keeps the dict form"""
+    uid = "bits-user"
+    entry = {
+        "uid": uid, "date": "2024-03-01", "mood": 5, "pain": 2, "energy": 6, "allergy_state": 0,
+        "allergy_medication": 0, "had_sex": 0, "sexual_wellbeing": 5, "sleep_quality": 7,
+        "stress_level_work": 3, "stress_level_home": 2, "physical_activity": 1, "step_count": 4000,
+        "weather_enjoyment": 6,
+    }
+
+    def stored_bits():
+        with seeded_engine.connect() as connection:
+            registry = dict(connection.execute(text("SELECT name, bit FROM activity_registry")).all())
+            bits = connection.execute(
+                text("SELECT activities_bits FROM healthentry WHERE uid = :uid"), {"uid": uid}
+            ).scalar()
+        return registry, bits
+
+    try:
+        response = seeded_client.post("/entries/", json={**entry, "daily_activities": {"swim": 1, "chess": 0, "note": "x"}})
+        print(f"Response: {response.json()}")
+        assert response.status_code == 201
+        assert response.json()["daily_activities"] == {"swim": 1, "chess": 0, "note": "x"}
+        assert "activities_bits" not in response.json()
+        registry, bits = stored_bits()
+        assert {"swim", "chess", "note"} <= set(registry)
+        assert len(set(registry.values())) == len(registry)
+        assert bits == 1 << registry["swim"]
+
+        seeded_client.post("/entries/", json={**entry, "daily_activities": {"chess": 1}})
+        registry, bits = stored_bits()
+        assert bits == 1 << registry["chess"]
+
+        # The mask cannot be written directly
+        with seeded_engine.begin() as connection:
+            connection.execute(text("UPDATE healthentry SET activities_bits = 0 WHERE uid = :uid"), {"uid": uid})
+        assert stored_bits()[1] == 1 << registry["chess"]
+
+        entries = seeded_client.get("/entries/", params={"uid": uid}).json()
+        assert entries[0]["daily_activities"] == {"chess": 1}
+        assert "activities_bits" not in entries[0]
+
+        # Activities of other users, or not done in the exported entries, get no column
+        seeded_client.post("/entries/", json={**entry, "uid": "bits-other", "daily_activities": {"secret_thing": 1}})
+        lines = seeded_client.get("/export/csv", params={"uid": uid}).text.splitlines()
+        values = dict(zip(lines[0].split(","), lines[1].split(",")))
+        print(f"CSV header: {lines[0]}")
+        assert values["chess"] == "1"
+        assert "swim" not in values and "secret_thing" not in values
+        arrays = np.load(io.BytesIO(seeded_client.get("/export/columnar", params={"uid": uid}).content), allow_pickle=False)
+        assert arrays["activity_names"].tolist() == ["chess"]
+        assert arrays["activities"].tolist() == [[1]]
+        assert "activities_bits" not in seeded_client.get("/export/json", params={"uid": uid}).json()[0]
+    finally:
+        with seeded_engine.begin() as connection:
+            connection.execute(text("DELETE FROM healthentry WHERE uid IN (:uid, 'bits-other')"), {"uid": uid})
+
+
+def test_export_includes_activities_beyond_the_registry(migrated_engine):
+    """Test that exports read activities without a bit from daily_activities once the registry is full"""
+    with migrated_engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            connection.execute(text("""
+                INSERT INTO activity_registry (bit, name)
+                SELECT bit, 'filler_' || bit FROM generate_series(0, 62) AS bit
+                WHERE bit > (SELECT coalesce(max(bit), -1) FROM activity_registry)
+            """))
+            connection.execute(text(TRIGGER_TEST_INSERT), {"offset": 0, "days": 2})
+            connection.execute(text("""
+                UPDATE healthentry SET daily_activities = CASE
+                    WHEN date = '2024-01-01' THEN '{"filler_62": 1, "overflow": 1}'::jsonb
+                    ELSE '{"overflow": 0}'::jsonb
+                END
+                WHERE uid = 'trigger-user'
+            """))
+            session = Session(bind=connection)
+            activities = api._export_activities(session, "trigger-user", None, None)
+            print(f"Export activities: {activities}")
+            assert activities == [("filler_62", 62), ("overflow", None)]
+            assert connection.execute(text(
+                "SELECT activities_bits FROM healthentry WHERE uid = 'trigger-user' ORDER BY date"
+            )).scalars().all() == [1 << 62, 0]
+        finally:
+            transaction.rollback()
+
+
+def _wait_for(condition, timeout=10.0):
+    """Poll condition until it is true or the timeout is reached, returns its last value"""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_invalidation_listener_follows_writes_and_reconnects(migrated_engine):
+    """Test that writes bump the data version and reach the listener, also after a lost connection"""
+    uid = "trigger-user"
+    cache = StatsCache(max_entries=10)
+    listening_changes = []
+    set_listening = cache.set_listening
+    cache.set_listening = lambda listening: (listening_changes.append(listening), set_listening(listening))
+
+    listener = InvalidationListener(migrated_engine, cache, reconnect_delay=0.1)
+    listener.start()
+    try:
+        assert _wait_for(lambda: not cache.verify_versions)
+        first_pid = listener.backend_pid
+
+        with migrated_engine.begin() as connection:
+            connection.execute(text(TRIGGER_TEST_INSERT), {"offset": 0, "days": 3})
+        assert _wait_for(lambda: cache.version(uid) > 0)
+
+        # Kill the listening connection: the cache has to verify versions until the listener is back
+        with migrated_engine.begin() as connection:
+            connection.execute(text("SELECT pg_terminate_backend(:pid)"), {"pid": first_pid})
+        assert _wait_for(lambda: listener.backend_pid not in (None, first_pid))
+        assert not cache.verify_versions
+        print(f"Listening state changes: {listening_changes}")
+        assert listening_changes == [False, True, False, True]
+
+        version = cache.version(uid)
+        version_query = text("SELECT version FROM user_data_version WHERE uid = :uid")
+        with migrated_engine.begin() as connection:
+            stored_version = connection.execute(version_query, {"uid": uid}).scalar()
+            connection.execute(text("DELETE FROM healthentry WHERE uid = :uid"), {"uid": uid})
+            assert connection.execute(version_query, {"uid": uid}).scalar() == stored_version + 1
+        assert _wait_for(lambda: cache.version(uid) > version)
+
+    finally:
+        listener.stop()
+
+
+def test_engine_instrumentation_counts_queries_and_connections(migrated_engine):
+    """Test that the engine events count statements, and checkouts are timed and tracked"""
+    engine = create_engine(settings.database_url, poolclass=InstrumentedQueuePool)
+    instrument_engine(engine)
+
+    def sample(name, labels=None):
+        return REGISTRY.get_sample_value(name, labels or {}) or 0.0
+
+    selects = sample("pa_db_queries_total", {"operation": "SELECT"})
+    checkouts = sample("pa_db_pool_checkout_wait_seconds_count")
+    try:
+        with engine.connect() as connection:
+            in_use = sample("pa_db_pool_connections_in_use")
+            connection.execute(text("SELECT 1"))
+            connection.execute(text("SELECT 2"))
+        assert sample("pa_db_pool_connections_in_use") == in_use - 1
+    finally:
+        engine.dispose()
+
+    # The dialect may run SELECTs of its own on the first connect
+    assert sample("pa_db_queries_total", {"operation": "SELECT"}) >= selects + 2
+    assert sample("pa_db_pool_checkout_wait_seconds_count") == checkouts + 1
+
+
+def test_profiling_logs_slow_statements_and_many_queries(seeded_engine, seeded_client, monkeypatch, caplog):
+    """Test the Server-Timing header, the slow statement log with EXPLAIN ANALYZE and the N+1 warning"""
+    profile_engine(seeded_engine)
+    monkeypatch.setenv("PA_SLOW_QUERY_MS", "0.001")
+    monkeypatch.setenv("PA_SLOW_QUERY_EXPLAIN", "true")
+    monkeypatch.setenv("PA_QUERY_COUNT_WARNING", "1")
+
+    with caplog.at_level("WARNING", logger="src.personal_analytics_backend.profiling"):
+        response = seeded_client.get("/stats/summary", params={"uid": "user7"})
+    assert response.status_code == 200
+
+    server_timing = response.headers["server-timing"]
+    print(f"Server-Timing: {server_timing}")
+    assert [part.split(";")[0] for part in server_timing.split(", ")] == ["db", "handler", "serialize", "total"]
+    query_count = int(server_timing.split('desc="')[1].split(" ")[0])
+    assert query_count >= 2
+
+    slow_logs = [record.getMessage() for record in caplog.records if record.getMessage().startswith("Slow SQL")]
+    assert len(slow_logs) == query_count
+    assert any("'user7'" in message and "Execution Time" in message for message in slow_logs)
+    assert any("possibly an N+1 query pattern" in record.getMessage() and "/stats/summary" in record.getMessage()
+               for record in caplog.records)
+
+    # The EXPLAIN ANALYZE ran in a savepoint, the session's transaction still works
+    assert seeded_client.get("/stats/weekday-averages", params={"uid": "user7"}).status_code == 200
+
+
+def test_pool_replaces_broken_connections_and_counts_timeouts(migrated_engine):
+    """Test that pre-ping replaces a killed connection without an error, and that pool events are counted"""
+    engine = create_engine(
+        settings.database_url, poolclass=InstrumentedQueuePool,
+        pool_size=1, max_overflow=0, pool_timeout=0.2, pool_pre_ping=True
+    )
+    instrument_engine(engine)
+
+    def sample(name, labels=None):
+        return REGISTRY.get_sample_value(name, labels or {}) or 0.0
+
+    events = {event: sample("pa_db_pool_events_total", {"event": event})
+              for event in ("connect", "close", "invalidate", "checkout_timeout")}
+    try:
+        with engine.connect() as connection:
+            pid = connection.execute(text("SELECT pg_backend_pid()")).scalar()
+        with migrated_engine.begin() as connection:
+            connection.execute(text("SELECT pg_terminate_backend(:pid)"), {"pid": pid})
+
+        # The pre-ping notices the killed connection and opens a new one
+        with engine.connect() as connection:
+            assert connection.execute(text("SELECT pg_backend_pid()")).scalar() != pid
+            with pytest.raises(sqlalchemy_exc.TimeoutError):
+                engine.connect()
+    finally:
+        engine.dispose()
+
+    increments = {event: sample("pa_db_pool_events_total", {"event": event}) - before for event, before in events.items()}
+    print(f"Pool events: {increments}")
+    assert increments == {"connect": 2, "close": 2, "invalidate": 1, "checkout_timeout": 1}
+
+
+def test_async_mode_answers_like_sync_mode(seeded_engine, seeded_client, monkeypatch):
+    """Test that endpoints wrapped for async mode, including a streamed export, answer like in sync mode"""
+    pytest.importorskip("psycopg", reason="async mode needs the async extra")
+    monkeypatch.setenv("PA_ASYNC_DATABASE", "true")
+    with seeded_engine.connect() as connection:
+        schema = connection.execute(text("SELECT current_schema()")).scalar()
+    # NullPool, as the connections of the async driver belong to the event loop of the test client
+    async_engine = create_async_engine(
+        make_url(settings.database_url).set(drivername="postgresql+psycopg"),
+        connect_args={"options": f"-csearch_path={schema}"}, poolclass=NullPool
+    )
+
+    async def get_test_async_session():
+        async with AsyncSession(async_engine) as session:
+            yield session
+
+    async_app = FastAPI()
+    async_app.get("/entries/", response_model=List[HealthEntryRead])(async_if_enabled(api.read_all_entries))
+    async_app.get("/stats/summary")(async_if_enabled(api.get_summary_stats))
+    async_app.get("/export/ndjson")(async_if_enabled(api.export_all_data_ndjson))
+    async_app.dependency_overrides[get_async_session] = get_test_async_session
+
+    requests = [
+        ("/entries/", {"uid": "user3", "limit": 50}),
+        ("/stats/summary", {"uid": "user3"}),
+        ("/export/ndjson", {"uid": "user3"}),
+        ("/export/ndjson", {"uid": "nobody"}),
+    ]
+    with TestClient(async_app) as async_client:
+        for path, params in requests:
+            stats_cache.clear()
+            expected = seeded_client.get(path, params=params)
+            stats_cache.clear()
+            response = async_client.get(path, params=params)
+            print(f"{path} {params}: {response.status_code}, {len(response.content)} bytes")
+            assert response.status_code == expected.status_code
+            assert response.content == expected.content
@@ -0,0 +1,195 @@
+import math
+import statistics
+
+import numpy as np
+import pytest
+
+from src.personal_analytics_backend import stats_engine
+
+
+nan = float("nan")
+
+
+@pytest.fixture
+def metric_values():
+    """Five days of three metrics, the third one with missing values"""
+    return np.array([
+        [5.0, 2.0, 7.0],
+        [6.0, 1.0, nan],
+        [8.0, 0.0, 9.0],
+        [3.0, 6.0, 4.0],
+        [4.0, 5.0, nan],
+    ])
+
+
+def test_rows_to_matrix_maps_none_to_nan():
+    """Test that NULL metric values become NaN, and dates are split off"""
+    dates, values = stats_engine.rows_to_matrix([("2024-01-01", 5, None), ("2024-01-02", 6, 3)], 2)
+    assert dates == ["2024-01-01", "2024-01-02"]
+    assert values.shape == (2, 2)
+    assert math.isnan(values[0, 1])
+
+    _, empty = stats_engine.rows_to_matrix([], 2)
+    assert empty.shape == (0, 2)
+
+
+def test_pearson_matrix_matches_statistics_on_complete_pairs(metric_values):
+    """Test the vectorized Pearson correlation against the standard library, pair by pair"""
+    correlations, sample_sizes = stats_engine.pearson_matrix(metric_values)
+
+    assert correlations[0, 1] == pytest.approx(statistics.correlation(metric_values[:, 0], metric_values[:, 1]))
+    assert sample_sizes[0, 1] == 5
+
+    # Only the days on which both metrics were recorded are used, aligned by day
+    common = ~np.isnan(metric_values[:, 2])
+    expected = statistics.correlation(metric_values[common, 0], metric_values[common, 2])
+    assert correlations[0, 2] == pytest.approx(expected)
+    assert correlations[2, 0] == pytest.approx(expected)
+    assert sample_sizes[0, 2] == 3
+    assert correlations[1, 1] == pytest.approx(1.0)
+
+
+def test_pearson_matrix_marks_degenerate_pairs(metric_values):
+    """Test that constant columns and too small samples give NaN instead of an error"""
+    values = np.column_stack([metric_values[:, 0], np.full(5, 3.0)])
+    correlations, _ = stats_engine.pearson_matrix(values)
+    assert math.isnan(correlations[0, 1])
+
+    correlations, _ = stats_engine.pearson_matrix(metric_values, min_periods=4)
+    assert math.isnan(correlations[0, 2])
+    assert not math.isnan(correlations[0, 1])
+
+
+def test_rankdata_averages_ties():
+    """Test that tied values get the average of their ranks"""
+    ranks = stats_engine.rankdata(np.array([10.0, 20.0, 10.0, nan, 30.0]))
+    assert ranks[:3].tolist() == [1.5, 3.0, 1.5]
+    assert math.isnan(ranks[3])
+    assert ranks[4] == 4.0
+
+
+def test_spearman_matrix_reranks_pairs_with_missing_values(metric_values):
+    """Test that Spearman correlation ranks each pair over the days both metrics were recorded"""
+    correlations, sample_sizes = stats_engine.correlation_matrix(metric_values, method="spearman")
+
+    # Perfectly anti-monotonic on all five days
+    assert correlations[0, 1] == pytest.approx(statistics.correlation(
+        stats_engine.rankdata(metric_values[:, 0]), stats_engine.rankdata(metric_values[:, 1])
+    ))
+    # Monotonic on the three common days
+    assert correlations[0, 2] == pytest.approx(1.0)
+    assert sample_sizes[0, 2] == 3
+
+
+def test_correlation_pairs_sorted_and_without_undefined():
+    """Test that pairs come sorted by strength, and undefined correlations are dropped"""
+    correlations = np.array([
+        [1.0, 0.2, -0.9],
+        [0.2, 1.0, nan],
+        [-0.9, nan, 1.0],
+    ])
+    sample_sizes = np.full((3, 3), 10)
+    pairs = stats_engine.correlation_pairs(["a", "b", "c"], correlations, sample_sizes)
+    assert [(pair["metric1"], pair["metric2"]) for pair in pairs] == [("a", "c"), ("a", "b")]
+    assert pairs[0]["correlation"] == -0.9
+    assert pairs[0]["sample_size"] == 10
+
+
+def test_daily_series_leaves_gaps_for_missing_days():
+    """Test that entries are placed on a calendar grid, with NaN rows for days without entry"""
+    values = np.array([[1.0], [2.0], [4.0]])
+    daily = stats_engine.daily_series(["2024-02-28", "2024-02-29", "2024-03-02"], values)
+    assert daily.shape == (4, 1)
+    assert daily[:2, 0].tolist() == [1.0, 2.0]
+    assert math.isnan(daily[2, 0])
+    assert daily[3, 0] == 4.0
+
+
+def test_daily_series_accepts_unpadded_dates():
+    """Test that dates stored without zero padding are placed on the grid like padded ones"""
+    values = np.array([[1.0], [3.0]])
+    daily = stats_engine.daily_series(["2024-1-5", "2024-01-07"], values)
+    assert daily.shape == (3, 1)
+    assert daily[0, 0] == 1.0
+    assert math.isnan(daily[1, 0])
+    assert daily[2, 0] == 3.0
+
+
+def test_lagged_correlations_pair_days_by_calendar():
+    """Test that lagged correlations only pair up days that are exactly lag days apart"""
+    # Metric 1 follows metric 0 with a delay of two days, one day is missing
+    leader = np.array([1.0, 5.0, 2.0, 8.0, 3.0, 7.0, 4.0, 6.0, 2.0, 9.0])
+    follower = np.concatenate([[0.0, 0.0], leader[:-2]])
+    daily = np.column_stack([leader, follower])
+    daily[5] = np.nan
+
+    correlations, sample_sizes = stats_engine.lagged_correlations(daily, max_lag=3)
+
+    assert correlations.shape == (3, 2, 2)
+    assert correlations[1, 0, 1] == pytest.approx(1.0)   # metric 0 today vs metric 1 in two days
+    assert abs(correlations[0, 0, 1]) < 0.99
+    # 8 pairs of days two days apart, minus the two that involve the missing day
+    assert sample_sizes[1, 0, 1] == 6
+
+    # More lags than days leave the extra lags undefined
+    correlations, sample_sizes = stats_engine.lagged_correlations(daily[:3], max_lag=5)
+    assert np.isnan(correlations[2:]).all()
+    assert (sample_sizes[2:] == 0).all()
+
+
+def test_lttb_keeps_ends_and_spikes():
+    """Test that LTTB keeps the first and last point and a single spike, and skips missing values"""
+    x = np.arange(1000.0)
+    y = np.sin(x / 50)
+    y[500] = 10.0
+    y[::7] = nan
+
+    kept = stats_engine.lttb_indices(x, y, 50)
+
+    assert len(kept) == 50
+    assert (np.diff(kept) > 0).all()
+    assert kept[0] == 1 and kept[-1] == 999
+    assert 500 in kept
+    assert not np.isnan(y[kept]).any()
+
+    # Short series are returned as they are
+    assert stats_engine.lttb_indices(x[:5], y[:5], 10).tolist() == [1, 2, 3, 4]
+
+
+def test_rolling_mean_std_match_naive_windows():
+    """Test the running-sum rolling mean and std against recomputing every window, with missing days"""
+    rng = np.random.default_rng(3)
+    daily = rng.integers(0, 11, size=(60, 2)).astype(float)
+    daily[rng.random(daily.shape) < 0.3] = nan
+    daily[10:20] = nan  # A gap of ten days
+
+    for window in (1, 7, 30):
+        mean, std = stats_engine.rolling_mean_std(daily, window)
+        for day in range(len(daily)):
+            for metric in range(2):
+                values = daily[max(day - window + 1, 0):day + 1, metric]
+                values = values[~np.isnan(values)]
+                if len(values) >= 1:
+                    assert mean[day, metric] == pytest.approx(values.mean())
+                else:
+                    assert math.isnan(mean[day, metric])
+                if len(values) >= 2:
+                    assert std[day, metric] == pytest.approx(statistics.stdev(values))
+                else:
+                    assert math.isnan(std[day, metric])
+
+
+def test_ewma_decays_over_missing_days():
+    """Test that the EWMA weighs values by their age in days, also across missing days"""
+    daily = np.array([[2.0], [nan], [nan], [8.0], [nan]])
+    alpha = 0.5
+
+    smoothed = stats_engine.ewma(daily, alpha)
+
+    assert smoothed[0, 0] == 2.0
+    assert smoothed[2, 0] == 2.0  # Only one value so far, whatever its weight
+    # The first value is three days old on day 3
+    expected = (8.0 + 0.5 ** 3 * 2.0) / (1 + 0.5 ** 3)
+    assert smoothed[3, 0] == pytest.approx(expected)
+    assert smoothed[4, 0] == pytest.approx(expected)
+    assert math.isnan(stats_engine.ewma(np.array([[nan], [1.0]]), alpha)[0, 0])